@@ -1,14 +1,41 @@
+import argparse
+import asyncio
+import atexit
+import cProfile
+import io
+import json
 import logging
+import multiprocessing
+import os
+import pstats
+import queue
+import random
+import re
+import signal
 import sqlite3
-from typing import Dict, Optional, List, Tuple
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import threading
+import time
+import traceback
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Deque, Dict, Optional, List, Set, Tuple
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial, wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from multiprocessing.queues import Queue as ProcessQueue
+from multiprocessing.synchronize import Event as ProcessEvent
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
 
@@ -22,6 +49,69 @@ START_TIME = datetime.now()
 DATABASE_FILE = "bot_database.db"
 LOG_FILE = "bot.log"
 
+# Bot API server the bot talks to; the token is appended. Point it at a
+# local telegram-bot-api server, or at fake_bot_api.py for load tests.
+BOT_API_BASE_URL = "https://api.telegram.org/bot"
+
+# Async storage configuration
+DB_READER_THREADS = 4
+
+# Schema migrations that only add indexes are run after startup, on a
+# background thread, once their table has MIGRATION_BACKGROUND_ROWS rows;
+# building them inline would hold up startup for as long as the build takes.
+MIGRATION_BACKGROUND_ROWS = 100_000
+# A background build holds the database write lock until its index is done;
+# meanwhile writes give up after INDEX_BUILD_LOCK_WAIT seconds instead of the
+# storage profile's busy_timeout, and only the periodic flush commits buffers.
+INDEX_BUILD_LOCK_WAIT = 0.05
+
+# SQLite storage profile applied to every connection. "durable" fsyncs every
+# commit, "balanced" only at WAL checkpoints (a power loss can drop the last
+# commits but never corrupts the file), "throughput" leaves syncing to the OS.
+STORAGE_PROFILE = "balanced"
+STORAGE_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000,
+        'cached_statements': 128
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+        'cached_statements': 256
+    },
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 10000,
+        'cached_statements': 512
+    }
+}
+
+# Write-behind configuration: user upserts and command logs are buffered and
+# committed together once WRITE_BATCH_SIZE rows are pending or the oldest
+# pending row is WRITE_MAX_DELAY seconds old. These bound how much recent
+# activity a crash can lose, and how stale reads of users, commands and the
+# stats counters may be; only the writer thread ever commits them.
+WRITE_BATCH_SIZE = 500
+WRITE_MAX_DELAY = 2.0
+# After a failed flush only the periodic flush retries, so writes never wait
+# on a failing database; meanwhile at most WRITE_BUFFER_MAX_COMMANDS command
+# logs are kept and the oldest beyond that are dropped. Pending user upserts
+# are bounded by the number of distinct users and always kept.
+WRITE_BUFFER_MAX_COMMANDS = 100_000
+
 # Rate limiting configuration
 RATE_LIMITS = {
     'start': timedelta(seconds=10),
@@ -31,41 +121,654 @@ RATE_LIMITS = {
     'feedback': timedelta(minutes=2)
 }
 
-# Logging setup
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
+# Cooldowns live in memory; at most RATE_LIMITER_MAX_ENTRIES are tracked and
+# live ones are snapshotted to SQLite every RATE_LIMIT_SNAPSHOT_INTERVAL
+# seconds (0 disables) so they survive restarts.
+RATE_LIMITER_MAX_ENTRIES = 1_000_000
+RATE_LIMIT_SNAPSHOT_INTERVAL = 60.0
 
-class DatabaseManager:
-    """Handles all database operations with connection pooling"""
-    
-    _connection = None
+# Broadcast engine: Telegram allows about 30 messages/s in total and 1
+# message/s per chat. Recipients are processed in chunks of
+# BROADCAST_CHUNK_SIZE and the job cursor is persisted after each chunk, so
+# a crash re-sends at most one chunk.
+BROADCAST_SENDERS = 8
+BROADCAST_GLOBAL_RATE = 25.0
+BROADCAST_PER_CHAT_RATE = 1.0
+BROADCAST_CHUNK_SIZE = 100
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_PROGRESS_INTERVAL = 5.0
+
+# Deliverability of each chat, from broadcast send results. Chats that are
+# blocked, deactivated or not found are stored in delivery_status and
+# skipped by later broadcasts until the user sends /start again; every other
+# chat is deliverable and has no row.
+DELIVERY_OK = 0
+DELIVERY_BLOCKED = 1
+DELIVERY_DEACTIVATED = 2
+DELIVERY_CHAT_NOT_FOUND = 3
+DELIVERY_STATUS_NAMES = {
+    DELIVERY_OK: "ok",
+    DELIVERY_BLOCKED: "blocked",
+    DELIVERY_DEACTIVATED: "deactivated",
+    DELIVERY_CHAT_NOT_FOUND: "chat not found"
+}
+
+# get_global_stats reads counters maintained by SQLite triggers; they are
+# recomputed from the base tables every STATS_RECONCILE_INTERVAL seconds.
+STATS_RECONCILE_INTERVAL = 6 * 3600
+
+# Raw command rows older than COMMAND_RAW_RETENTION_DAYS are folded into
+# per-user/per-command/per-hour rollups every COMMAND_ROLLUP_INTERVAL seconds,
+# at most COMMAND_ROLLUP_BATCH rows per transaction. Keep the window at two
+# days or more: reconcile_stats rebuilds recent activity from the raw rows.
+COMMAND_RAW_RETENTION_DAYS = 7
+COMMAND_ROLLUP_INTERVAL = 3600
+COMMAND_ROLLUP_BATCH = 10_000
+
+# bot_settings and the banned/limited ID sets are served from memory. Writes
+# bump a version stamp that other processes sharing the DB file check every
+# CACHE_VERSION_CHECK_INTERVAL seconds (0 disables the check).
+CACHE_VERSION_CHECK_INTERVAL = 10.0
+
+# Bulk moderation: one action applied to a pasted list or an uploaded text
+# file of user IDs in a single transaction. Reports list up to
+# BULK_REPORT_INLINE_IDS IDs per outcome; longer ones come as a CSV file.
+BULK_MODERATION_ACTIONS = {
+    'ban': ('is_banned', 1),
+    'unban': ('is_banned', 0),
+    'limit': ('is_limited', 1),
+    'unlimit': ('is_limited', 0)
+}
+BULK_MODERATION_MAX_IDS = 100_000
+BULK_MODERATION_MAX_FILE_SIZE = 2 * 1024 * 1024
+BULK_REPORT_INLINE_IDS = 20
+
+# Update ingestion: "polling" or "webhook". In webhook mode the embedded
+# server listens on WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH and registers
+# WEBHOOK_URL, the public HTTPS address (e.g. a reverse proxy in front of one
+# or more instances), with Telegram; webhook mode refuses to start without
+# it. When WEBHOOK_SECRET_TOKEN is set, requests without a matching
+# X-Telegram-Bot-Api-Secret-Token are rejected. --listen, --port,
+# --webhook-path, --webhook-url and --secret-token set these per instance.
+UPDATE_MODE = "polling"
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"
+WEBHOOK_URL = ""
+WEBHOOK_SECRET_TOKEN = ""
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Sharded deployment: with WORKER_PROCESSES > 0 the main process only receives
+# updates and routes each one to worker user_id % WORKER_PROCESSES over a
+# bounded queue, so one user's updates are always handled, in order, by the
+# same worker. Workers share the SQLite file (WAL + busy_timeout) and pick up
+# each other's settings and moderation changes through cache_versions; only
+# worker 0 resumes broadcasts and runs reconciliation and rollups.
+WORKER_PROCESSES = 0
+WORKER_QUEUE_SIZE = 10_000
+
+# Updates from different users are handled concurrently, at most
+# MAX_CONCURRENT_UPDATES at once (1 restores sequential processing); one
+# user's updates still run one at a time and in order, so the feedback and
+# admin pending_action flows never race. At most MAX_PENDING_UPDATES are
+# taken in, counting those waiting for their user's earlier ones; the rest
+# wait in the update queue. Outbound Bot API calls share a pool of
+# CONNECTION_POOL_SIZE connections and wait up to POOL_TIMEOUT seconds for a
+# free one.
+MAX_CONCURRENT_UPDATES = 64
+MAX_PENDING_UPDATES = 4096
+CONNECTION_POOL_SIZE = 64
+POOL_TIMEOUT = 10.0
+
+# Callback queries taking longer than this many seconds are logged as slow
+SLOW_CALLBACK_THRESHOLD = 1.0
+
+# Metrics: handler, callback, database and Bot API latencies are recorded in
+# histograms with these bucket bounds (seconds) and served in Prometheus text
+# format at http://METRICS_HOST:METRICS_PORT/metrics (0 or --metrics-port 0
+# disables the endpoint; sharded worker N listens on METRICS_PORT + N). If
+# the port is taken the bot logs a warning and runs without the endpoint.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Profiling, off by default and switched at runtime with /profile on|off.
+# While on, SQL statements slower than SLOW_QUERY_THRESHOLD seconds are
+# logged with the shape of their parameters (never the values), and a
+# PROFILE_SAMPLE_RATE share of handler calls run under cProfile; the
+# aggregated stats are written to PROFILE_FILE every PROFILE_DUMP_INTERVAL
+# seconds and when profiling is switched off.
+PROFILING_ENABLED = False
+SLOW_QUERY_THRESHOLD = 0.05
+SLOW_QUERY_LOG_SIZE = 50
+PROFILE_SAMPLE_RATE = 0.01
+PROFILE_FILE = "bot_profile.prof"
+PROFILE_DUMP_INTERVAL = 60
+
+# Feedback viewer: at most FEEDBACK_PAGE_SIZE entries per page, fewer when
+# they would not fit in one message (Telegram's limit, in UTF-16 code units)
+FEEDBACK_PAGE_SIZE = 10
+MESSAGE_MAX_LENGTH = 4096
+
+# Broadcast audience segments: language, premium, active within one of
+# SEGMENT_ACTIVE_DAYS and banned or not. Segment sizes in the picker come
+# from a summary of the users table refreshed every SEGMENT_SUMMARY_TTL
+# seconds; the SEGMENT_LANGUAGES most common languages are offered.
+SEGMENT_ACTIVE_DAYS = (1, 7, 30)
+SEGMENT_LANGUAGES = 8
+SEGMENT_SUMMARY_TTL = 300
+
+# Logging: records are queued by the calling thread and written to stderr
+# and LOG_FILE by a listener thread, so logging never does I/O on the event
+# loop. LOG_FILE rotates at LOG_MAX_BYTES, or at LOG_ROTATE_WHEN (e.g.
+# "midnight") if set, keeping LOG_BACKUP_COUNT old files. LOG_FORMAT "json"
+# writes one compact JSON object per line. Records beyond LOG_QUEUE_SIZE
+# waiting to be written are dropped and counted. Repetitive errors logged
+# with an aggregate key are written once per LOG_AGGREGATE_INTERVAL seconds,
+# followed by a count of the ones suppressed.
+LOG_FORMAT = "text"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_WHEN: Optional[str] = None
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10_000
+LOG_AGGREGATE_INTERVAL = 60.0
+
+# Rendered /start profile texts kept in memory, keyed by every field they show
+PROFILE_RENDER_CACHE_SIZE = 10_000
+
+# Position of this process among the workers (set by run_worker)
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+
+class JsonLogFormatter(logging.Formatter):
+    """One compact JSON object per record, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'msg': record.getMessage()
+        }
+        if hasattr(record, 'aggregate'):
+            entry['aggregate'] = record.aggregate
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+class LogAggregator(logging.Filter):
+    """Pass the first record of each aggregate key per window and count the rest.
     
+    Call sites opt in with logger.error(..., extra={'aggregate': key}), e.g.
+    one key for every failed broadcast send. flush() logs how many records
+    each key suppressed and opens a new window; run it every
+    LOG_AGGREGATE_INTERVAL seconds.
+    """
+
+    _lock = threading.Lock()
+    # key -> [suppressed count, last suppressed message, logger, level]
+    _windows: Dict[str, list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'aggregate', None)
+        if key is None:
+            return True
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                self._windows[key] = [0, None, record.name, record.levelno]
+                return True
+            window[0] += 1
+            window[1] = record.getMessage()
+        Metrics.inc('bot_log_records_suppressed_total', 'aggregate', key)
+        return False
+
     @classmethod
-    def get_connection(cls):
-        if cls._connection is None:
-            cls._connection = sqlite3.connect(DATABASE_FILE)
-            cls._connection.row_factory = sqlite3.Row
-        return cls._connection
+    def flush(cls):
+        with cls._lock:
+            windows, cls._windows = cls._windows, {}
+        for key, (suppressed, last_message, name, level) in windows.items():
+            if suppressed:
+                logging.getLogger(name).log(
+                    level, f"{suppressed} more '{key}' messages suppressed, the last: {last_message}"
+                )
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records, counting them, when the listener falls behind."""
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            Metrics.inc('bot_log_records_dropped_total', 'level', record.levelname)
+
+_log_listener: Optional[QueueListener] = None
+
+def setup_logging(log_queue=None, listen: bool = True) -> None:
+    """Send every log record through a queue instead of writing it inline.
+    
+    With `listen` this process also starts the listener thread that writes
+    the queue to stderr and the rotating LOG_FILE. Sharded workers pass the
+    front process's multiprocessing queue with listen=False, so one process
+    owns (and rotates) the file. Calling it again replaces the previous
+    setup.
+    """
+    global _log_listener
+    stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    if log_queue is None:
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    
+    if listen:
+        if LOG_ROTATE_WHEN:
+            file_handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT,
+                                                    encoding='utf-8')
+        else:
+            file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                               encoding='utf-8')
+        if LOG_FORMAT == "json":
+            formatter = JsonLogFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handlers = [file_handler, logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _log_listener.start()
+    
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(LogAggregator())
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+
+def stop_logging() -> None:
+    """Write out everything still queued and stop the listener thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+# Exit handlers run last-registered first: queued records are written out
+# before logging's own shutdown closes the handlers
+atexit.register(stop_logging)
+logger = logging.getLogger(__name__)
+
+class Metrics:
+    """Process-wide counters, gauges and latency histograms.
     
+    Every series has a single label. Recording is a bisect and two adds
+    under a lock, cheap enough to leave on; gauges are callables read only
+    when metrics are rendered.
+    """
+
+    HELP = {
+        'bot_handler_seconds': "Time spent in update handlers",
+        'bot_handler_errors_total': "Update handlers that raised",
+        'bot_callback_seconds': "Time spent handling callback query routes",
+        'bot_db_seconds': "Time spent in DatabaseManager methods",
+        'bot_api_seconds': "Time spent in Bot API requests",
+        'bot_api_errors_total': "Bot API requests answered with a non-200 status",
+        'bot_update_queue_depth': "Updates waiting to be handled",
+        'bot_pending_writes': "Buffered user upserts and command logs not yet committed",
+        'bot_active_broadcasts': "Broadcast jobs running in this process",
+        'bot_broadcast_undeliverable_total': "Broadcast recipients found blocked, deactivated or missing",
+        'bot_uptime_seconds': "Seconds since the bot started",
+        'bot_log_records_dropped_total': "Log records dropped because the log queue was full",
+        'bot_log_records_suppressed_total': "Repetitive log records folded into a periodic summary"
+    }
+
+    _lock = threading.Lock()
+    # name -> (label, value) -> per-bucket counts (last one is +Inf), then the sum
+    _histograms: Dict[str, Dict[Tuple[str, str], list]] = {}
+    _counters: Dict[str, Dict[Tuple[str, str], float]] = {}
+    _gauges: Dict[str, Callable[[], float]] = {}
+
     @classmethod
-    def close_connection(cls):
-        if cls._connection is not None:
-            cls._connection.close()
-            cls._connection = None
+    def observe(cls, name: str, label: str, value: str, seconds: float):
+        index = bisect_left(METRICS_BUCKETS, seconds)
+        with cls._lock:
+            series = cls._histograms.setdefault(name, {})
+            buckets = series.get((label, value))
+            if buckets is None:
+                buckets = series[(label, value)] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+            buckets[index] += 1
+            buckets[-1] += seconds
+
+    @classmethod
+    def inc(cls, name: str, label: str, value: str, amount: float = 1):
+        with cls._lock:
+            series = cls._counters.setdefault(name, {})
+            series[(label, value)] = series.get((label, value), 0) + amount
+
+    @classmethod
+    def gauge(cls, name: str, read: Callable[[], float]):
+        cls._gauges[name] = read
+
+    @classmethod
+    def _snapshot(cls) -> Tuple[Dict, Dict]:
+        with cls._lock:
+            histograms = {name: {key: list(buckets) for key, buckets in series.items()}
+                          for name, series in cls._histograms.items()}
+            counters = {name: dict(series) for name, series in cls._counters.items()}
+        return histograms, counters
+
+    @classmethod
+    def render(cls) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        histograms, counters = cls._snapshot()
+        lines = []
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {cls.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (label, value), buckets in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{label}="{value}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {buckets[-1]:.6f}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {cumulative}')
+        for name, series in sorted(counters.items()):
+            lines.append(f"# HELP {name} {cls.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (label, value), count in sorted(series.items()):
+                lines.append(f'{name}{{{label}="{value}"}} {count}')
+        for name, read in sorted(cls._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logger.error(f"Reading gauge {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {cls.HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def summary(cls, top: int = 5) -> str:
+        """Busiest series of each histogram with count, p50 and p95, for the admin panel."""
+        histograms, counters = cls._snapshot()
+        
+        def quantile(buckets: list, count: int, q: float) -> str:
+            # Upper bound of the bucket holding the q-th observation
+            cumulative = 0
+            for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+                cumulative += bucket_count
+                if cumulative >= q * count:
+                    return f"≤{bound * 1000:g}ms"
+            return f">{METRICS_BUCKETS[-1]:g}s"
+        
+        sections = []
+        for name, series in sorted(histograms.items()):
+            rows = sorted(((sum(buckets[:-1]), value, buckets) for (_, value), buckets in series.items()),
+                          key=lambda row: row[0], reverse=True)[:top]
+            lines = [f"{cls.HELP.get(name, name)}:"]
+            for count, value, buckets in rows:
+                lines.append(f"  {value}: {count}x, p50 {quantile(buckets, count, 0.5)}, "
+                             f"p95 {quantile(buckets, count, 0.95)}")
+            sections.append("\n".join(lines))
+        # Only the *_errors_total counters; the others count drops and outcomes
+        errors = sum(sum(series.values()) for name, series in counters.items() if name.endswith('_errors_total'))
+        sections.append(f"Errors: {errors:g}")
+        return "\n\n".join(sections)
+
+class Profiler:
+    """Opt-in slow-query log and sampled cProfile of update handlers.
     
+    cProfile only sees the thread that enables it, so sampling covers the
+    event loop: while any sampled handler call is in flight, everything the
+    loop runs is profiled, including other updates interleaved with it.
+    Time spent in the database threads shows up in the slow-query log.
+    """
+
+    enabled = PROFILING_ENABLED
+    sample_rate = PROFILE_SAMPLE_RATE
+    slow_query_threshold = SLOW_QUERY_THRESHOLD
+    sampled = 0
+    last_dump: Optional[str] = None
+
+    _lock = threading.Lock()
+    # (logged at, seconds, sql, parameter shape), newest last
+    _slow_queries: Deque[Tuple[datetime, float, str, str]] = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+    _profile: Optional[cProfile.Profile] = None
+    _active = 0
+
     @classmethod
-    def init_db(cls):
-        conn = cls.get_connection()
-        cursor = conn.cursor()
+    def enable(cls, sample_rate: Optional[float] = None, slow_query_threshold: Optional[float] = None):
+        if sample_rate is not None:
+            cls.sample_rate = sample_rate
+        if slow_query_threshold is not None:
+            cls.slow_query_threshold = slow_query_threshold
+        cls.enabled = True
+        logger.info(f"Profiling on: sampling {cls.sample_rate:.1%} of handler calls, "
+                    f"logging queries over {cls.slow_query_threshold * 1000:g}ms")
+
+    @classmethod
+    def disable(cls) -> Optional[str]:
+        """Stop profiling and write what was collected; returns the file written."""
+        cls.enabled = False
+        path = cls.dump()
+        logger.info("Profiling off")
+        return path
+
+    @staticmethod
+    def parameter_shape(parameters) -> str:
+        """Types of a statement's parameters, e.g. "(int, str)" or "{user_id: int}"."""
+        if isinstance(parameters, dict):
+            return "{" + ", ".join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + "}"
+        if isinstance(parameters, (list, tuple)):
+            return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+        return type(parameters).__name__
+
+    @classmethod
+    def record_query(cls, sql: str, shape: str, seconds: float):
+        sql = " ".join(sql.split())
+        with cls._lock:
+            cls._slow_queries.append((datetime.now(), seconds, sql, shape))
+        logger.warning(f"Slow query ({seconds * 1000:.1f}ms, params {shape}): {sql}",
+                       extra={'aggregate': 'slow_query'})
+
+    @classmethod
+    def start_sample(cls):
+        with cls._lock:
+            if cls._profile is None:
+                cls._profile = cProfile.Profile()
+            if cls._active == 0:
+                cls._profile.enable()
+            cls._active += 1
+            cls.sampled += 1
+
+    @classmethod
+    def stop_sample(cls):
+        with cls._lock:
+            cls._active -= 1
+            if cls._active == 0:
+                cls._profile.disable()
+
+    @classmethod
+    def dump(cls) -> Optional[str]:
+        """Write the stats aggregated since the last reset to PROFILE_FILE."""
+        with cls._lock:
+            if cls._profile is None:
+                return None
+            root, ext = os.path.splitext(PROFILE_FILE)
+            path = f"{root}.{SHARD_INDEX}{ext}" if SHARD_COUNT > 1 else PROFILE_FILE
+            # dump_stats() stops the profiler; resume it for calls still in flight
+            cls._profile.dump_stats(path)
+            if cls._active:
+                cls._profile.enable()
+            cls.last_dump = path
+        return path
+
+    @classmethod
+    def reset(cls):
+        """Forget collected samples and slow queries."""
+        with cls._lock:
+            if cls._active:
+                cls._profile.disable()
+                cls._profile = cProfile.Profile()
+                cls._profile.enable()
+            else:
+                cls._profile = None
+            cls._slow_queries.clear()
+            cls.sampled = 0
+
+    @classmethod
+    def summary(cls, top: int = 5) -> str:
+        """State, slowest recent queries and costliest functions, for /profile."""
+        with cls._lock:
+            slow_queries = sorted(cls._slow_queries, key=lambda entry: entry[1], reverse=True)[:top]
+            functions = []
+            if cls._profile is not None:
+                # Like dump_stats(), taking a snapshot stops the profiler
+                stats = pstats.Stats(cls._profile).stats
+                if cls._active:
+                    cls._profile.enable()
+                # Own time: cumulative time would rank the event loop's frames first
+                functions = sorted(((own, calls, f"{func} ({os.path.basename(file)}:{line})")
+                                    for (file, line, func), (_, calls, own, _, _) in stats.items()),
+                                   reverse=True)[:top]
+        lines = [
+            f"Profiling: {'on' if cls.enabled else 'off'}",
+            f"Sampling {cls.sample_rate:.1%} of handler calls ({cls.sampled} sampled)",
+            f"Slow query threshold: {cls.slow_query_threshold * 1000:g}ms",
+            f"Last dump: {cls.last_dump or 'none'}"
+        ]
+        if slow_queries:
+            lines.append("\nSlowest recent queries:")
+            for logged_at, seconds, sql, shape in slow_queries:
+                lines.append(f"  {seconds * 1000:.1f}ms at {logged_at:%H:%M:%S} {shape}: {sql[:120]}")
+        if functions:
+            lines.append("\nMost time spent in (sampled calls):")
+            for own, calls, name in functions:
+                lines.append(f"  {own * 1000:.1f}ms in {calls} calls: {name}")
+        return "\n".join(lines)
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Cursor that reports statements slower than Profiler.slow_query_threshold.
+    
+    A statement's time is its execute plus the fetchone/fetchall calls
+    after it (iterating the cursor is not timed); it is logged once, as
+    soon as it crosses the threshold.
+    """
+
+    _shape = ""
+    _elapsed = 0.0
+    _reported = True
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            if not self._reported and self._elapsed >= Profiler.slow_query_threshold:
+                self._reported = True
+                Profiler.record_query(self._sql, self._shape, self._elapsed)
+
+    def execute(self, sql, parameters=()):
+        if not Profiler.enabled:
+            return super().execute(sql, parameters)
+        self._sql, self._shape, self._elapsed, self._reported = sql, Profiler.parameter_shape(parameters), 0.0, False
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not Profiler.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        if isinstance(seq_of_parameters, (list, tuple)):
+            shape = (f"{len(seq_of_parameters)} x {Profiler.parameter_shape(seq_of_parameters[0])}"
+                     if seq_of_parameters else "0 rows")
+        else:
+            shape = f"many from {type(seq_of_parameters).__name__}"
+        self._sql, self._shape, self._elapsed, self._reported = sql, shape, 0.0, False
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        if self._reported:
+            return super().fetchone()
+        return self._timed(super().fetchone)
+
+    def fetchall(self):
+        if self._reported:
+            return super().fetchall()
+        return self._timed(super().fetchall)
+
+class ProfilingConnection(sqlite3.Connection):
+    """Connection whose cursors, including the ones execute() opens, are ProfilingCursors."""
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        if not Profiler.enabled:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not Profiler.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def instrument_callback(name: str, callback: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """Wrap an update handler callback with a latency histogram and error counter."""
+    @wraps(callback)
+    async def timed(update: object, context: ContextTypes.DEFAULT_TYPE):
+        sampled = Profiler.enabled and random.random() < Profiler.sample_rate
+        if sampled:
+            Profiler.start_sample()
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            Metrics.inc('bot_handler_errors_total', 'handler', name)
+            raise
+        finally:
+            Metrics.observe('bot_handler_seconds', 'handler', name, time.perf_counter() - started)
+            if sampled:
+                Profiler.stop_sample()
+    return timed
+
+def instrument_methods(cls, metric: str, exclude: Tuple[str, ...] = ()):
+    """Time every public classmethod of `cls` into the `metric` histogram."""
+    for name, attr in list(vars(cls).items()):
+        if name.startswith('_') or name in exclude or not isinstance(attr, classmethod):
+            continue
         
-        cursor.execute('''
+        def timed(func, name=name):
+            @wraps(func)
+            def call(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    Metrics.observe(metric, 'method', name, time.perf_counter() - started)
+            return call
+        setattr(cls, name, classmethod(timed(attr.__func__)))
+
+def index_name(statement: str) -> str:
+    """Name of the index a CREATE INDEX IF NOT EXISTS statement creates."""
+    return statement.split('EXISTS', 1)[1].split()[0]
+
+def add_broadcast_segment_column(conn: sqlite3.Connection):
+    """ALTER TABLE has no IF NOT EXISTS for columns."""
+    if 'segment' not in {row[1] for row in conn.execute('PRAGMA table_info(broadcast_jobs)')}:
+        conn.execute('ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT')
+
+# Schema history, oldest first, applied by DatabaseManager.migrate(). PRAGMA
+# user_version counts the steps a database has had, so startup only runs the
+# new ones. Databases from before versioning start at 0 with part of this
+# schema in place, so every step must be safe to re-run. A step is a list of
+# 'sql' statements or an 'apply' function taking the connection; steps
+# marked 'background' only create indexes on that table.
+MIGRATIONS: List[Dict] = [
+    # Tables of the original schema, and the default texts
+    {
+        'name': "core tables",
+        'sql': [
+            '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -79,9 +782,8 @@ class DatabaseManager:
                 is_banned INTEGER DEFAULT 0,
                 is_limited INTEGER DEFAULT 0
             )
-        ''')
-        
-        cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS commands (
                 command_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -89,25 +791,22 @@ class DatabaseManager:
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(user_id) REFERENCES users(user_id)
             )
-        ''')
-        
-        cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS bot_settings (
                 setting_name TEXT PRIMARY KEY,
                 setting_value TEXT
             )
-        ''')
-        
-        cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS rate_limits (
                 user_id INTEGER,
                 command TEXT,
                 last_used TIMESTAMP,
                 PRIMARY KEY (user_id, command)
             )
-        ''')
-        
-        cursor.execute('''
+            ''',
+            '''
             CREATE TABLE IF NOT EXISTS feedback (
                 feedback_id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -115,36 +814,452 @@ class DatabaseManager:
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(user_id) REFERENCES users(user_id)
             )
-        ''')
-        
-        # Insert default settings if not exists
-        cursor.execute('''
+            ''',
+            '''
             INSERT OR IGNORE INTO bot_settings (setting_name, setting_value)
             VALUES ('terms_and_conditions', 'Default Terms and Conditions. Please update through admin panel.'),
                    ('privacy_policy', 'Default Privacy Policy. Please update through admin panel.'),
                    ('welcome_message', 'Welcome to the bot! Use /start to begin.'),
                    ('feedback_message', 'Thank you for your feedback! We appreciate your input.')
-        ''')
+            '''
+        ]
+    },
+    # Secondary indexes for the time-ordered feedback and flagged-user
+    # lookups; benchmark.py queryplan fails if a hot query stops using them
+    {
+        'name': "hot query indexes",
+        'sql': [
+            'CREATE INDEX IF NOT EXISTS idx_feedback_timestamp ON feedback(timestamp)',
+            'CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned) WHERE is_banned = 1',
+            'CREATE INDEX IF NOT EXISTS idx_users_limited ON users(is_limited) WHERE is_limited = 1'
+        ]
+    },
+    # Per-user and time-ordered command lookups; a commands table upgraded
+    # from the original schema can be huge, so these may build in the background
+    {
+        'name': "command indexes",
+        'background': 'commands',
+        'sql': [
+            'CREATE INDEX IF NOT EXISTS idx_commands_user_command ON commands(user_id, command)',
+            'CREATE INDEX IF NOT EXISTS idx_commands_timestamp ON commands(timestamp)'
+        ]
+    },
+    {
+        'name': "broadcast jobs",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                message TEXT,
+                status TEXT DEFAULT 'running',
+                cursor_user_id INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                progress_message_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                segment TEXT
+            )
+            '''
+        ]
+    },
+    # Version stamps that tell other processes an in-memory cache is stale
+    {
+        'name': "cache versions",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS cache_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+            '''
+            INSERT OR IGNORE INTO cache_versions (name, version)
+            VALUES ('settings', 0), ('moderation', 0)
+            '''
+        ]
+    },
+    # Counters behind get_global_stats, kept current by the triggers;
+    # command_rollups holds hourly counts for raw rows past
+    # COMMAND_RAW_RETENTION_DAYS
+    {
+        'name': "stats counters and rollups",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS command_rollups (
+                user_id INTEGER,
+                command TEXT,
+                hour TEXT,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, command, hour)
+            ) WITHOUT ROWID
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS daily_active_users (
+                day TEXT,
+                user_id INTEGER,
+                PRIMARY KEY (day, user_id)
+            ) WITHOUT ROWID
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users
+            BEGIN
+                UPDATE stats_counters SET value = value + CASE name
+                    WHEN 'total_users' THEN 1
+                    WHEN 'banned_users' THEN NEW.is_banned
+                    ELSE NEW.is_limited END
+                WHERE name IN ('total_users', 'banned_users', 'limited_users');
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users
+            BEGIN
+                UPDATE stats_counters SET value = value - CASE name
+                    WHEN 'total_users' THEN 1
+                    WHEN 'banned_users' THEN OLD.is_banned
+                    ELSE OLD.is_limited END
+                WHERE name IN ('total_users', 'banned_users', 'limited_users');
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS users_stats_update AFTER UPDATE OF is_banned, is_limited ON users
+            WHEN NEW.is_banned != OLD.is_banned OR NEW.is_limited != OLD.is_limited
+            BEGIN
+                UPDATE stats_counters SET value = value + CASE name
+                    WHEN 'banned_users' THEN NEW.is_banned - OLD.is_banned
+                    ELSE NEW.is_limited - OLD.is_limited END
+                WHERE name IN ('banned_users', 'limited_users');
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS commands_stats_insert AFTER INSERT ON commands
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'total_commands';
+                INSERT OR IGNORE INTO daily_active_users (day, user_id)
+                VALUES (DATE(NEW.timestamp), NEW.user_id);
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS daily_active_stats_insert AFTER INSERT ON daily_active_users
+            BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('active:' || NEW.day, 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS feedback_stats_insert AFTER INSERT ON feedback
+            BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'feedback_count';
+            END
+            ''',
+            '''
+            CREATE TRIGGER IF NOT EXISTS feedback_stats_delete AFTER DELETE ON feedback
+            BEGIN
+                UPDATE stats_counters SET value = value - 1 WHERE name = 'feedback_count';
+            END
+            '''
+        ]
+    },
+    # Databases created before segments have no segment column (NULL = everyone)
+    {
+        'name': "broadcast segments",
+        'apply': add_broadcast_segment_column
+    },
+    # Segment indexes: language and premium keep rowid order, so a segment's
+    # recipients stream by user_id without sorting; the covering one answers
+    # the segment summary without touching the table
+    {
+        'name': "segment indexes",
+        'background': 'users',
+        'sql': [
+            'CREATE INDEX IF NOT EXISTS idx_users_language ON users(language_code)',
+            'CREATE INDEX IF NOT EXISTS idx_users_premium ON users(is_premium) WHERE is_premium = 1',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_users_segment
+            ON users(language_code, is_premium, is_banned, last_seen)
+            '''
+        ]
+    },
+    # Chats a broadcast failed to reach for good (blocked, deactivated, not
+    # found), which broadcasts skip; deliverable chats have no row
+    {
+        'name': "delivery status",
+        'sql': [
+            '''
+            CREATE TABLE IF NOT EXISTS delivery_status (
+                user_id INTEGER PRIMARY KEY,
+                status INTEGER NOT NULL DEFAULT 0,
+                last_failure TIMESTAMP
+            )
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS idx_delivery_dead
+            ON delivery_status(status) WHERE status != 0
+            '''
+        ]
+    }
+]
+
+class DatabaseManager:
+    """Handles all database operations with one connection per thread"""
+    
+    _local = threading.local()
+    _connections: List[sqlite3.Connection] = []
+    _connections_lock = threading.Lock()
+    
+    # Write-behind buffers, guarded by _write_lock
+    _write_lock = threading.RLock()
+    _pending_users: Dict[int, Dict] = {}
+    _pending_commands: List[Tuple[int, str, str]] = []
+    _pending_revivals: Set[int] = set()
+    _pending_since: Optional[float] = None
+    _flush_failing = False
+    _dropped_commands = 0
+    # Command timestamps have one-second resolution, so format each second once
+    _command_second = 0
+    _command_timestamp = ''
+    
+    # In-memory copy of bot_settings and the cache_versions stamp it matches
+    _settings_lock = threading.Lock()
+    _settings: Optional[Dict[str, str]] = None
+    _settings_version = 0
+    
+    # Indexes present in the database, and the background builds still to run
+    _indexes: Set[str] = set()
+    _deferred_indexes: List[str] = []
+    _index_builder: Optional[sqlite3.Connection] = None
+    
+    # User counts behind the broadcast segment picker
+    _segment_lock = threading.Lock()
+    _segment_summary: Optional[Dict] = None
+    
+    # IDs of banned and limited users; replaced wholesale on reload
+    _banned_ids: Set[int] = set()
+    _limited_ids: Set[int] = set()
+    _moderation_version = 0
+    
+    @classmethod
+    def get_connection(cls):
+        conn = getattr(cls._local, 'connection', None)
+        if conn is None:
+            profile = STORAGE_PROFILES[STORAGE_PROFILE]
+            # Each connection is only ever used by the thread that opened it;
+            # the flag just lets close_connection() run from the main thread.
+            conn = sqlite3.connect(
+                DATABASE_FILE,
+                check_same_thread=False,
+                timeout=profile['busy_timeout'] / 1000,
+                cached_statements=profile['cached_statements'],
+                factory=ProfilingConnection
+            )
+            conn.row_factory = sqlite3.Row
+            cls._apply_storage_profile(conn, profile)
+            cls._local.connection = conn
+            with cls._connections_lock:
+                cls._connections.append(conn)
+        return conn
+    
+    @classmethod
+    def _apply_storage_profile(cls, conn: sqlite3.Connection, profile: Dict):
+        # WAL lets the reader threads keep querying while the writer commits
+        conn.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+        conn.execute(f"PRAGMA synchronous={profile['synchronous']}")
+        conn.execute(f"PRAGMA mmap_size={int(profile['mmap_size'])}")
+        conn.execute(f"PRAGMA cache_size={int(profile['cache_size'])}")
+        conn.execute(f"PRAGMA temp_store={profile['temp_store']}")
+        conn.execute(f"PRAGMA busy_timeout={int(profile['busy_timeout'])}")
+    
+    @classmethod
+    def close_connection(cls):
+        with cls._connections_lock:
+            for conn in cls._connections:
+                conn.close()
+            cls._connections.clear()
+        cls._local = threading.local()
+    
+    @classmethod
+    def init_db(cls):
+        """Bring the schema up to date and load the in-memory caches."""
+        cls.migrate()
+        conn = cls.get_connection()
         
-        conn.commit()
+        # First run with the counters table: seed it from the existing data
+        if conn.execute('SELECT COUNT(*) FROM stats_counters').fetchone()[0] == 0:
+            cls.reconcile_stats()
+        
+        cls.load_settings()
+        cls.load_moderation_state()
     
     @classmethod
-    def get_setting(cls, setting_name: str) -> str:
+    def migrate(cls) -> int:
+        """Apply the pending MIGRATIONS, each in its own transaction; returns the schema version.
+        
+        Background steps on a table of MIGRATION_BACKGROUND_ROWS rows or more
+        are only recorded; build_deferred_indexes() creates them later, and
+        any still missing after a restart are queued again.
+        """
+        conn = cls.get_connection()
+        while True:
+            # Under the write lock, so processes starting together migrate once
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.rollback()
+                    break
+                step = MIGRATIONS[version]
+                started = time.perf_counter()
+                if 'apply' in step:
+                    step['apply'](conn)
+                elif not cls._is_large(conn, step.get('background')):
+                    for statement in step['sql']:
+                        conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            logger.info(f"Schema migration {version + 1} ({step['name']}) applied "
+                        f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+        
+        cls._indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        cls._deferred_indexes = [
+            statement for step in MIGRATIONS if step.get('background') for statement in step['sql']
+            if index_name(statement) not in cls._indexes
+        ]
+        if cls._deferred_indexes:
+            logger.info(f"{len(cls._deferred_indexes)} indexes will be built in the background")
+        return version
+    
+    @classmethod
+    def _is_large(cls, conn: sqlite3.Connection, table: Optional[str]) -> bool:
+        if table is None:
+            return False
+        # Counts at most MIGRATION_BACKGROUND_ROWS rows, however big the table
+        return conn.execute(
+            f'SELECT COUNT(*) FROM (SELECT 1 FROM {table} LIMIT {MIGRATION_BACKGROUND_ROWS})'
+        ).fetchone()[0] >= MIGRATION_BACKGROUND_ROWS
+    
+    @classmethod
+    def build_deferred_indexes(cls):
+        """Create the indexes migrate() deferred, one statement (and write lock) at a time.
+        
+        Meant for its own thread. Queries work without these indexes, only
+        slower; buffered writes stay in memory while an index builds, see
+        _lock_wait().
+        interrupt_index_builds() aborts at shutdown; the next start resumes.
+        """
+        conn = cls.get_connection()
+        cls._index_builder = conn
+        try:
+            while cls._deferred_indexes:
+                statement = cls._deferred_indexes[0]
+                name = index_name(statement)
+                started = time.perf_counter()
+                try:
+                    conn.execute(statement)
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"Building index {name} stopped ({e}); it resumes on the next start")
+                    return
+                cls._deferred_indexes.pop(0)
+                cls._indexes = cls._indexes | {name}
+                logger.info(f"Built index {name} in {time.perf_counter() - started:.1f}s")
+        finally:
+            cls._index_builder = None
+    
+    @classmethod
+    def interrupt_index_builds(cls):
+        conn = cls._index_builder
+        if conn is not None:
+            conn.interrupt()
+    
+    @classmethod
+    def _lock_wait(cls, conn: sqlite3.Connection):
+        """Set how long `conn` waits for the write lock: briefly while an index builds."""
+        if cls._index_builder is not None:
+            wait = INDEX_BUILD_LOCK_WAIT
+        else:
+            wait = STORAGE_PROFILES[STORAGE_PROFILE]['busy_timeout'] / 1000
+        conn.execute(f'PRAGMA busy_timeout={int(wait * 1000)}')
+    
+    @classmethod
+    def has_index(cls, name: str) -> bool:
+        return name in cls._indexes
+    
+    @classmethod
+    def _bump_cache_version(cls, name: str) -> int:
+        """Mark an in-memory cache as changed for every process; returns the new stamp."""
+        conn = cls.get_connection()
+        with conn:
+            conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (name,))
+            return conn.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()['version']
+    
+    @classmethod
+    def _get_cache_version(cls, name: str) -> int:
+        conn = cls.get_connection()
+        row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+        return row['version'] if row else 0
+    
+    @classmethod
+    def load_settings(cls):
+        """(Re)load every setting into memory along with its version stamp."""
         conn = cls.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT setting_value FROM bot_settings WHERE setting_name = ?', (setting_name,))
-        result = cursor.fetchone()
-        return result['setting_value'] if result else ""
+        # One statement, so the stamp is read from the same snapshot as the values
+        cursor.execute('''
+            SELECT setting_name, setting_value,
+                   (SELECT version FROM cache_versions WHERE name = 'settings') AS version
+            FROM bot_settings
+        ''')
+        rows = cursor.fetchall()
+        settings = {row['setting_name']: row['setting_value'] for row in rows}
+        with cls._settings_lock:
+            cls._settings = settings
+            cls._settings_version = rows[0]['version'] if rows else 0
+    
+    @classmethod
+    def refresh_settings(cls):
+        """Reload settings only if another process changed them."""
+        if cls._settings is None or cls._get_cache_version('settings') != cls._settings_version:
+            cls.load_settings()
+    
+    @classmethod
+    def get_setting(cls, setting_name: str) -> str:
+        # Served from memory; only the very first call touches SQLite
+        if cls._settings is None:
+            cls.load_settings()
+        return cls._settings.get(setting_name, "")
     
     @classmethod
     def update_setting(cls, setting_name: str, setting_value: str):
         conn = cls.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO bot_settings (setting_name, setting_value)
-            VALUES (?, ?)
-        ''', (setting_name, setting_value))
-        conn.commit()
+        with conn:
+            cursor.execute('''
+                INSERT OR REPLACE INTO bot_settings (setting_name, setting_value)
+                VALUES (?, ?)
+            ''', (setting_name, setting_value))
+            cursor.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'settings'")
+            version = cursor.execute("SELECT version FROM cache_versions WHERE name = 'settings'").fetchone()
+        
+        # Write-through: this process sees the new value immediately. If
+        # another process changed settings since our last load, reload all.
+        if cls._settings is None or version['version'] != cls._settings_version + 1:
+            cls.load_settings()
+            return
+        with cls._settings_lock:
+            settings = dict(cls._settings)
+            settings[setting_name] = setting_value
+            cls._settings = settings
+            cls._settings_version = version['version']
     
     @classmethod
     def get_user(cls, user_id: int) -> Optional[Dict]:
@@ -152,73 +1267,161 @@ class DatabaseManager:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         result = cursor.fetchone()
-        return dict(result) if result else None
+        user = dict(result) if result else None
+        
+        # Overlay a buffered upsert so callers read their own writes
+        with cls._write_lock:
+            pending = cls._pending_users.get(user_id)
+        if pending is None:
+            return user
+        if user is None:
+            return dict(pending, first_seen=pending['last_seen'])
+        user.update({k: v for k, v in pending.items() if k not in ('is_banned', 'is_limited')})
+        return user
     
     @classmethod
     def update_user(cls, user_data: Dict):
-        conn = cls.get_connection()
-        cursor = conn.cursor()
-        
         # Handle is_premium which might be None
         is_premium = 1 if user_data.get('is_premium') else 0
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (
-                user_id, username, first_name, last_name, language_code, 
-                is_premium, is_bot, last_seen, is_banned, is_limited
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            user_data['user_id'],
-            user_data.get('username'),
-            user_data.get('first_name'),
-            user_data.get('last_name'),
-            user_data.get('language_code'),
-            is_premium,
-            int(user_data.get('is_bot', False)),
-            datetime.now(),
-            int(user_data.get('is_banned', False)),
-            int(user_data.get('is_limited', False))
-        ))
-        conn.commit()
+        with cls._write_lock:
+            # Repeated upserts of the same user coalesce into the latest one
+            cls._pending_users[user_data['user_id']] = {
+                'user_id': user_data['user_id'],
+                'username': user_data.get('username'),
+                'first_name': user_data.get('first_name'),
+                'last_name': user_data.get('last_name'),
+                'language_code': user_data.get('language_code'),
+                'is_premium': is_premium,
+                'is_bot': int(user_data.get('is_bot', False)),
+                'last_seen': datetime.now().isoformat(' '),
+                'is_banned': int(user_data.get('is_banned', False)),
+                'is_limited': int(user_data.get('is_limited', False))
+            }
+            cls._schedule_flush()
     
     @classmethod
     def log_command(cls, user_id: int, command: str):
-        conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO commands (user_id, command)
-            VALUES (?, ?)
-        ''', (user_id, command))
-        conn.commit()
+        # Stamp now in the same UTC format CURRENT_TIMESTAMP would have used
+        second = int(time.time())
+        with cls._write_lock:
+            if second != cls._command_second:
+                cls._command_second = second
+                cls._command_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(second))
+            cls._pending_commands.append((user_id, command, cls._command_timestamp))
+            if len(cls._pending_commands) > WRITE_BUFFER_MAX_COMMANDS:
+                # Only while flushes fail; drop a batch at a time, oldest first
+                del cls._pending_commands[:WRITE_BATCH_SIZE]
+                cls._dropped_commands += WRITE_BATCH_SIZE
+            cls._schedule_flush()
+    
+    @classmethod
+    def revive_delivery(cls, user_id: int):
+        """Make an undeliverable chat a broadcast recipient again, e.g. after /start."""
+        with cls._write_lock:
+            cls._pending_revivals.add(user_id)
+            cls._schedule_flush()
+    
+    @classmethod
+    def _schedule_flush(cls):
+        """Flush the write-behind buffers once a size or age bound is hit."""
+        now = time.monotonic()
+        if cls._pending_since is None:
+            cls._pending_since = now
+        if cls._index_builder is not None or cls._flush_failing:
+            # The build holds the write lock, or the last flush failed;
+            # leave it to the periodic flush
+            return
+        pending = len(cls._pending_users) + len(cls._pending_commands)
+        if pending >= WRITE_BATCH_SIZE or now - cls._pending_since >= WRITE_MAX_DELAY:
+            cls.flush_writes()
+    
+    @classmethod
+    def flush_writes(cls):
+        """Commit every buffered write in a single transaction."""
+        with cls._write_lock:
+            if cls._pending_since is None:
+                return
+            # In primary key order, so the upserts walk the users B-tree once
+            users = [cls._pending_users[user_id] for user_id in sorted(cls._pending_users)]
+            commands = cls._pending_commands
+            revivals = [(user_id,) for user_id in cls._pending_revivals]
+            
+            conn = cls.get_connection()
+            try:
+                cls._lock_wait(conn)
+                with conn:
+                    # Upsert rather than REPLACE so first_seen and the
+                    # ban/limit flags of existing users are preserved
+                    conn.executemany('''
+                        INSERT INTO users (
+                            user_id, username, first_name, last_name, language_code,
+                            is_premium, is_bot, last_seen, is_banned, is_limited
+                        )
+                        VALUES (:user_id, :username, :first_name, :last_name, :language_code,
+                                :is_premium, :is_bot, :last_seen, :is_banned, :is_limited)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                            username = excluded.username,
+                            first_name = excluded.first_name,
+                            last_name = excluded.last_name,
+                            language_code = excluded.language_code,
+                            is_premium = excluded.is_premium,
+                            is_bot = excluded.is_bot,
+                            last_seen = excluded.last_seen
+                    ''', users)
+                    conn.executemany('DELETE FROM delivery_status WHERE user_id = ?', revivals)
+                    conn.executemany('''
+                        INSERT INTO commands (user_id, command, timestamp)
+                        VALUES (?, ?, ?)
+                    ''', commands)
+            except sqlite3.Error as e:
+                # Keep the buffers for the periodic flush to retry
+                cls._flush_failing = True
+                logger.error(f"Error flushing {len(users) + len(commands)} buffered writes: {e}")
+                return
+            
+            if cls._dropped_commands:
+                logger.warning(f"Dropped {cls._dropped_commands} command logs while flushes were failing")
+            cls._pending_users = {}
+            cls._pending_commands = []
+            cls._pending_revivals = set()
+            cls._pending_since = None
+            cls._flush_failing = False
+            cls._dropped_commands = 0
     
     @classmethod
     def get_user_stats(cls, user_id: int) -> Dict:
         conn = cls.get_connection()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            return {}
-        
+        # Recent raw rows (idx_commands_user_command) plus the rolled-up
+        # history (command_rollups primary key); a user without commands
+        # still yields a single row with a NULL command
         cursor.execute('''
-            SELECT command, COUNT(*) as count 
-            FROM commands 
-            WHERE user_id = ?
-            GROUP BY command
+            SELECT u.first_seen, u.last_seen, c.command, SUM(c.count) as count
+            FROM users u
+            LEFT JOIN (
+                SELECT command, COUNT(*) AS count FROM commands
+                WHERE user_id = :user_id GROUP BY command
+                UNION ALL
+                SELECT command, count FROM command_rollups
+                WHERE user_id = :user_id
+            ) c ON 1
+            WHERE u.user_id = :user_id
+            GROUP BY c.command
             ORDER BY count DESC
-        ''', (user_id,))
-        commands = {row['command']: row['count'] for row in cursor.fetchall()}
+        ''', {'user_id': user_id})
+        rows = cursor.fetchall()
+        
+        if not rows:
+            return {}
         
-        cursor.execute('SELECT COUNT(*) FROM commands WHERE user_id = ?', (user_id,))
-        total_commands = cursor.fetchone()[0]
+        commands = {row['command']: row['count'] for row in rows if row['command'] is not None}
         
         return {
-            'first_seen': user['first_seen'],
-            'last_seen': user['last_seen'],
-            'total_commands': total_commands,
+            'first_seen': rows[0]['first_seen'],
+            'last_seen': rows[0]['last_seen'],
+            'total_commands': sum(commands.values()),
             'commands': commands
         }
     
@@ -227,21 +1430,95 @@ class DatabaseManager:
         conn = cls.get_connection()
         cursor = conn.cursor()
         
+        cursor.execute('''
+            SELECT name, value FROM stats_counters
+            WHERE name IN ('total_users', 'total_commands', 'banned_users',
+                           'limited_users', 'feedback_count', 'active:' || DATE('now'))
+        ''')
+        counters = {row['name']: row['value'] for row in cursor.fetchall()}
+        
         stats = {
-            'total_users': cursor.execute('SELECT COUNT(*) FROM users').fetchone()[0],
-            'active_today': cursor.execute('''
-                SELECT COUNT(DISTINCT user_id) 
-                FROM commands 
-                WHERE DATE(timestamp) = DATE('now')
-            ''').fetchone()[0],
-            'total_commands': cursor.execute('SELECT COUNT(*) FROM commands').fetchone()[0],
-            'banned_users': cursor.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1').fetchone()[0],
-            'limited_users': cursor.execute('SELECT COUNT(*) FROM users WHERE is_limited = 1').fetchone()[0],
-            'feedback_count': cursor.execute('SELECT COUNT(*) FROM feedback').fetchone()[0]
+            'total_users': counters.get('total_users', 0),
+            'active_today': next((v for k, v in counters.items() if k.startswith('active:')), 0),
+            'total_commands': counters.get('total_commands', 0),
+            'banned_users': counters.get('banned_users', 0),
+            'limited_users': counters.get('limited_users', 0),
+            'feedback_count': counters.get('feedback_count', 0)
         }
         
         return stats
     
+    @classmethod
+    def reconcile_stats(cls):
+        """Recompute the stats counters from the base tables.
+        
+        The triggers keep the counters exact; this corrects drift from rows
+        changed outside the bot and prunes per-day data older than yesterday.
+        """
+        conn = cls.get_connection()
+        with conn:
+            conn.execute('''
+                DELETE FROM daily_active_users WHERE day < DATE('now', '-1 day')
+            ''')
+            conn.execute('''
+                DELETE FROM stats_counters
+                WHERE name LIKE 'active:%' AND name < 'active:' || DATE('now', '-1 day')
+            ''')
+            conn.execute('''
+                INSERT OR IGNORE INTO daily_active_users (day, user_id)
+                SELECT DISTINCT DATE(timestamp), user_id FROM commands
+                WHERE timestamp >= DATE('now', '-1 day')
+            ''')
+            conn.execute('''
+                INSERT OR REPLACE INTO stats_counters (name, value)
+                SELECT 'total_users', COUNT(*) FROM users
+                UNION ALL SELECT 'banned_users', COUNT(*) FROM users WHERE is_banned = 1
+                UNION ALL SELECT 'limited_users', COUNT(*) FROM users WHERE is_limited = 1
+                UNION ALL SELECT 'total_commands',
+                    (SELECT COUNT(*) FROM commands)
+                    + (SELECT IFNULL(SUM(count), 0) FROM command_rollups)
+                UNION ALL SELECT 'feedback_count', COUNT(*) FROM feedback
+                UNION ALL SELECT 'active:' || day, COUNT(*) FROM daily_active_users GROUP BY day
+            ''')
+    
+    @classmethod
+    def rollup_commands(cls, limit: int = COMMAND_ROLLUP_BATCH) -> int:
+        """Fold the oldest raw command rows past the retention window into
+        command_rollups and delete them; returns how many rows were folded.
+        
+        Each call is one short transaction of roughly `limit` rows, so callers
+        loop until it returns less than `limit`.
+        """
+        if not cls.has_index('idx_commands_timestamp'):
+            # Each batch would scan and sort the whole table; wait for the
+            # background migration to build the index
+            return 0
+        cls.flush_writes()
+        conn = cls.get_connection()
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=COMMAND_RAW_RETENTION_DAYS)).strftime('%Y-%m-%d %H:00:00')
+        
+        # Bound the batch by the timestamp of its last row; ties are folded
+        # too, so every call makes progress
+        row = conn.execute('''
+            SELECT timestamp FROM commands WHERE timestamp < ?
+            ORDER BY timestamp LIMIT 1 OFFSET ?
+        ''', (cutoff, limit - 1)).fetchone()
+        condition, bound = ('timestamp <= ?', row['timestamp']) if row else ('timestamp < ?', cutoff)
+        
+        # Without the hint the planner walks all of idx_commands_user_command
+        # to skip sorting the GROUP BY
+        with conn:
+            conn.execute(f'''
+                INSERT INTO command_rollups (user_id, command, hour, count)
+                SELECT user_id, command, strftime('%Y-%m-%d %H:00:00', timestamp), COUNT(*)
+                FROM commands INDEXED BY idx_commands_timestamp WHERE {condition}
+                GROUP BY 1, 2, 3
+                ON CONFLICT(user_id, command, hour) DO UPDATE SET count = count + excluded.count
+            ''', (bound,))
+            # No delete trigger on commands: total_commands keeps counting them
+            folded = conn.execute(f'DELETE FROM commands WHERE {condition}', (bound,)).rowcount
+        return folded
+    
     @classmethod
     def get_all_users(cls) -> List[Dict]:
         conn = cls.get_connection()
@@ -250,61 +1527,59 @@ class DatabaseManager:
         return [dict(row) for row in cursor.fetchall()]
     
     @classmethod
-    def update_rate_limit(cls, user_id: int, command: str):
+    def save_rate_limits(cls, entries: List[Tuple[int, str, datetime]]):
+        """Replace the persisted cooldowns of this shard with a RateLimiter snapshot."""
         conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO rate_limits (user_id, command, last_used)
-            VALUES (?, ?, ?)
-        ''', (user_id, command, datetime.now()))
-        conn.commit()
+        with conn:
+            # Workers only ever see their own users, so each replaces its slice
+            conn.execute('DELETE FROM rate_limits WHERE user_id % ? = ?', (SHARD_COUNT, SHARD_INDEX))
+            conn.executemany('''
+                INSERT INTO rate_limits (user_id, command, last_used)
+                VALUES (?, ?, ?)
+            ''', entries)
     
     @classmethod
-    def check_rate_limit(cls, user_id: int, command: str) -> Optional[timedelta]:
-        if command not in RATE_LIMITS:
-            return None
-            
+    def load_rate_limits(cls) -> List[Dict]:
         conn = cls.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT last_used 
-            FROM rate_limits 
-            WHERE user_id = ? AND command = ?
-        ''', (user_id, command))
-        
-        result = cursor.fetchone()
-        if not result:
-            return None
-            
-        last_time = datetime.strptime(result['last_used'], '%Y-%m-%d %H:%M:%S.%f')
-        time_passed = datetime.now() - last_time
-        limit_duration = RATE_LIMITS[command]
-        
-        return limit_duration - time_passed if time_passed < limit_duration else None
+            SELECT user_id, command, last_used FROM rate_limits
+            WHERE user_id % ? = ?
+        ''', (SHARD_COUNT, SHARD_INDEX))
+        return [dict(row) for row in cursor.fetchall()]
     
     @classmethod
     def ban_user(cls, user_id: int) -> bool:
         if user_id in ADMIN_IDS:
             return False
         
+        # Apply after any buffered upsert of the same user
+        cls.flush_writes()
         conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
+        cls._lock_wait(conn)
+        with conn:
+            affected = conn.execute('UPDATE users SET is_banned = 1 WHERE user_id = ?', (user_id,)).rowcount
         
         if affected == 0:
             cls.update_user({'user_id': user_id, 'is_banned': 1})
+            cls.flush_writes()
         
+        cls._banned_ids.add(user_id)
+        cls._moderation_changed()
         return True
     
     @classmethod
     def unban_user(cls, user_id: int) -> bool:
+        # Apply after any buffered upsert of the same user
+        cls.flush_writes()
         conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
+        cls._lock_wait(conn)
+        with conn:
+            affected = conn.execute('UPDATE users SET is_banned = 0 WHERE user_id = ?', (user_id,)).rowcount
+        
+        if user_id in cls._banned_ids:
+            cls._banned_ids.discard(user_id)
+            cls._moderation_changed()
         return affected > 0
     
     @classmethod
@@ -312,35 +1587,117 @@ class DatabaseManager:
         if user_id in ADMIN_IDS:
             return False
         
+        # Apply after any buffered upsert of the same user
+        cls.flush_writes()
         conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_limited = 1 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
+        cls._lock_wait(conn)
+        with conn:
+            affected = conn.execute('UPDATE users SET is_limited = 1 WHERE user_id = ?', (user_id,)).rowcount
         
         if affected == 0:
             cls.update_user({'user_id': user_id, 'is_limited': 1})
+            cls.flush_writes()
         
+        cls._limited_ids.add(user_id)
+        cls._moderation_changed()
         return True
     
     @classmethod
     def unlimit_user(cls, user_id: int) -> bool:
+        # Apply after any buffered upsert of the same user
+        cls.flush_writes()
         conn = cls.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET is_limited = 0 WHERE user_id = ?', (user_id,))
-        affected = cursor.rowcount
-        conn.commit()
+        cls._lock_wait(conn)
+        with conn:
+            affected = conn.execute('UPDATE users SET is_limited = 0 WHERE user_id = ?', (user_id,)).rowcount
+        
+        if user_id in cls._limited_ids:
+            cls._limited_ids.discard(user_id)
+            cls._moderation_changed()
         return affected > 0
     
+    @classmethod
+    def bulk_moderate(cls, action: str, user_ids: List[int]) -> Dict[str, List[int]]:
+        """Apply a BULK_MODERATION_ACTIONS action to many users in one transaction.
+        
+        Returns the IDs per outcome: 'changed', 'unchanged' (already in that
+        state), 'created' (unknown IDs banned or limited ahead of their first
+        visit), 'unknown' (unknown IDs to unban or unlimit) and 'admin'
+        (admins are never banned or limited).
+        """
+        column, value = BULK_MODERATION_ACTIONS[action]
+        outcomes = {'changed': [], 'unchanged': [], 'created': [], 'unknown': [], 'admin': []}
+        user_ids = list(dict.fromkeys(user_ids))
+        if value:
+            outcomes['admin'] = [user_id for user_id in user_ids if user_id in ADMIN_IDS]
+            user_ids = [user_id for user_id in user_ids if user_id not in ADMIN_IDS]
+        
+        # Apply after any buffered upserts of the same users
+        cls.flush_writes()
+        conn = cls.get_connection()
+        cls._lock_wait(conn)
+        with conn:
+            current = dict(conn.execute(f'''
+                SELECT user_id, {column} FROM users
+                WHERE user_id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(user_ids),)))
+            for user_id in user_ids:
+                if user_id not in current:
+                    outcomes['created' if value else 'unknown'].append(user_id)
+                else:
+                    outcomes['unchanged' if current[user_id] == value else 'changed'].append(user_id)
+            if value:
+                conn.executemany(f'''
+                    INSERT INTO users (user_id, {column}) VALUES (?, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET {column} = 1
+                ''', [(user_id,) for user_id in outcomes['changed'] + outcomes['created']])
+            else:
+                conn.executemany(f'UPDATE users SET {column} = 0 WHERE user_id = ?',
+                                 [(user_id,) for user_id in outcomes['changed']])
+        
+        # Swap in a new set so readers see either none or all of the change
+        attribute = '_banned_ids' if column == 'is_banned' else '_limited_ids'
+        ids = getattr(cls, attribute)
+        updated = ids | set(user_ids) if value else ids - set(user_ids)
+        if updated != ids:
+            setattr(cls, attribute, updated)
+            cls._moderation_changed()
+        return outcomes
+    
+    @classmethod
+    def _moderation_changed(cls):
+        version = cls._bump_cache_version('moderation')
+        if version == cls._moderation_version + 1:
+            cls._moderation_version = version
+        else:
+            # Another process changed moderation state too; resync
+            cls.load_moderation_state()
+    
+    @classmethod
+    def load_moderation_state(cls):
+        """Load the banned and limited ID sets through their partial indexes."""
+        # Read the stamp first: if it moves while loading, the next
+        # refresh sees a newer version and simply loads again
+        version = cls._get_cache_version('moderation')
+        conn = cls.get_connection()
+        banned = {row[0] for row in conn.execute('SELECT user_id FROM users WHERE is_banned = 1')}
+        limited = {row[0] for row in conn.execute('SELECT user_id FROM users WHERE is_limited = 1')}
+        cls._banned_ids, cls._limited_ids = banned, limited
+        cls._moderation_version = version
+    
+    @classmethod
+    def refresh_moderation_state(cls):
+        """Reload the ID sets only if another process changed them."""
+        if cls._get_cache_version('moderation') != cls._moderation_version:
+            cls.load_moderation_state()
+    
     @classmethod
     def is_banned(cls, user_id: int) -> bool:
-        user = cls.get_user(user_id)
-        return bool(user and user.get('is_banned', 0) == 1)
+        return user_id in cls._banned_ids
     
     @classmethod
     def is_limited(cls, user_id: int) -> bool:
-        user = cls.get_user(user_id)
-        return bool(user and user.get('is_limited', 0) == 1)
+        return user_id in cls._limited_ids
     
     @classmethod
     def add_feedback(cls, user_id: int, message: str) -> bool:
@@ -358,17 +1715,860 @@ class DatabaseManager:
             return False
     
     @classmethod
-    def get_feedback(cls, limit: int = 10) -> List[Dict]:
+    def get_feedback(cls, limit: int = 10, older_than: Optional[int] = None,
+                     newer_than: Optional[int] = None) -> List[Dict]:
+        """Up to `limit` feedback rows on either side of a keyset cursor.
+        
+        Rows are ordered by (timestamp, feedback_id), newest first, and the
+        cursor is the feedback_id of the last row shown: its key is looked up
+        by primary key, so every page is an index seek however much feedback
+        has piled up. With `newer_than` the rows come back oldest first,
+        i.e. still nearest to the cursor first.
+        """
         conn = cls.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
+        if newer_than is not None:
+            keyset, order, cursor_id = '>', 'ASC', newer_than
+        else:
+            keyset, order, cursor_id = '<', 'DESC', older_than
+        # idx_feedback_timestamp ends in the rowid, i.e. feedback_id
+        where = f'''
+            WHERE (f.timestamp, f.feedback_id) {keyset}
+                (SELECT timestamp, feedback_id FROM feedback WHERE feedback_id = :cursor_id)
+        ''' if cursor_id is not None else ''
+        cursor.execute(f'''
             SELECT f.*, u.username, u.first_name, u.last_name 
             FROM feedback f
             LEFT JOIN users u ON f.user_id = u.user_id
-            ORDER BY f.timestamp DESC
-            LIMIT ?
-        ''', (limit,))
+            {where}
+            ORDER BY f.timestamp {order}, f.feedback_id {order}
+            LIMIT :limit
+        ''', {'cursor_id': cursor_id, 'limit': limit})
         return [dict(row) for row in cursor.fetchall()]
+    
+    @classmethod
+    def count_users(cls) -> int:
+        return cls.get_global_stats()['total_users']
+    
+    @classmethod
+    def get_broadcast_recipients(cls, after_user_id: int, limit: int, segment: Optional[Dict] = None) -> List[int]:
+        """Next page of recipient IDs in `segment` (everyone if None), walking the users primary key."""
+        conn = cls.get_connection()
+        cursor = conn.cursor()
+        where, params = cls._segment_filter(segment)
+        cursor.execute(f'''
+            SELECT user_id FROM users
+            WHERE user_id > :after_user_id AND {where}
+            ORDER BY user_id
+            LIMIT :limit
+        ''', {**params, 'after_user_id': after_user_id, 'limit': limit})
+        return [row['user_id'] for row in cursor.fetchall()]
+    
+    @classmethod
+    def _segment_filter(cls, segment: Optional[Dict]) -> Tuple[str, Dict]:
+        """WHERE clause and parameters matching the deliverable users in `segment`.
+        
+        A segment is a dict of optional filters: 'language' (a language
+        code), 'premium' (bool), 'active_days' (seen within that many days)
+        and 'include_banned' (banned users are left out unless true). None
+        means every user, banned or not. Undeliverable chats never match.
+        """
+        segment = segment or {'include_banned': True}
+        # One primary-key probe of delivery_status per candidate row
+        clauses, params = ['NOT EXISTS (SELECT 1 FROM delivery_status d '
+                           'WHERE d.user_id = users.user_id AND d.status != 0)'], {}
+        if segment.get('language'):
+            clauses.append('language_code = :language')
+            params['language'] = segment['language']
+        if segment.get('premium') is not None:
+            clauses.append('is_premium = :premium')
+            params['premium'] = int(segment['premium'])
+        if segment.get('active_days'):
+            # last_seen is written in local time by update_user()
+            clauses.append('last_seen >= :active_since')
+            params['active_since'] = (datetime.now() - timedelta(days=segment['active_days'])).isoformat(' ')
+        if not segment.get('include_banned'):
+            clauses.append('is_banned = 0')
+        return ' AND '.join(clauses), params
+    
+    @classmethod
+    def count_segment(cls, segment: Optional[Dict]) -> int:
+        """Exact size of `segment`, for the total of a broadcast job."""
+        conn = cls.get_connection()
+        if segment is None:
+            # Everyone: the trigger-maintained user count less the dead set
+            undeliverable = conn.execute('SELECT COUNT(*) FROM delivery_status WHERE status != 0').fetchone()[0]
+            return cls.count_users() - undeliverable
+        where, params = cls._segment_filter(segment)
+        return conn.execute(f'SELECT COUNT(*) FROM users WHERE {where}', params).fetchone()[0]
+    
+    @classmethod
+    def refresh_segment_summary(cls) -> Dict:
+        """Recount deliverable users per (language, premium, banned) and activity window.
+        
+        One pass over idx_users_segment in index order, so no sorting; every
+        segment size is then a sum over a few dozen rows in memory. The
+        undeliverable chats are counted the same way and subtracted.
+        """
+        conn = cls.get_connection()
+        now = datetime.now()
+        active = ', '.join(f'SUM(last_seen >= :active_{days}) AS active_{days}' for days in SEGMENT_ACTIVE_DAYS)
+        params = {f'active_{days}': (now - timedelta(days=days)).isoformat(' ') for days in SEGMENT_ACTIVE_DAYS}
+        # Until a background migration has built it, scan the table instead
+        hint = 'INDEXED BY idx_users_segment' if cls.has_index('idx_users_segment') else ''
+        cursor = conn.execute(f'''
+            SELECT language_code, is_premium, is_banned, COUNT(*) AS total, {active}
+            FROM users {hint}
+            GROUP BY language_code, is_premium, is_banned
+        ''', params)
+        rows = {(row['language_code'], row['is_premium'], row['is_banned']): dict(row) for row in cursor.fetchall()}
+        cursor = conn.execute(f'''
+            SELECT language_code, is_premium, is_banned, COUNT(*) AS total, {active}
+            FROM delivery_status INDEXED BY idx_delivery_dead
+            JOIN users USING (user_id)
+            WHERE status != 0
+            GROUP BY language_code, is_premium, is_banned
+        ''', params)
+        undeliverable = 0
+        for dead in cursor.fetchall():
+            undeliverable += dead['total']
+            row = rows.get((dead['language_code'], dead['is_premium'], dead['is_banned']))
+            if row is None:
+                # The user changed language between the two queries
+                continue
+            for column in dead.keys()[3:]:
+                row[column] -= dead[column]
+        summary = {'computed_at': now, 'rows': list(rows.values()), 'undeliverable': undeliverable}
+        with cls._segment_lock:
+            cls._segment_summary = summary
+        return summary
+    
+    @classmethod
+    def get_segment_summary(cls) -> Dict:
+        """The latest segment summary, computed on first use."""
+        with cls._segment_lock:
+            summary = cls._segment_summary
+        return summary if summary is not None else cls.refresh_segment_summary()
+    
+    @classmethod
+    def create_broadcast_job(cls, admin_id: int, message: str, total: int,
+                             progress_message_id: Optional[int], segment: Optional[Dict] = None) -> Dict:
+        conn = cls.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, message, total, progress_message_id, segment)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (admin_id, message, total, progress_message_id, json.dumps(segment) if segment is not None else None))
+        conn.commit()
+        cursor.execute('SELECT * FROM broadcast_jobs WHERE job_id = ?', (cursor.lastrowid,))
+        return dict(cursor.fetchone())
+    
+    @classmethod
+    def update_broadcast_job(cls, job_id: int, cursor_user_id: int, sent: int, failed: int,
+                             status: str = 'running'):
+        conn = cls.get_connection()
+        conn.execute('''
+            UPDATE broadcast_jobs
+            SET cursor_user_id = ?, sent = ?, failed = ?, status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        ''', (cursor_user_id, sent, failed, status, job_id))
+        conn.commit()
+    
+    @classmethod
+    def get_unfinished_broadcast_jobs(cls) -> List[Dict]:
+        conn = cls.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")
+        return [dict(row) for row in cursor.fetchall()]
+    
+    @classmethod
+    def record_undeliverable(cls, undeliverable: List[Tuple[int, int]]):
+        """Store the dead chats of one broadcast chunk in a single transaction.
+        
+        `undeliverable` holds (user_id, DELIVERY_* status) pairs; failures
+        that may go away on their own (flood limits, network errors) are not
+        recorded at all, and neither are successful deliveries.
+        """
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        conn = cls.get_connection()
+        with conn:
+            conn.executemany('''
+                INSERT INTO delivery_status (user_id, status, last_failure) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, last_failure = excluded.last_failure
+            ''', [(user_id, status, now) for user_id, status in undeliverable])
+    
+    @classmethod
+    def get_delivery_status(cls, user_id: int) -> Optional[Dict]:
+        conn = cls.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM delivery_status WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        return dict(result) if result else None
+
+# Connection plumbing is excluded; everything else is a query or a cache hit
+# update_user and log_command only append to the write-behind buffers;
+# their SQLite time is flush_writes'
+instrument_methods(DatabaseManager, 'bot_db_seconds',
+                   exclude=('get_connection', 'close_connection', 'update_user', 'log_command'))
+
+class AsyncDatabaseManager:
+    """Awaitable DatabaseManager API that keeps SQLite I/O off the event loop.
+
+    Reads run on a small pool of reader threads, writes are serialized on a
+    single writer thread so commits never contend with each other.
+    """
+
+    _reader: Optional[ThreadPoolExecutor] = None
+    _writer: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def start(cls):
+        if cls._writer is None:
+            cls._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+            cls._reader = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix="db-reader")
+
+    @classmethod
+    def shutdown(cls):
+        if cls._writer is not None:
+            cls._writer.shutdown(wait=True)
+            cls._reader.shutdown(wait=True)
+            cls._writer = None
+            cls._reader = None
+
+    @classmethod
+    async def _read(cls, func, *args):
+        cls.start()
+        return await asyncio.get_running_loop().run_in_executor(cls._reader, func, *args)
+
+    @classmethod
+    async def _write(cls, func, *args):
+        cls.start()
+        return await asyncio.get_running_loop().run_in_executor(cls._writer, func, *args)
+
+    @classmethod
+    async def refresh_settings(cls):
+        return await cls._read(DatabaseManager.refresh_settings)
+
+    @classmethod
+    async def update_setting(cls, setting_name: str, setting_value: str):
+        return await cls._write(DatabaseManager.update_setting, setting_name, setting_value)
+
+    @classmethod
+    async def get_user(cls, user_id: int) -> Optional[Dict]:
+        return await cls._read(DatabaseManager.get_user, user_id)
+
+    @classmethod
+    async def update_user(cls, user_data: Dict):
+        return await cls._write(DatabaseManager.update_user, user_data)
+
+    @classmethod
+    async def log_command(cls, user_id: int, command: str):
+        return await cls._write(DatabaseManager.log_command, user_id, command)
+
+    @classmethod
+    async def flush_writes(cls):
+        return await cls._write(DatabaseManager.flush_writes)
+
+    @classmethod
+    async def get_user_stats(cls, user_id: int) -> Dict:
+        return await cls._read(DatabaseManager.get_user_stats, user_id)
+
+    @classmethod
+    async def get_global_stats(cls) -> Dict:
+        return await cls._read(DatabaseManager.get_global_stats)
+
+    @classmethod
+    async def rollup_commands(cls) -> int:
+        return await cls._write(DatabaseManager.rollup_commands)
+
+    @classmethod
+    async def reconcile_stats(cls):
+        return await cls._write(DatabaseManager.reconcile_stats)
+
+    @classmethod
+    async def get_all_users(cls) -> List[Dict]:
+        return await cls._read(DatabaseManager.get_all_users)
+
+    @classmethod
+    async def save_rate_limits(cls, entries: List[Tuple[int, str, datetime]]):
+        return await cls._write(DatabaseManager.save_rate_limits, entries)
+
+    @classmethod
+    async def load_rate_limits(cls) -> List[Dict]:
+        return await cls._read(DatabaseManager.load_rate_limits)
+
+    @classmethod
+    async def ban_user(cls, user_id: int) -> bool:
+        return await cls._write(DatabaseManager.ban_user, user_id)
+
+    @classmethod
+    async def unban_user(cls, user_id: int) -> bool:
+        return await cls._write(DatabaseManager.unban_user, user_id)
+
+    @classmethod
+    async def limit_user(cls, user_id: int) -> bool:
+        return await cls._write(DatabaseManager.limit_user, user_id)
+
+    @classmethod
+    async def unlimit_user(cls, user_id: int) -> bool:
+        return await cls._write(DatabaseManager.unlimit_user, user_id)
+
+    @classmethod
+    async def refresh_moderation_state(cls):
+        return await cls._read(DatabaseManager.refresh_moderation_state)
+
+    @classmethod
+    async def add_feedback(cls, user_id: int, message: str) -> bool:
+        return await cls._write(DatabaseManager.add_feedback, user_id, message)
+
+    @classmethod
+    async def get_feedback(cls, limit: int = 10, older_than: Optional[int] = None,
+                           newer_than: Optional[int] = None) -> List[Dict]:
+        return await cls._read(DatabaseManager.get_feedback, limit, older_than, newer_than)
+
+    @classmethod
+    async def count_users(cls) -> int:
+        return await cls._read(DatabaseManager.count_users)
+
+    @classmethod
+    async def get_broadcast_recipients(cls, after_user_id: int, limit: int,
+                                       segment: Optional[Dict] = None) -> List[int]:
+        return await cls._read(DatabaseManager.get_broadcast_recipients, after_user_id, limit, segment)
+
+    @classmethod
+    async def count_segment(cls, segment: Optional[Dict]) -> int:
+        return await cls._read(DatabaseManager.count_segment, segment)
+
+    @classmethod
+    async def refresh_segment_summary(cls) -> Dict:
+        return await cls._read(DatabaseManager.refresh_segment_summary)
+
+    @classmethod
+    async def get_segment_summary(cls) -> Dict:
+        return await cls._read(DatabaseManager.get_segment_summary)
+
+    @classmethod
+    async def create_broadcast_job(cls, admin_id: int, message: str, total: int,
+                                   progress_message_id: Optional[int], segment: Optional[Dict] = None) -> Dict:
+        return await cls._write(DatabaseManager.create_broadcast_job, admin_id, message, total, progress_message_id,
+                                segment)
+
+    @classmethod
+    async def update_broadcast_job(cls, job_id: int, cursor_user_id: int, sent: int, failed: int,
+                                   status: str = 'running'):
+        return await cls._write(DatabaseManager.update_broadcast_job, job_id, cursor_user_id, sent, failed, status)
+
+    @classmethod
+    async def get_unfinished_broadcast_jobs(cls) -> List[Dict]:
+        return await cls._read(DatabaseManager.get_unfinished_broadcast_jobs)
+
+    @classmethod
+    async def bulk_moderate(cls, action: str, user_ids: List[int]) -> Dict[str, List[int]]:
+        return await cls._write(DatabaseManager.bulk_moderate, action, user_ids)
+
+    @classmethod
+    async def revive_delivery(cls, user_id: int):
+        return await cls._write(DatabaseManager.revive_delivery, user_id)
+
+    @classmethod
+    async def record_undeliverable(cls, undeliverable: List[Tuple[int, int]]):
+        return await cls._write(DatabaseManager.record_undeliverable, undeliverable)
+
+    @classmethod
+    async def get_delivery_status(cls, user_id: int) -> Optional[Dict]:
+        return await cls._read(DatabaseManager.get_delivery_status, user_id)
+
+class RateLimiter:
+    """In-memory cooldowns for the commands in RATE_LIMITS.
+
+    Deadlines are kept on the monotonic clock in one OrderedDict per command,
+    ordered by last use. Each command has a single cooldown, so every map is
+    in deadline order too: expired entries collect at its front and are
+    dropped cheaply. Together the maps never grow past
+    RATE_LIMITER_MAX_ENTRIES.
+    """
+
+    # command -> {user_id: deadline}; a map is created on the command's first hit
+    _deadlines: "Dict[str, OrderedDict[int, float]]" = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def check(cls, user_id: int, command: str) -> Optional[timedelta]:
+        """Return the remaining cooldown, or None if the command may run."""
+        if command not in RATE_LIMITS:
+            return None
+
+        with cls._lock:
+            deadlines = cls._deadlines.get(command)
+            deadline = deadlines.get(user_id) if deadlines is not None else None
+            if deadline is None:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                del deadlines[user_id]
+                return None
+        return timedelta(seconds=remaining)
+
+    @classmethod
+    def hit(cls, user_id: int, command: str):
+        """Start the cooldown for a command the user just ran."""
+        if command not in RATE_LIMITS:
+            return
+
+        now = time.monotonic()
+        with cls._lock:
+            deadlines = cls._deadlines.setdefault(command, OrderedDict())
+            deadlines[user_id] = now + RATE_LIMITS[command].total_seconds()
+            deadlines.move_to_end(user_id)
+            cls._evict(now)
+
+    @classmethod
+    def _evict(cls, now: float):
+        # Soonest deadlines sit at the front of each map; drop them while
+        # they are expired, then the soonest overall while over the size bound.
+        for deadlines in cls._deadlines.values():
+            while deadlines and next(iter(deadlines.values())) <= now:
+                deadlines.popitem(last=False)
+        for _ in range(sum(map(len, cls._deadlines.values())) - RATE_LIMITER_MAX_ENTRIES):
+            soonest = min((deadlines for deadlines in cls._deadlines.values() if deadlines),
+                          key=lambda deadlines: next(iter(deadlines.values())))
+            soonest.popitem(last=False)
+
+    @classmethod
+    def snapshot(cls) -> List[Tuple[int, str, datetime]]:
+        """Live cooldowns as (user_id, command, last_used) wall-clock rows."""
+        now = time.monotonic()
+        wall_now = datetime.now()
+        with cls._lock:
+            items = [(user_id, command, deadline)
+                     for command, deadlines in cls._deadlines.items()
+                     for user_id, deadline in deadlines.items()]
+        return [
+            (user_id, command, wall_now - (RATE_LIMITS[command] - timedelta(seconds=deadline - now)))
+            for user_id, command, deadline in items
+            if deadline > now and command in RATE_LIMITS
+        ]
+
+    @classmethod
+    def restore(cls, rows: List[Dict]):
+        """Reload cooldowns persisted by a previous snapshot."""
+        now = time.monotonic()
+        wall_now = datetime.now()
+        restored = []
+        for row in rows:
+            if row['command'] not in RATE_LIMITS:
+                continue
+            try:
+                last_used = datetime.fromisoformat(str(row['last_used']))
+            except ValueError:
+                continue
+            remaining = RATE_LIMITS[row['command']] - (wall_now - last_used)
+            if remaining.total_seconds() > 0:
+                restored.append((last_used, row['user_id'], row['command'], now + remaining.total_seconds()))
+
+        with cls._lock:
+            for _, user_id, command, deadline in sorted(restored):
+                deadlines = cls._deadlines.setdefault(command, OrderedDict())
+                deadlines[user_id] = deadline
+                deadlines.move_to_end(user_id)
+            cls._evict(now)
+
+class TokenBucket:
+    """Async token bucket; acquire() waits until a token is available"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds`, e.g. after a RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class BroadcastEngine:
+    """Background broadcasts paced to Telegram's flood limits.
+
+    A job walks the users table in primary-key order. Each chunk is sent by
+    up to BROADCAST_SENDERS concurrent senders sharing one global token
+    bucket, then the job cursor and counters are persisted so unfinished jobs
+    are resumed by resume_jobs() after a restart. Chats that turn out to be
+    blocked, deactivated or missing are recorded in delivery_status and left
+    out of later jobs.
+    """
+
+    # Tasks and buckets (with their asyncio locks) of the event loop in _loop
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _tasks: Dict[int, asyncio.Task] = {}
+    _global_bucket: Optional[TokenBucket] = None
+    _chat_buckets: Dict[int, TokenBucket] = {}
+
+    @classmethod
+    def _bind_loop(cls):
+        """Start over with fresh state when running on a new event loop."""
+        loop = asyncio.get_running_loop()
+        if cls._loop is not loop:
+            cls._loop = loop
+            cls._tasks = {}
+            cls._global_bucket = TokenBucket(BROADCAST_GLOBAL_RATE, capacity=BROADCAST_GLOBAL_RATE)
+            cls._chat_buckets = {}
+
+    @classmethod
+    def _bucket(cls) -> TokenBucket:
+        cls._bind_loop()
+        return cls._global_bucket
+
+    @classmethod
+    async def _throttle(cls, chat_id: int):
+        """Wait for both the per-chat and the global send budget."""
+        global_bucket = cls._bucket()
+        bucket = cls._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = cls._chat_buckets[chat_id] = TokenBucket(BROADCAST_PER_CHAT_RATE)
+        await bucket.acquire()
+        await global_bucket.acquire()
+
+    @classmethod
+    async def start_job(cls, bot: Bot, admin_id: int, text: str, segment: Optional[Dict] = None) -> Dict:
+        """Start sending `text` to `segment` (see DatabaseManager._segment_filter), or to everyone."""
+        total = await AsyncDatabaseManager.count_segment(segment)
+        progress = await bot.send_message(
+            chat_id=admin_id, text=f"📢 Starting broadcast to {total} users ({describe_segment(segment)})..."
+        )
+        job = await AsyncDatabaseManager.create_broadcast_job(admin_id, text, total, progress.message_id, segment)
+        cls._launch(bot, job)
+        return job
+
+    @classmethod
+    async def resume_jobs(cls, bot: Bot):
+        cls._bind_loop()
+        for job in await AsyncDatabaseManager.get_unfinished_broadcast_jobs():
+            if job['job_id'] not in cls._tasks:
+                logger.info(f"Resuming broadcast #{job['job_id']} after user {job['cursor_user_id']}")
+                cls._launch(bot, job)
+
+    @classmethod
+    def stop_all(cls):
+        """Cancel running jobs; they stay 'running' in the DB and resume later."""
+        for task in list(cls._tasks.values()):
+            task.cancel()
+
+    @classmethod
+    def _launch(cls, bot: Bot, job: Dict):
+        cls._bind_loop()
+        task = asyncio.create_task(cls._run(bot, job))
+        cls._tasks[job['job_id']] = task
+        task.add_done_callback(lambda _: cls._tasks.pop(job['job_id'], None))
+
+    @classmethod
+    async def _run(cls, bot: Bot, job: Dict):
+        job_id = job['job_id']
+        cursor_user_id, sent, failed = job['cursor_user_id'], job['sent'], job['failed']
+        segment = json.loads(job['segment']) if job.get('segment') else None
+        semaphore = asyncio.Semaphore(BROADCAST_SENDERS)
+        started = time.monotonic()
+        last_progress = started
+        sent_at_start = sent + failed
+
+        async def send_one(chat_id: int) -> Optional[int]:
+            async with semaphore:
+                return await cls._send(bot, chat_id, job['message'])
+
+        try:
+            while recipients := await AsyncDatabaseManager.get_broadcast_recipients(cursor_user_id, BROADCAST_CHUNK_SIZE,
+                                                                                    segment):
+                results = await asyncio.gather(*(send_one(chat_id) for chat_id in recipients))
+                delivered = results.count(DELIVERY_OK)
+                undeliverable = [(chat_id, status) for chat_id, status in zip(recipients, results)
+                                 if status not in (DELIVERY_OK, None)]
+                if undeliverable:
+                    await AsyncDatabaseManager.record_undeliverable(undeliverable)
+                for _, status in undeliverable:
+                    Metrics.inc('bot_broadcast_undeliverable_total', 'status', DELIVERY_STATUS_NAMES[status])
+                sent += delivered
+                failed += len(results) - delivered
+                cursor_user_id = recipients[-1]
+                await AsyncDatabaseManager.update_broadcast_job(job_id, cursor_user_id, sent, failed)
+
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    rate = (sent + failed - sent_at_start) / (last_progress - started)
+                    await cls._report_progress(bot, job, sent, failed, rate)
+        except Exception as e:
+            logger.error(f"Broadcast #{job_id} stopped at user {cursor_user_id}: {e}")
+            raise
+
+        await AsyncDatabaseManager.update_broadcast_job(job_id, cursor_user_id, sent, failed, 'done')
+        logger.info(f"Broadcast #{job_id} finished: {sent} sent, {failed} failed")
+        await cls._throttle(job['admin_id'])
+        await bot.send_message(
+            chat_id=job['admin_id'],
+            text=(
+                f"📢 Broadcast completed!\n"
+                f"✅ Success: {sent}\n"
+                f"❌ Failed: {failed}"
+            )
+        )
+
+    @classmethod
+    async def _send(cls, bot: Bot, chat_id: int, text: str) -> Optional[int]:
+        """Send one message; DELIVERY_OK, the DELIVERY_* status of a dead chat, or None on other failures."""
+        # Every recipient gets one message per job, so only the global
+        # budget applies here; _throttle() covers repeated sends to a chat.
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await cls._bucket().acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return DELIVERY_OK
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                delay = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                logger.warning(f"Flood limit hit, pausing broadcast sends for {delay}s",
+                               extra={'aggregate': 'broadcast_flood'})
+                cls._bucket().pause(delay)
+            except Forbidden as e:
+                # "bot was blocked by the user", "user is deactivated", "bot was kicked..."
+                logger.info(f"Broadcast recipient {chat_id} is unreachable: {e}",
+                            extra={'aggregate': 'broadcast_unreachable'})
+                return DELIVERY_DEACTIVATED if "deactivated" in str(e).lower() else DELIVERY_BLOCKED
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    logger.info(f"Broadcast recipient {chat_id} is unreachable: {e}",
+                                extra={'aggregate': 'broadcast_unreachable'})
+                    return DELIVERY_CHAT_NOT_FOUND
+                logger.error(f"Failed to send broadcast to {chat_id}: {e}",
+                             extra={'aggregate': 'broadcast_send'})
+                return None
+            except NetworkError as e:
+                if attempt == BROADCAST_MAX_RETRIES:
+                    logger.error(f"Failed to send broadcast to {chat_id}: {e}",
+                                 extra={'aggregate': 'broadcast_send'})
+                    return None
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError as e:
+                logger.error(f"Failed to send broadcast to {chat_id}: {e}",
+                             extra={'aggregate': 'broadcast_send'})
+                return None
+        return None
+
+    @classmethod
+    async def _report_progress(cls, bot: Bot, job: Dict, sent: int, failed: int, rate: float):
+        done = sent + failed
+        percent = done * 100 // job['total'] if job['total'] else 100
+        text = (
+            f"📢 Broadcast #{job['job_id']} in progress\n\n"
+            f"📨 {done}/{job['total']} ({percent}%)\n"
+            f"✅ Success: {sent}\n"
+            f"❌ Failed: {failed}\n"
+            f"⚡ {rate:.1f} msg/s"
+        )
+        try:
+            await cls._throttle(job['admin_id'])
+            await bot.edit_message_text(chat_id=job['admin_id'], message_id=job['progress_message_id'], text=text)
+        except TelegramError as e:
+            logger.warning(f"Could not update broadcast #{job['job_id']} progress: {e}")
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Concurrent update processing that keeps each user's updates in order.
+    
+    The base class admits up to `max_pending` updates into do_process_update(),
+    including those waiting for their user's lock; at most `max_running` of
+    them run at once, each only after its user's lock is held, so waiting
+    updates never take a running slot.
+    """
+
+    __slots__ = ("_slots", "_user_locks")
+
+    def __init__(self, max_running: int, max_pending: int = MAX_PENDING_UPDATES):
+        super().__init__(max(max_running, max_pending))
+        self._slots = asyncio.Semaphore(max_running)
+        # user_id -> [lock, updates holding or waiting for it]
+        self._user_locks: Dict[int, list] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock is FIFO, so the user's updates run in arrival order
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+class InstrumentedRequest(BaseRequest):
+    """Bot API backend that times every request of the wrapped one per API method."""
+
+    def __init__(self, wrapped: BaseRequest):
+        self._wrapped = wrapped
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self._wrapped.read_timeout
+
+    async def initialize(self) -> None:
+        await self._wrapped.initialize()
+
+    async def shutdown(self) -> None:
+        await self._wrapped.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self._wrapped.do_request(url, method, request_data, **kwargs)
+        finally:
+            Metrics.observe('bot_api_seconds', 'method', endpoint, time.perf_counter() - started)
+        if status != 200:
+            Metrics.inc('bot_api_errors_total', 'method', endpoint)
+        return status, payload
+
+class CallbackRouter:
+    """Dispatch callback queries to handlers registered per callback_data.
+    
+    callback_data is "name" or "name:param"; the name selects the route with
+    one dict lookup and the param is passed to the handler. Each route is
+    wrapped in the middleware chain once, when it is registered, so
+    dispatch itself does no per-middleware bookkeeping.
+    """
+
+    def __init__(self, middlewares: List[Callable[..., Awaitable[None]]]):
+        # Outermost first; each is called as middleware(call_next, route, update, context, param)
+        self._middlewares = middlewares
+        self._routes: Dict[str, Callable[..., Awaitable[None]]] = {}
+        # Route options by name, for introspection
+        self.routes: Dict[str, Dict] = {}
+
+    def route(self, *names: str, admin_only: bool = False, rate_limit: Optional[str] = None, log: bool = True):
+        """Register handler(update, context, param) for the given callback names.
+        
+        admin_only and rate_limit (a RATE_LIMITS key) are enforced by the
+        middlewares; log=False skips command logging for noisy buttons.
+        """
+        def register(handler: Callable[..., Awaitable[None]]):
+            for name in names:
+                route = {'name': name, 'admin_only': admin_only, 'rate_limit': rate_limit, 'log': log}
+                call = handler
+                for middleware in reversed(self._middlewares):
+                    call = partial(middleware, call, route)
+                self._routes[name] = call
+                self.routes[name] = route
+            return handler
+        return register
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """CallbackQueryHandler callback: answer the query and run its route."""
+        query = update.callback_query
+        await query.answer()
+        name, _, param = (query.data or "").partition(":")
+        call = self._routes.get(name)
+        if call is None:
+            logger.warning(f"No route for callback data {query.data!r}")
+            return
+        await call(update, context, param)
+
+# Rendering: telegram objects are immutable, so every reply shares these
+# keyboards instead of building new ones per update
+USER_MENU_ROWS = (
+    (InlineKeyboardButton("📜 Terms", callback_data="terms"),
+     InlineKeyboardButton("🔏 Privacy", callback_data="privacy")),
+    (InlineKeyboardButton("ℹ️ Bot Info", callback_data="version"),
+     InlineKeyboardButton("💬 Feedback", callback_data="feedback"))
+)
+USER_MENU_MARKUP = InlineKeyboardMarkup(USER_MENU_ROWS)
+ADMIN_MENU_MARKUP = InlineKeyboardMarkup(
+    USER_MENU_ROWS + ((InlineKeyboardButton("👑 Admin Panel", callback_data="adminpanel"),),)
+)
+ADMIN_PANEL_MARKUP = InlineKeyboardMarkup((
+    (InlineKeyboardButton("📊 Stats", callback_data="adminstats"),
+     InlineKeyboardButton("👤 User Lookup", callback_data="userlookup")),
+    (InlineKeyboardButton("⛔ Ban User", callback_data="banuser"),
+     InlineKeyboardButton("✅ Unban User", callback_data="unbanuser")),
+    (InlineKeyboardButton("🔒 Limit User", callback_data="limituser"),
+     InlineKeyboardButton("🔓 Unlimit User", callback_data="unlimituser")),
+    (InlineKeyboardButton("📋 Bulk Moderation", callback_data="bulkmod"),),
+    (InlineKeyboardButton("📝 Update Terms", callback_data="updateterms"),
+     InlineKeyboardButton("📝 Update Policy", callback_data="updatepolicy")),
+    (InlineKeyboardButton("📢 Broadcast", callback_data="broadcast"),),
+    (InlineKeyboardButton("📩 View Feedback", callback_data="viewfeedback"),
+     InlineKeyboardButton("📈 Metrics", callback_data="adminmetrics")),
+    (InlineKeyboardButton("🔙 Back", callback_data="back"),)
+))
+BACK_MARKUP = InlineKeyboardMarkup(((InlineKeyboardButton("🔙 Back", callback_data="back"),),))
+BACK_TO_ADMIN_MARKUP = InlineKeyboardMarkup(((InlineKeyboardButton("🔙 Back to Admin", callback_data="adminpanel"),),))
+CANCEL_MARKUP = InlineKeyboardMarkup(((InlineKeyboardButton("❌ Cancel", callback_data="back"),),))
+CANCEL_TO_ADMIN_MARKUP = InlineKeyboardMarkup(((InlineKeyboardButton("❌ Cancel", callback_data="adminpanel"),),))
+
+PROFILE_TEMPLATE = (
+    "{welcome}\n\nUSER DETAILS:\n\n"
+    "🆔 User ID: {user_id}\n"
+    "👤 Username: {username}\n"
+    "📛 First Name: {first_name}\n"
+    "📛 Last Name: {last_name}\n"
+    "🌐 Language: {language}\n"
+    "💎 Premium: {premium}\n"
+    "🤖 Bot: {bot}\n"
+    "🔒 Status: {status}\n"
+)
+
+@lru_cache(maxsize=PROFILE_RENDER_CACHE_SIZE)
+def _render_profile_text(welcome: str, user_id: int, username: Optional[str], first_name: Optional[str],
+                         last_name: Optional[str], language_code: Optional[str], is_premium: bool,
+                         is_bot: bool, status: str) -> str:
+    return PROFILE_TEMPLATE.format(
+        welcome=welcome,
+        user_id=user_id,
+        username=f"@{username}" if username else "Not set",
+        first_name=first_name or "Not set",
+        last_name=last_name or "Not set",
+        language=language_code or "Not set",
+        premium="Yes" if is_premium else "No",
+        bot="Yes" if is_bot else "No",
+        status=status
+    )
+
+def render_profile(user, user_context: Dict) -> Tuple[str, InlineKeyboardMarkup]:
+    """Welcome text with the user's account details, and the matching menu."""
+    status = "❌ Banned" if user_context['is_banned'] else (
+             "⚠️ Limited" if user_context['is_limited'] else "✅ Active")
+    # The welcome message is part of the key, so editing it needs no invalidation
+    text = _render_profile_text(
+        DatabaseManager.get_setting('welcome_message'), user.id, user.username, user.first_name,
+        user.last_name, user.language_code, bool(getattr(user, 'is_premium', False)), bool(user.is_bot), status
+    )
+    return text, ADMIN_MENU_MARKUP if user_context['is_admin'] else USER_MENU_MARKUP
 
 def format_time_remaining(seconds: int, command: str) -> str:
     """Format time remaining with a progress bar"""
@@ -377,256 +2577,539 @@ def format_time_remaining(seconds: int, command: str) -> str:
     bar = "▓" * progress + "░" * (10 - progress)
     return f"⏳ Cooldown: [{bar}] {seconds}s remaining"
 
-# Initialize database
-DatabaseManager.init_db()
+def build_user_context(user) -> Dict:
+    """Flags and profile of an update's user, answered entirely from memory."""
+    return {
+        'user_id': user.id,
+        'is_admin': user.id in ADMIN_IDS,
+        'is_banned': DatabaseManager.is_banned(user.id),
+        'is_limited': DatabaseManager.is_limited(user.id),
+        'profile': {
+            'user_id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'language_code': user.language_code,
+            'is_premium': getattr(user, 'is_premium', False),
+            'is_bot': user.is_bot
+        }
+    }
+
+async def load_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pre-handler middleware: attach the user context once per update."""
+    if update.effective_user:
+        context.user_context = build_user_context(update.effective_user)
+
+def get_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Dict:
+    """Return the context attached by load_user_context, building it if absent."""
+    user_context = getattr(context, 'user_context', None)
+    if user_context is None or user_context['user_id'] != update.effective_user.id:
+        user_context = context.user_context = build_user_context(update.effective_user)
+    return user_context
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send welcome message with user's Telegram account details."""
     user = update.effective_user
+    user_context = get_user_context(update, context)
     
     # Check rate limiting
-    if (time_remaining := DatabaseManager.check_rate_limit(user.id, 'start')):
+    if (time_remaining := RateLimiter.check(user.id, 'start')):
         await update.message.reply_text(
             format_time_remaining(int(time_remaining.total_seconds()), 'start')
         )
         return
     
     # Check if user is banned
-    if DatabaseManager.is_banned(user.id):
+    if user_context['is_banned']:
         await update.message.reply_text("⛔ Your account has been banned from using this bot.")
         return
     
     # Update user data
-    user_data = {
-        'user_id': user.id,
-        'username': user.username,
-        'first_name': user.first_name,
-        'last_name': user.last_name,
-        'language_code': user.language_code,
-        'is_premium': getattr(user, 'is_premium', False),
-        'is_bot': user.is_bot
-    }
-    DatabaseManager.update_user(user_data)
-    DatabaseManager.log_command(user.id, 'start')
-    DatabaseManager.update_rate_limit(user.id, 'start')
-    
-    # Get welcome message
-    welcome_message = DatabaseManager.get_setting('welcome_message')
-    
-    # Prepare user details
-    user_details = f"{welcome_message}\n\nUSER DETAILS:\n\n"
-    user_details += f"🆔 User ID: {user.id}\n"
-    user_details += f"👤 Username: @{user.username}\n" if user.username else "👤 Username: Not set\n"
-    user_details += f"📛 First Name: {user.first_name}\n" if user.first_name else "📛 First Name: Not set\n"
-    user_details += f"📛 Last Name: {user.last_name}\n" if user.last_name else "📛 Last Name: Not set\n"
-    user_details += f"🌐 Language: {user.language_code}\n" if user.language_code else "🌐 Language: Not set\n"
-    user_details += f"💎 Premium: {'Yes' if getattr(user, 'is_premium', False) else 'No'}\n"
-    user_details += f"🤖 Bot: {'Yes' if user.is_bot else 'No'}\n"
-    
-    # Get user status safely
-    user_status = "❌ Banned" if DatabaseManager.is_banned(user.id) else (
-                 "⚠️ Limited" if DatabaseManager.is_limited(user.id) else "✅ Active")
-    user_details += f"🔒 Status: {user_status}\n"
-    
-    # Create keyboard with options
-    keyboard = [
-        [InlineKeyboardButton("📜 Terms", callback_data="terms"),
-         InlineKeyboardButton("🔏 Privacy", callback_data="privacy")],
-        [InlineKeyboardButton("ℹ️ Bot Info", callback_data="version"),
-         InlineKeyboardButton("💬 Feedback", callback_data="feedback")]
-    ]
+    await AsyncDatabaseManager.update_user(user_context['profile'])
+    await AsyncDatabaseManager.revive_delivery(user.id)
+    await AsyncDatabaseManager.log_command(user.id, 'start')
+    RateLimiter.hit(user.id, 'start')
     
-    if user.id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="adminpanel")])
+    # Prepare user details and the menu for this user
+    user_details, reply_markup = render_profile(user, user_context)
     
     await update.message.reply_text(
         text=user_details,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=reply_markup,
         parse_mode=None
     )
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle all button callbacks."""
-    query = update.callback_query
-    await query.answer()
+async def timing_middleware(call_next, route: Dict, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            param: str) -> None:
+    """Record per-route latency and log callbacks slower than SLOW_CALLBACK_THRESHOLD."""
+    started = time.perf_counter()
+    try:
+        await call_next(update, context, param)
+    finally:
+        elapsed = time.perf_counter() - started
+        Metrics.observe('bot_callback_seconds', 'route', route['name'], elapsed)
+        if elapsed >= SLOW_CALLBACK_THRESHOLD:
+            logger.warning(f"Slow callback '{route['name']}': {elapsed * 1000:.0f}ms",
+                           extra={'aggregate': 'slow_callback'})
+
+async def command_log_middleware(call_next, route: Dict, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 param: str) -> None:
+    """Record the button press in the commands log."""
+    # Logged under the route name so parameterized buttons share one stats key
+    if route['log']:
+        await AsyncDatabaseManager.log_command(update.callback_query.from_user.id, route['name'])
+    await call_next(update, context, param)
+
+async def auth_middleware(call_next, route: Dict, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                          param: str) -> None:
+    """Reject admin_only routes for everyone but admins."""
+    if route['admin_only'] and not get_user_context(update, context)['is_admin']:
+        await update.callback_query.edit_message_text("⛔ Access denied.")
+        return
+    await call_next(update, context, param)
+
+async def rate_limit_middleware(call_next, route: Dict, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                param: str) -> None:
+    """Enforce the route's RATE_LIMITS cooldown."""
+    command = route['rate_limit']
+    if command and (time_remaining := RateLimiter.check(update.callback_query.from_user.id, command)):
+        await update.callback_query.edit_message_text(
+            format_time_remaining(int(time_remaining.total_seconds()), command)
+        )
+        return
+    await call_next(update, context, param)
+
+callback_router = CallbackRouter([
+    timing_middleware,
+    command_log_middleware,
+    auth_middleware,
+    rate_limit_middleware
+])
+
+@callback_router.route("terms")
+async def show_terms(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show the terms and conditions."""
+    terms = DatabaseManager.get_setting('terms_and_conditions')
+    await update.callback_query.edit_message_text(
+        text=f"📜 TERMS AND CONDITIONS\n\n{terms}",
+        reply_markup=BACK_MARKUP
+    )
+
+@callback_router.route("privacy")
+async def show_privacy(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show the privacy policy."""
+    policy = DatabaseManager.get_setting('privacy_policy')
+    await update.callback_query.edit_message_text(
+        text=f"🔏 PRIVACY POLICY\n\n{policy}",
+        reply_markup=BACK_MARKUP
+    )
+
+@callback_router.route("version")
+async def show_version(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show bot version, uptime and user count."""
+    uptime = datetime.now() - START_TIME
+    days, seconds = uptime.days, uptime.seconds
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
+    stats = await AsyncDatabaseManager.get_global_stats()
     
-    user_id = query.from_user.id
-    user = query.from_user
+    version_info = (
+        f"ℹ️ BOT INFORMATION\n\n"
+        f"🛠 Version: {BOT_VERSION}\n"
+        f"⏱ Uptime: {days}d {hours}h {minutes}m\n"
+        f"🚀 Started: {START_TIME.strftime('%Y-%m-%d %H:%M:%S')}\n"
+        f"👥 Total Users: {stats['total_users']}"
+    )
     
-    # Log the button press
-    DatabaseManager.log_command(user_id, query.data)
+    await update.callback_query.edit_message_text(
+        text=version_info,
+        reply_markup=BACK_MARKUP
+    )
+
+@callback_router.route("feedback", rate_limit='feedback')
+async def prompt_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Ask the user for a feedback message."""
+    context.user_data['pending_action'] = 'feedback'
+    await update.callback_query.edit_message_text(
+        text="💬 Please send your feedback message:",
+        reply_markup=CANCEL_MARKUP
+    )
+
+@callback_router.route("adminpanel", admin_only=True)
+async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show the admin panel."""
+    await update.callback_query.edit_message_text(
+        text="👑 ADMIN PANEL\n\nSelect an action:",
+        reply_markup=ADMIN_PANEL_MARKUP
+    )
+
+@callback_router.route("adminstats", admin_only=True)
+async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show global bot statistics to admins."""
+    stats = await AsyncDatabaseManager.get_global_stats()
+    uptime = datetime.now() - START_TIME
+    days, seconds = uptime.days, uptime.seconds
+    hours = seconds // 3600
+    minutes = (seconds % 3600) // 60
     
-    if query.data == "terms":
-        terms = DatabaseManager.get_setting('terms_and_conditions')
-        await query.edit_message_text(
-            text=f"📜 TERMS AND CONDITIONS\n\n{terms}",
-            reply_markup=back_button_markup()
-        )
-    elif query.data == "privacy":
-        policy = DatabaseManager.get_setting('privacy_policy')
-        await query.edit_message_text(
-            text=f"🔏 PRIVACY POLICY\n\n{policy}",
-            reply_markup=back_button_markup()
-        )
-    elif query.data == "version":
-        uptime = datetime.now() - START_TIME
-        days, seconds = uptime.days, uptime.seconds
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        
-        version_info = (
-            f"ℹ️ BOT INFORMATION\n\n"
-            f"🛠 Version: {BOT_VERSION}\n"
-            f"⏱ Uptime: {days}d {hours}h {minutes}m\n"
-            f"🚀 Started: {START_TIME.strftime('%Y-%m-%d %H:%M:%S')}\n"
-            f"👥 Total Users: {DatabaseManager.get_global_stats()['total_users']}"
-        )
-        
-        await query.edit_message_text(
-            text=version_info,
-            reply_markup=back_button_markup()
-        )
-    elif query.data == "feedback":
-        if (time_remaining := DatabaseManager.check_rate_limit(user_id, 'feedback')):
-            await query.edit_message_text(
-                format_time_remaining(int(time_remaining.total_seconds()), 'feedback')
-            )
-            return
-        
-        context.user_data['pending_action'] = 'feedback'
-        await query.edit_message_text(
-            text="💬 Please send your feedback message:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="back")]])
-        )
-    elif query.data == "adminpanel":
-        if user_id not in ADMIN_IDS:
-            await query.edit_message_text("⛔ Access denied.")
-            return
-            
-        keyboard = [
-            [InlineKeyboardButton("📊 Stats", callback_data="adminstats"),
-             InlineKeyboardButton("👤 User Lookup", callback_data="userlookup")],
-            [InlineKeyboardButton("⛔ Ban User", callback_data="banuser"),
-             InlineKeyboardButton("✅ Unban User", callback_data="unbanuser")],
-            [InlineKeyboardButton("🔒 Limit User", callback_data="limituser"),
-             InlineKeyboardButton("🔓 Unlimit User", callback_data="unlimituser")],
-            [InlineKeyboardButton("📝 Update Terms", callback_data="updateterms"),
-             InlineKeyboardButton("📝 Update Policy", callback_data="updatepolicy")],
-            [InlineKeyboardButton("📢 Broadcast", callback_data="broadcast")],
-            [InlineKeyboardButton("📩 View Feedback", callback_data="viewfeedback")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
-        
-        await query.edit_message_text(
-            text="👑 ADMIN PANEL\n\nSelect an action:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    elif query.data == "adminstats":
-        if user_id not in ADMIN_IDS:
-            await query.edit_message_text("⛔ Access denied.")
-            return
-            
-        stats = DatabaseManager.get_global_stats()
-        uptime = datetime.now() - START_TIME
-        days, seconds = uptime.days, uptime.seconds
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        
-        stats_message = (
-            f"📊 ADMIN STATISTICS\n\n"
-            f"🛠 Version: {BOT_VERSION}\n"
-            f"⏱ Uptime: {days}d {hours}h {minutes}m\n"
-            f"👥 Total users: {stats['total_users']}\n"
-            f"🟢 Active today: {stats['active_today']}\n"
-            f"🔄 Commands processed: {stats['total_commands']}\n"
-            f"⛔ Banned users: {stats['banned_users']}\n"
-            f"🔒 Limited users: {stats['limited_users']}\n"
-            f"📩 Feedback received: {stats['feedback_count']}"
-        )
-        
-        await query.edit_message_text(
-            text=stats_message,
-            reply_markup=back_to_admin_markup()
-        )
-    elif query.data == "viewfeedback":
-        if user_id not in ADMIN_IDS:
-            await query.edit_message_text("⛔ Access denied.")
-            return
-            
-        feedback_list = DatabaseManager.get_feedback()
-        if not feedback_list:
-            await query.edit_message_text("ℹ️ No feedback has been submitted yet.")
-            return
-            
-        feedback_message = "📩 RECENT FEEDBACK\n\n"
-        for i, feedback in enumerate(feedback_list, 1):
-            user_info = f"@{feedback['username']}" if feedback['username'] else f"{feedback['first_name']} {feedback['last_name']}"
-            feedback_message += (
-                f"{i}. From: {user_info} (ID: {feedback['user_id']})\n"
-                f"   Message: {feedback['message']}\n"
-                f"   Date: {feedback['timestamp']}\n\n"
-            )
-        
-        await query.edit_message_text(
-            text=feedback_message,
-            reply_markup=back_to_admin_markup()
+    stats_message = (
+        f"📊 ADMIN STATISTICS\n\n"
+        f"🛠 Version: {BOT_VERSION}\n"
+        f"⏱ Uptime: {days}d {hours}h {minutes}m\n"
+        f"👥 Total users: {stats['total_users']}\n"
+        f"🟢 Active today: {stats['active_today']}\n"
+        f"🔄 Commands processed: {stats['total_commands']}\n"
+        f"⛔ Banned users: {stats['banned_users']}\n"
+        f"🔒 Limited users: {stats['limited_users']}\n"
+        f"📩 Feedback received: {stats['feedback_count']}"
+    )
+    
+    await update.callback_query.edit_message_text(
+        text=stats_message,
+        reply_markup=BACK_TO_ADMIN_MARKUP
+    )
+
+@callback_router.route("adminmetrics", admin_only=True)
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show handler, database and Bot API latencies to admins."""
+    # Telegram caps messages at 4096 characters
+    text = f"📈 METRICS (this process)\n\n{Metrics.summary()}"[:4096]
+    await update.callback_query.edit_message_text(
+        text=text,
+        reply_markup=BACK_TO_ADMIN_MARKUP
+    )
+
+def message_length(text: str) -> int:
+    """Length as Telegram counts it, in UTF-16 code units (an emoji is usually 2)."""
+    return len(text.encode('utf-16-le')) // 2
+
+def format_feedback(feedback: Dict, max_length: int) -> str:
+    """One feedback entry, its message cut short if the entry would exceed `max_length`."""
+    user_info = f"@{feedback['username']}" if feedback['username'] else f"{feedback['first_name']} {feedback['last_name']}"
+    head = f"#{feedback['feedback_id']} From: {user_info} (ID: {feedback['user_id']})\n   Message: "
+    tail = f"\n   Date: {feedback['timestamp']}\n\n"
+    message = feedback['message'] or ""
+    room = max_length - message_length(head) - message_length(tail)
+    if message_length(message) > room:
+        message = message[:max(room - 1, 0)]
+        while message and message_length(message) > room - 1:
+            message = message[:-1]
+        message += "…"
+    return head + message + tail
+
+@callback_router.route("viewfeedback", "feedbackpage", admin_only=True)
+async def show_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Show admins one page of feedback, newest first.
+    
+    "viewfeedback" opens the newest page; "feedbackpage:older:<id>" and
+    "feedbackpage:newer:<id>" page on from the entry with that feedback_id.
+    """
+    direction, _, cursor_id = param.partition(":")
+    cursor_id = int(cursor_id) if cursor_id.isdigit() else None
+    newer = direction == "newer" and cursor_id is not None
+    # One extra row tells whether there is another page in that direction
+    rows = await AsyncDatabaseManager.get_feedback(
+        FEEDBACK_PAGE_SIZE + 1,
+        older_than=None if newer else cursor_id,
+        newer_than=cursor_id if newer else None
+    )
+    if not rows and cursor_id is not None:
+        # The cursor entry is gone; start over from the newest page
+        cursor_id, newer = None, False
+        rows = await AsyncDatabaseManager.get_feedback(FEEDBACK_PAGE_SIZE + 1)
+    if not rows:
+        await update.callback_query.edit_message_text("ℹ️ No feedback has been submitted yet.",
+                                                      reply_markup=BACK_TO_ADMIN_MARKUP)
+        return
+    
+    # Fill the page from the cursor outward until it is full or the next entry would not fit
+    header = "📩 FEEDBACK\n\n"
+    budget = MESSAGE_MAX_LENGTH - message_length(header)
+    entries = []
+    for feedback in rows[:FEEDBACK_PAGE_SIZE]:
+        entry = format_feedback(feedback, budget)
+        if entries and message_length(entry) > budget:
+            break
+        entries.append((feedback['feedback_id'], entry))
+        budget -= message_length(entry)
+    more = len(entries) < len(rows)
+    if newer:
+        entries.reverse()
+        has_newer, has_older = more, True
+    else:
+        has_newer, has_older = cursor_id is not None, more
+    
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"feedbackpage:newer:{entries[0][0]}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton("Older ➡️", callback_data=f"feedbackpage:older:{entries[-1][0]}"))
+    await update.callback_query.edit_message_text(
+        text=header + "".join(entry for _, entry in entries).rstrip(),
+        reply_markup=InlineKeyboardMarkup((navigation,) + BACK_TO_ADMIN_MARKUP.inline_keyboard)
+        if navigation else BACK_TO_ADMIN_MARKUP
+    )
+
+@callback_router.route("back")
+async def show_start_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Go back to the /start profile and menu."""
+    # Recreate the original start message
+    user_details, reply_markup = render_profile(update.callback_query.from_user, get_user_context(update, context))
+    
+    await update.callback_query.edit_message_text(
+        text=user_details,
+        reply_markup=reply_markup
+    )
+
+def encode_segment(segment: Dict) -> str:
+    """Compact callback_data form of a segment, e.g. "l=en,p=1,a=7" (defaults omitted)."""
+    fields = []
+    if segment.get('language'):
+        fields.append(f"l={segment['language']}")
+    if segment.get('premium') is not None:
+        fields.append(f"p={int(segment['premium'])}")
+    if segment.get('active_days'):
+        fields.append(f"a={segment['active_days']}")
+    if segment.get('include_banned'):
+        fields.append("b=1")
+    return ",".join(fields)
+
+def decode_segment(text: str) -> Dict:
+    """Inverse of encode_segment(); unknown or invalid fields are ignored."""
+    segment = {'language': None, 'premium': None, 'active_days': None, 'include_banned': False}
+    for field in text.split(","):
+        key, _, value = field.partition("=")
+        if key == "l" and 0 < len(value) <= 16:
+            segment['language'] = value
+        elif key == "p" and value in ("0", "1"):
+            segment['premium'] = value == "1"
+        elif key == "a" and value.isdigit() and int(value) in SEGMENT_ACTIVE_DAYS:
+            segment['active_days'] = int(value)
+        elif key == "b" and value == "1":
+            segment['include_banned'] = True
+    return segment
+
+def describe_segment(segment: Optional[Dict]) -> str:
+    if segment is None:
+        return "all users"
+    parts = [f"language {segment['language']}" if segment.get('language') else "all languages"]
+    if segment.get('premium') is not None:
+        parts.append("premium" if segment['premium'] else "non-premium")
+    if segment.get('active_days'):
+        parts.append(f"active in the last {segment['active_days']}d")
+    parts.append("banned included" if segment.get('include_banned') else "not banned")
+    return ", ".join(parts)
+
+def describe_delivery(delivery: Optional[Dict]) -> str:
+    """One-line deliverability of a chat, from DatabaseManager.get_delivery_status()."""
+    if delivery is None:
+        return "ok"
+    return f"{DELIVERY_STATUS_NAMES[delivery['status']]} since {delivery['last_failure']} (skipped by broadcasts)"
+
+def segment_size(summary: Dict, segment: Dict) -> int:
+    """Size of `segment` from a DatabaseManager segment summary."""
+    column = f"active_{segment['active_days']}" if segment.get('active_days') else 'total'
+    return sum(
+        row[column] for row in summary['rows']
+        if (not segment.get('language') or row['language_code'] == segment['language'])
+        and (segment.get('premium') is None or row['is_premium'] == int(segment['premium']))
+        and (segment.get('include_banned') or not row['is_banned'])
+    )
+
+def segment_languages(summary: Dict) -> List[str]:
+    """The SEGMENT_LANGUAGES most common language codes."""
+    totals: Dict[str, int] = {}
+    for row in summary['rows']:
+        if row['language_code']:
+            totals[row['language_code']] = totals.get(row['language_code'], 0) + row['total']
+    return sorted(totals, key=totals.get, reverse=True)[:SEGMENT_LANGUAGES]
+
+def segment_picker_markup(segment: Dict, languages: List[str]) -> InlineKeyboardMarkup:
+    """Filter buttons (each re-renders the picker with one filter changed) plus send and back."""
+    def option(label: str, selected: bool, **changes) -> InlineKeyboardButton:
+        return InlineKeyboardButton(("✅ " if selected else "") + label,
+                                    callback_data=f"broadcast:{encode_segment({**segment, **changes})}")
+    
+    language_buttons = [option("All", not segment['language'], language=None)] + [
+        option(code, segment['language'] == code, language=code) for code in languages
+    ]
+    rows = [language_buttons[i:i + 4] for i in range(0, len(language_buttons), 4)]
+    rows.append([option("Any", segment['premium'] is None, premium=None),
+                 option("⭐ Premium", segment['premium'] is True, premium=True),
+                 option("Regular", segment['premium'] is False, premium=False)])
+    rows.append([option("Any time", not segment['active_days'], active_days=None)] + [
+        option(f"{days}d", segment['active_days'] == days, active_days=days) for days in SEGMENT_ACTIVE_DAYS
+    ])
+    rows.append([option("🚫 Banned excluded" if not segment['include_banned'] else "Banned included",
+                        False, include_banned=not segment['include_banned'])])
+    rows.append([InlineKeyboardButton("✍️ Write message", callback_data=f"broadcastmsg:{encode_segment(segment)}")])
+    return InlineKeyboardMarkup(rows + list(BACK_TO_ADMIN_MARKUP.inline_keyboard))
+
+@callback_router.route("broadcast", admin_only=True)
+async def show_segment_picker(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Let an admin narrow the broadcast audience, showing its size as filters change."""
+    segment = decode_segment(param)
+    summary = await AsyncDatabaseManager.get_segment_summary()
+    try:
+        await update.callback_query.edit_message_text(
+            text=(
+                f"📢 BROADCAST AUDIENCE\n\n"
+                f"🎯 {describe_segment(segment)}\n"
+                f"👥 {segment_size(summary, segment)} users "
+                f"(counted at {summary['computed_at']:%H:%M})\n"
+                f"📵 {summary['undeliverable']} unreachable chats are skipped\n\n"
+                f"Pick the filters, then write the message."
+            ),
+            reply_markup=segment_picker_markup(segment, segment_languages(summary))
         )
-    elif query.data == "back":
-        # Recreate the original start message
-        user = query.from_user
-        welcome_message = DatabaseManager.get_setting('welcome_message')
-        
-        user_details = f"{welcome_message}\n\nUSER DETAILS:\n\n"
-        user_details += f"🆔 User ID: {user.id}\n"
-        user_details += f"👤 Username: @{user.username}\n" if user.username else "👤 Username: Not set\n"
-        user_details += f"📛 First Name: {user.first_name}\n" if user.first_name else "📛 First Name: Not set\n"
-        user_details += f"📛 Last Name: {user.last_name}\n" if user.last_name else "📛 Last Name: Not set\n"
-        user_details += f"🌐 Language: {user.language_code}\n" if user.language_code else "🌐 Language: Not set\n"
-        user_details += f"💎 Premium: {'Yes' if getattr(user, 'is_premium', False) else 'No'}\n"
-        user_details += f"🤖 Bot: {'Yes' if user.is_bot else 'No'}\n"
-        
-        # Get user status safely
-        user_status = "❌ Banned" if DatabaseManager.is_banned(user.id) else (
-                     "⚠️ Limited" if DatabaseManager.is_limited(user.id) else "✅ Active")
-        user_details += f"🔒 Status: {user_status}\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("📜 Terms", callback_data="terms"),
-             InlineKeyboardButton("🔏 Privacy", callback_data="privacy")],
-            [InlineKeyboardButton("ℹ️ Bot Info", callback_data="version"),
-             InlineKeyboardButton("💬 Feedback", callback_data="feedback")]
-        ]
-        
-        if user.id in ADMIN_IDS:
-            keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="adminpanel")])
-        
-        await query.edit_message_text(
-            text=user_details,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    except BadRequest as e:
+        # Pressing the option that is already selected changes nothing
+        if "not modified" not in str(e):
+            raise
+
+@callback_router.route("broadcastmsg", admin_only=True)
+async def prompt_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Ask for the message to broadcast to the chosen segment."""
+    segment = decode_segment(param)
+    context.user_data['pending_action'] = 'broadcast'
+    context.user_data['broadcast_segment'] = segment
+    await update.callback_query.edit_message_text(
+        text=(
+            f"📢 Broadcast\n\n"
+            f"🎯 {describe_segment(segment)}\n\n"
+            f"Send the message to broadcast:\n\nType /cancel to abort."
+        ),
+        reply_markup=CANCEL_TO_ADMIN_MARKUP
+    )
+
+BULK_ACTION_LABELS = {
+    'ban': ("⛔ Ban", "banned"),
+    'unban': ("✅ Unban", "unbanned"),
+    'limit': ("🔒 Limit", "limited"),
+    'unlimit': ("🔓 Unlimit", "unlimited")
+}
+BULK_MODERATION_MARKUP = InlineKeyboardMarkup(
+    tuple(
+        tuple(InlineKeyboardButton(BULK_ACTION_LABELS[action][0], callback_data=f"bulkmod:{action}")
+              for action in pair)
+        for pair in (('ban', 'unban'), ('limit', 'unlimit'))
+    ) + BACK_TO_ADMIN_MARKUP.inline_keyboard
+)
+
+def parse_user_ids(text: str) -> Tuple[List[int], List[str]]:
+    """User IDs separated by whitespace, commas or semicolons, and the entries that are not IDs."""
+    user_ids, invalid = [], []
+    for token in re.split(r'[\s,;]+', text.strip()):
+        # isdigit() would also pass superscripts like "²", which int() rejects;
+        # anything past SQLite's INTEGER range cannot be a Telegram ID either
+        if token.isdecimal() and int(token) < 2 ** 63:
+            user_ids.append(int(token))
+        elif token:
+            invalid.append(token)
+    return user_ids, invalid
+
+def format_bulk_report(action: str, outcomes: Dict[str, List[int]], invalid: List[str]) -> Tuple[str, bool]:
+    """Summary of a bulk action, and whether some ID lists had to be cut short."""
+    done = BULK_ACTION_LABELS[action][1]
+    lines = [
+        ("✅", f"{done}", outcomes['changed']),
+        ("🆕", f"{done} before their first visit", outcomes['created']),
+        ("ℹ️", f"already {done}", outcomes['unchanged']),
+        ("❔", "not known to the bot", outcomes['unknown']),
+        ("⛔", "admins skipped", outcomes['admin']),
+        ("❌", "invalid entries", invalid)
+    ]
+    text = f"📋 BULK {action.upper()}\n"
+    truncated = False
+    for icon, label, ids in lines:
+        if not ids:
+            continue
+        shown = ", ".join(str(user_id) for user_id in ids[:BULK_REPORT_INLINE_IDS])
+        if len(ids) > BULK_REPORT_INLINE_IDS:
+            shown += ", …"
+            truncated = True
+        text += f"\n{icon} {len(ids)} {label}: {shown}"
+    return text, truncated
+
+async def apply_bulk_moderation(update: Update, action: str, text: str) -> None:
+    """Run a bulk action on the IDs in `text` and reply with the per-ID outcomes."""
+    user_ids, invalid = parse_user_ids(text)
+    if not user_ids:
+        await update.message.reply_text("ℹ️ No user IDs found.")
+        return
+    if len(user_ids) > BULK_MODERATION_MAX_IDS:
+        await update.message.reply_text(f"⛔ At most {BULK_MODERATION_MAX_IDS} IDs per bulk action.")
+        return
+    
+    try:
+        outcomes = await AsyncDatabaseManager.bulk_moderate(action, user_ids)
+    except sqlite3.OperationalError as e:
+        # Most likely the write lock, held by a background index build
+        logger.warning(f"Admin {update.effective_user.id} bulk {action} failed: {e}")
+        await update.message.reply_text("⏳ The database is busy. Please try again in a minute.")
+        return
+    logger.info(f"Admin {update.effective_user.id} bulk {action}: "
+                f"{len(outcomes['changed']) + len(outcomes['created'])} of {len(user_ids)} IDs changed")
+    report, truncated = format_bulk_report(action, outcomes, invalid)
+    await update.message.reply_text(report)
+    if truncated:
+        # Every ID with its outcome, grouped by outcome
+        rows = [f"{user_id},{outcome}" for outcome, ids in outcomes.items() for user_id in ids]
+        rows += [f"{token},invalid" for token in invalid]
+        await update.message.reply_document(
+            document=io.BytesIO(("user_id,outcome\n" + "\n".join(rows) + "\n").encode()),
+            filename=f"bulk_{action}.csv"
         )
-    elif query.data in ["banuser", "unbanuser", "limituser", "unlimituser", "userlookup", 
-                       "updateterms", "updatepolicy", "broadcast"]:
-        if user_id not in ADMIN_IDS:
-            await query.edit_message_text("⛔ Access denied.")
-            return
-            
-        action_map = {
-            "banuser": ("⛔ Ban User", "Send the user ID to ban:", "ban"),
-            "unbanuser": ("✅ Unban User", "Send the user ID to unban:", "unban"),
-            "limituser": ("🔒 Limit User", "Send the user ID to limit:", "limit"),
-            "unlimituser": ("🔓 Unlimit User", "Send the user ID to unlimit:", "unlimit"),
-            "userlookup": ("👤 User Lookup", "Send the user ID to lookup:", "userinfo"),
-            "updateterms": ("📝 Update Terms", "Send the new Terms and Conditions:", "updateterms"),
-            "updatepolicy": ("📝 Update Policy", "Send the new Privacy Policy:", "updatepolicy"),
-            "broadcast": ("📢 Broadcast", "Send the message to broadcast to all users:", "broadcast")
-        }
-        
-        title, prompt, action = action_map[query.data]
-        context.user_data['pending_action'] = action
+
+@callback_router.route("bulkmod", admin_only=True)
+async def prompt_bulk_moderation(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Pick a bulk action, then ask for the list or file of IDs."""
+    query = update.callback_query
+    if param not in BULK_MODERATION_ACTIONS:
         await query.edit_message_text(
-            text=f"{title}\n\n{prompt}\n\nType /cancel to abort.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="adminpanel")]])
+            text="📋 Bulk Moderation\n\nChoose the action to apply to a list of users:",
+            reply_markup=BULK_MODERATION_MARKUP
         )
+        return
+    
+    context.user_data['pending_action'] = 'bulk'
+    context.user_data['bulk_action'] = param
+    await query.edit_message_text(
+        text=(
+            f"📋 Bulk {param}\n\n"
+            f"Send the user IDs separated by spaces, commas or new lines, "
+            f"or upload them as a text file (up to {BULK_MODERATION_MAX_IDS} IDs).\n\n"
+            f"Type /cancel to abort."
+        ),
+        reply_markup=CANCEL_TO_ADMIN_MARKUP
+    )
+
+# Admin panel buttons that prompt for text input: title, prompt, pending_action
+ADMIN_ACTION_PROMPTS = {
+    "banuser": ("⛔ Ban User", "Send the user ID to ban:", "ban"),
+    "unbanuser": ("✅ Unban User", "Send the user ID to unban:", "unban"),
+    "limituser": ("🔒 Limit User", "Send the user ID to limit:", "limit"),
+    "unlimituser": ("🔓 Unlimit User", "Send the user ID to unlimit:", "unlimit"),
+    "userlookup": ("👤 User Lookup", "Send the user ID to lookup:", "userinfo"),
+    "updateterms": ("📝 Update Terms", "Send the new Terms and Conditions:", "updateterms"),
+    "updatepolicy": ("📝 Update Policy", "Send the new Privacy Policy:", "updatepolicy")
+}
+
+@callback_router.route(*ADMIN_ACTION_PROMPTS, admin_only=True)
+async def prompt_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE, param: str) -> None:
+    """Ask an admin for the input of the chosen panel action."""
+    query = update.callback_query
+    # The route name, without the param a client may have appended
+    name = query.data.partition(":")[0]
+    if (action_prompt := ADMIN_ACTION_PROMPTS.get(name)) is None:
+        logger.warning(f"No admin action prompt for callback data {query.data!r}")
+        return
+    title, prompt, action = action_prompt
+    context.user_data['pending_action'] = action
+    await query.edit_message_text(
+        text=f"{title}\n\n{prompt}\n\nType /cancel to abort.",
+        reply_markup=CANCEL_TO_ADMIN_MARKUP
+    )
 
 async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle admin text input for various actions."""
@@ -646,41 +3129,43 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
             target_id = int(text)
             
             if action == "ban":
-                if DatabaseManager.ban_user(target_id):
+                if await AsyncDatabaseManager.ban_user(target_id):
                     await update.message.reply_text(f"✅ User {target_id} has been banned.")
                 else:
                     await update.message.reply_text("⛔ Cannot ban this user (may be an admin).")
             
             elif action == "unban":
-                if DatabaseManager.unban_user(target_id):
+                if await AsyncDatabaseManager.unban_user(target_id):
                     await update.message.reply_text(f"✅ User {target_id} has been unbanned.")
                 else:
                     await update.message.reply_text("ℹ️ User was not banned.")
             
             elif action == "limit":
-                if DatabaseManager.limit_user(target_id):
+                if await AsyncDatabaseManager.limit_user(target_id):
                     await update.message.reply_text(f"🔒 User {target_id} has been limited.")
                 else:
                     await update.message.reply_text("⛔ Cannot limit this user (may be an admin).")
             
             elif action == "unlimit":
-                if DatabaseManager.unlimit_user(target_id):
+                if await AsyncDatabaseManager.unlimit_user(target_id):
                     await update.message.reply_text(f"🔓 User {target_id} has been unlimited.")
                 else:
                     await update.message.reply_text("ℹ️ User was not limited.")
             
             elif action == "userinfo":
-                stats = DatabaseManager.get_user_stats(target_id)
+                stats = await AsyncDatabaseManager.get_user_stats(target_id)
                 
                 if not stats:
                     await update.message.reply_text("ℹ️ No data available for this user.")
                     return
                 
+                delivery = await AsyncDatabaseManager.get_delivery_status(target_id)
                 info_message = (
                     f"👤 USER INFO FOR {target_id}\n\n"
                     f"🕒 First seen: {stats['first_seen']}\n"
                     f"🕒 Last seen: {stats['last_seen']}\n"
                     f"🔄 Total commands: {stats['total_commands']}\n"
+                    f"📬 Delivery: {describe_delivery(delivery)}\n"
                     f"\n📊 COMMAND USAGE:\n"
                 )
                 
@@ -691,42 +3176,30 @@ async def handle_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         except ValueError:
             await update.message.reply_text("❌ Invalid user ID. Please enter a numeric ID.")
+        except sqlite3.OperationalError as e:
+            # Most likely the write lock, held by a background index build
+            logger.warning(f"Admin {action} for {text!r} failed: {e}")
+            await update.message.reply_text("⏳ The database is busy. Please try again in a minute.")
     
     elif action in ["updateterms", "updatepolicy"]:
         setting_name = "terms_and_conditions" if action == "updateterms" else "privacy_policy"
-        DatabaseManager.update_setting(setting_name, text)
+        await AsyncDatabaseManager.update_setting(setting_name, text)
         await update.message.reply_text(f"✅ {setting_name.replace('_', ' ').title()} updated successfully!")
     
     elif action == "broadcast":
-        if (time_remaining := DatabaseManager.check_rate_limit(user.id, 'broadcast')):
+        if (time_remaining := RateLimiter.check(user.id, 'broadcast')):
             await update.message.reply_text(
                 format_time_remaining(int(time_remaining.total_seconds()), 'broadcast')
             )
             return
         
-        users = DatabaseManager.get_all_users()
-        success = 0
-        failed = 0
-        
-        await update.message.reply_text(f"📢 Starting broadcast to {len(users)} users...")
-        
-        for user_data in users:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_data['user_id'],
-                    text=f"📢 Announcement:\n\n{text}"
-                )
-                success += 1
-            except Exception as e:
-                logger.error(f"Failed to send broadcast to {user_data['user_id']}: {e}")
-                failed += 1
-        
-        DatabaseManager.update_rate_limit(user.id, 'broadcast')
-        await update.message.reply_text(
-            f"📢 Broadcast completed!\n"
-            f"✅ Success: {success}\n"
-            f"❌ Failed: {failed}"
-        )
+        # The engine sends in the background and reports progress itself
+        await BroadcastEngine.start_job(context.bot, user.id, f"📢 Announcement:\n\n{text}",
+                                        context.user_data.pop('broadcast_segment', None))
+        RateLimiter.hit(user.id, 'broadcast')
+    
+    elif action == "bulk":
+        await apply_bulk_moderation(update, context.user_data.pop('bulk_action'), text)
     
     del context.user_data['pending_action']
 
@@ -740,7 +3213,7 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     feedback_message = update.message.text
     
     # Log the feedback
-    if DatabaseManager.add_feedback(user.id, feedback_message):
+    if await AsyncDatabaseManager.add_feedback(user.id, feedback_message):
         feedback_response = DatabaseManager.get_setting('feedback_message')
         await update.message.reply_text(feedback_response)
     else:
@@ -752,8 +3225,37 @@ async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     """Cancel any pending admin action."""
     if 'pending_action' in context.user_data:
         del context.user_data['pending_action']
+        context.user_data.pop('broadcast_segment', None)
+        context.user_data.pop('bulk_action', None)
         await update.message.reply_text("❌ Action cancelled.")
 
+async def handle_bulk_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Take the IDs for a pending bulk action from an uploaded text file."""
+    if context.user_data.get('pending_action') != 'bulk':
+        return
+    
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MODERATION_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"⛔ The file is too large (at most {BULK_MODERATION_MAX_FILE_SIZE // 1024} KB)."
+        )
+        return
+    content = await (await document.get_file()).download_as_bytearray()
+    del context.user_data['pending_action']
+    await apply_bulk_moderation(update, context.user_data.pop('bulk_action'),
+                                content.decode('utf-8', errors='replace'))
+
+async def bulk_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /bulk <ban|unban|limit|unlimit> <user_id> [...] for admins."""
+    if not context.args or context.args[0] not in BULK_MODERATION_ACTIONS:
+        await update.message.reply_text(
+            "ℹ️ Usage: /bulk <ban|unban|limit|unlimit> <user_id> [user_id ...]\n"
+            "For longer lists use 📋 Bulk Moderation in the admin panel and upload a file."
+        )
+        return
+    await AsyncDatabaseManager.log_command(update.effective_user.id, 'bulk')
+    await apply_bulk_moderation(update, context.args[0], " ".join(context.args[1:]))
+
 async def version_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /version command."""
     uptime = datetime.now() - START_TIME
@@ -778,16 +3280,16 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⛔ This command is restricted to administrators.")
         return
     
-    if (time_remaining := DatabaseManager.check_rate_limit(user.id, 'stats')):
+    if (time_remaining := RateLimiter.check(user.id, 'stats')):
         await update.message.reply_text(
             format_time_remaining(int(time_remaining.total_seconds()), 'stats')
         )
         return
     
-    DatabaseManager.log_command(user.id, 'stats')
-    DatabaseManager.update_rate_limit(user.id, 'stats')
+    await AsyncDatabaseManager.log_command(user.id, 'stats')
+    RateLimiter.hit(user.id, 'stats')
     
-    stats = DatabaseManager.get_global_stats()
+    stats = await AsyncDatabaseManager.get_global_stats()
     uptime = datetime.now() - START_TIME
     days, seconds = uptime.days, uptime.seconds
     hours = seconds // 3600
@@ -815,7 +3317,7 @@ async def user_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⛔ This command is restricted to administrators.")
         return
     
-    if (time_remaining := DatabaseManager.check_rate_limit(user.id, 'userinfo')):
+    if (time_remaining := RateLimiter.check(user.id, 'userinfo')):
         await update.message.reply_text(
             format_time_remaining(int(time_remaining.total_seconds()), 'userinfo')
         )
@@ -827,20 +3329,22 @@ async def user_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         target_id = int(context.args[0])
-        DatabaseManager.log_command(user.id, 'userinfo')
-        DatabaseManager.update_rate_limit(user.id, 'userinfo')
+        await AsyncDatabaseManager.log_command(user.id, 'userinfo')
+        RateLimiter.hit(user.id, 'userinfo')
         
-        stats = DatabaseManager.get_user_stats(target_id)
+        stats = await AsyncDatabaseManager.get_user_stats(target_id)
         
         if not stats:
             await update.message.reply_text("ℹ️ No data available for this user.")
             return
         
+        delivery = await AsyncDatabaseManager.get_delivery_status(target_id)
         info_message = (
             f"👤 USER INFO FOR {target_id}\n\n"
             f"🕒 First seen: {stats['first_seen']}\n"
             f"🕒 Last seen: {stats['last_seen']}\n"
             f"🔄 Total commands: {stats['total_commands']}\n"
+            f"📬 Delivery: {describe_delivery(delivery)}\n"
             f"\n📊 COMMAND USAGE:\n"
         )
         
@@ -851,48 +3355,316 @@ async def user_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Please enter a numeric ID.")
 
-def back_button_markup():
-    """Helper function to create back button markup"""
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back")]])
-
-def back_to_admin_markup():
-    """Helper function to create back to admin panel button markup"""
-    return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Admin", callback_data="adminpanel")]])
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /profile [on [sample_rate] [threshold_ms] | off | reset] for admins."""
+    user = update.effective_user
+    
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ This command is restricted to administrators.")
+        return
+    
+    action = context.args[0].lower() if context.args else "status"
+    if action == "on":
+        try:
+            sample_rate = float(context.args[1]) if len(context.args) > 1 else None
+            threshold_ms = float(context.args[2]) if len(context.args) > 2 else None
+        except ValueError:
+            await update.message.reply_text("ℹ️ Usage: /profile on [sample_rate 0-1] [threshold_ms]")
+            return
+        if sample_rate is not None and not 0 <= sample_rate <= 1:
+            await update.message.reply_text("❌ The sample rate must be between 0 and 1.")
+            return
+        Profiler.enable(sample_rate, threshold_ms / 1000 if threshold_ms is not None else None)
+    elif action == "off":
+        Profiler.disable()
+    elif action == "reset":
+        Profiler.reset()
+    elif action != "status":
+        await update.message.reply_text("ℹ️ Usage: /profile [on [sample_rate] [threshold_ms] | off | reset]")
+        return
+    
+    await AsyncDatabaseManager.log_command(user.id, 'profile')
+    await update.message.reply_text(f"🔬 PROFILING\n\n{Profiler.summary()}"[:4096])
 
-def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log errors and handle them gracefully."""
-    logger.error(msg="Exception while handling an update:", exc_info=context.error)
+    # An outage makes every update fail the same way; one traceback per window
+    # is enough. The raising frame is part of the key, so distinct bugs that
+    # happen to share an exception type are still all logged.
+    error = context.error
+    frames = traceback.extract_tb(error.__traceback__) if error is not None else []
+    origin = f"{frames[-1].name}:{frames[-1].lineno}" if frames else "unknown"
+    logger.error(msg="Exception while handling an update:", exc_info=error,
+                 extra={'aggregate': f"handler_error:{type(error).__name__}:{origin}"})
     
     if update and hasattr(update, 'effective_user'):
         user = update.effective_user
         try:
-            context.bot.send_message(
+            await context.bot.send_message(
                 chat_id=user.id,
                 text="❌ An error occurred. Please try again later."
             )
         except Exception:
             pass
 
-def main() -> None:
-    """Run the bot."""
-    # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+async def flush_writes_periodically() -> None:
+    """Commit buffered writes even when traffic is too low to fill a batch."""
+    while True:
+        await asyncio.sleep(WRITE_MAX_DELAY)
+        try:
+            await AsyncDatabaseManager.flush_writes()
+        except Exception as e:
+            logger.error(f"Periodic write flush failed: {e}")
+
+async def snapshot_rate_limits_periodically() -> None:
+    """Persist live cooldowns so a restart does not reset them."""
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SNAPSHOT_INTERVAL)
+        try:
+            await AsyncDatabaseManager.save_rate_limits(RateLimiter.snapshot())
+        except Exception as e:
+            logger.error(f"Rate limit snapshot failed: {e}")
+
+async def reconcile_stats_periodically() -> None:
+    """Correct counter drift and prune old per-day activity rows."""
+    while True:
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+        try:
+            await AsyncDatabaseManager.reconcile_stats()
+        except Exception as e:
+            logger.error(f"Stats reconciliation failed: {e}")
+
+async def rollup_commands_periodically() -> None:
+    """Keep the raw commands table bounded by folding old rows into rollups."""
+    while True:
+        await asyncio.sleep(COMMAND_ROLLUP_INTERVAL)
+        try:
+            # One batch per writer job so buffered flushes can interleave
+            folded = 0
+            while (batch := await AsyncDatabaseManager.rollup_commands()) >= COMMAND_ROLLUP_BATCH:
+                folded += batch
+            folded += batch
+            if folded:
+                logger.info(f"Rolled up {folded} command rows older than {COMMAND_RAW_RETENTION_DAYS} days")
+        except Exception as e:
+            logger.error(f"Command rollup failed: {e}")
+
+async def refresh_caches_periodically() -> None:
+    """Pick up settings and moderation changes made by other bot processes."""
+    while True:
+        await asyncio.sleep(CACHE_VERSION_CHECK_INTERVAL)
+        try:
+            await AsyncDatabaseManager.refresh_settings()
+            await AsyncDatabaseManager.refresh_moderation_state()
+        except Exception as e:
+            logger.error(f"Cache refresh failed: {e}")
+
+async def refresh_segment_summary_periodically() -> None:
+    """Keep the broadcast segment sizes at most SEGMENT_SUMMARY_TTL seconds old."""
+    while True:
+        await asyncio.sleep(SEGMENT_SUMMARY_TTL)
+        try:
+            await AsyncDatabaseManager.refresh_segment_summary()
+        except Exception as e:
+            logger.error(f"Segment summary refresh failed: {e}")
+
+async def flush_log_aggregates_periodically() -> None:
+    """Log how many repetitive records were suppressed, every LOG_AGGREGATE_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(LOG_AGGREGATE_INTERVAL)
+        LogAggregator.flush()
+
+async def dump_profile_periodically() -> None:
+    """Write the aggregated handler profile to disk while profiling is on."""
+    while True:
+        await asyncio.sleep(PROFILE_DUMP_INTERVAL)
+        if not Profiler.enabled:
+            continue
+        # On the loop thread: cProfile enables and disables per thread
+        try:
+            Profiler.dump()
+        except Exception as e:
+            logger.error(f"Writing the profile failed: {e}")
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Minimal HTTP/1.1 responder for GET /metrics."""
+    try:
+        request_line = (await reader.readline()).decode('latin-1').split()
+        # Skip the headers; nothing in them matters here
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", Metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def on_startup(application: Application) -> None:
+    """Start background tasks once the Application is initialized."""
+    tasks = [asyncio.create_task(flush_writes_periodically()),
+             asyncio.create_task(flush_log_aggregates_periodically())]
+    if PROFILE_DUMP_INTERVAL > 0:
+        tasks.append(asyncio.create_task(dump_profile_periodically()))
+    if SEGMENT_SUMMARY_TTL > 0:
+        tasks.append(asyncio.create_task(refresh_segment_summary_periodically()))
+    if CACHE_VERSION_CHECK_INTERVAL > 0:
+        tasks.append(asyncio.create_task(refresh_caches_periodically()))
+    if RATE_LIMIT_SNAPSHOT_INTERVAL > 0:
+        RateLimiter.restore(await AsyncDatabaseManager.load_rate_limits())
+        tasks.append(asyncio.create_task(snapshot_rate_limits_periodically()))
+    
+    # Database-wide maintenance and broadcast recovery run in one process only
+    if SHARD_INDEX == 0:
+        tasks.append(asyncio.create_task(reconcile_stats_periodically()))
+        tasks.append(asyncio.create_task(rollup_commands_periodically()))
+        if DatabaseManager._deferred_indexes:
+            tasks.append(asyncio.create_task(asyncio.to_thread(DatabaseManager.build_deferred_indexes)))
+    application.bot_data['background_tasks'] = tasks
+    
+    Metrics.gauge('bot_update_queue_depth', application.update_queue.qsize)
+    Metrics.gauge('bot_pending_writes',
+                  lambda: len(DatabaseManager._pending_users) + len(DatabaseManager._pending_commands))
+    Metrics.gauge('bot_active_broadcasts', lambda: len(BroadcastEngine._tasks))
+    Metrics.gauge('bot_uptime_seconds', lambda: round((datetime.now() - START_TIME).total_seconds()))
+    if METRICS_PORT > 0:
+        try:
+            application.bot_data['metrics_server'] = await asyncio.start_server(
+                serve_metrics, METRICS_HOST, METRICS_PORT + SHARD_INDEX
+            )
+        except OSError as e:
+            # E.g. another instance on this host has the port; run without it
+            logger.warning(f"Metrics endpoint on {METRICS_HOST}:{METRICS_PORT + SHARD_INDEX} "
+                           f"not started: {e}")
+    
+    if SHARD_INDEX == 0:
+        await BroadcastEngine.resume_jobs(application.bot)
+
+async def on_shutdown(application: Application) -> None:
+    """Stop background tasks and commit anything still buffered."""
+    BroadcastEngine.stop_all()
+    DatabaseManager.interrupt_index_builds()
+    for task in application.bot_data.get('background_tasks', []):
+        task.cancel()
+    if (metrics_server := application.bot_data.get('metrics_server')) is not None:
+        metrics_server.close()
+    if Profiler.enabled:
+        Profiler.dump()
+    LogAggregator.flush()
+    await AsyncDatabaseManager.flush_writes()
+    if RATE_LIMIT_SNAPSHOT_INTERVAL > 0:
+        await AsyncDatabaseManager.save_rate_limits(RateLimiter.snapshot())
+
+# Module setting each command-line option overrides, in this process and,
+# through run_sharded(), in every worker
+CLI_SETTINGS = {
+    'storage_profile': 'STORAGE_PROFILE',
+    'mode': 'UPDATE_MODE',
+    'listen': 'WEBHOOK_LISTEN',
+    'port': 'WEBHOOK_PORT',
+    'webhook_path': 'WEBHOOK_PATH',
+    'webhook_url': 'WEBHOOK_URL',
+    'secret_token': 'WEBHOOK_SECRET_TOKEN',
+    'metrics_port': 'METRICS_PORT',
+    'workers': 'WORKER_PROCESSES',
+    'api_url': 'BOT_API_BASE_URL',
+    'profile': 'PROFILING_ENABLED',
+    'log_format': 'LOG_FORMAT'
+}
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the Telegram bot.")
+    parser.add_argument("--storage-profile", choices=sorted(STORAGE_PROFILES), default=STORAGE_PROFILE,
+                        help="SQLite durability/speed trade-off (default: %(default)s)")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=UPDATE_MODE,
+                        help="how updates are received (default: %(default)s)")
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN, help="webhook server address (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT, help="webhook server port (default: %(default)s)")
+    parser.add_argument("--webhook-path", default=WEBHOOK_PATH,
+                        help="URL path the webhook server answers on (default: %(default)s)")
+    parser.add_argument("--webhook-url", default=WEBHOOK_URL,
+                        help="public HTTPS URL registered with Telegram, required in webhook mode")
+    parser.add_argument("--secret-token", default=WEBHOOK_SECRET_TOKEN,
+                        help="reject webhook requests without this X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Prometheus /metrics port, worker N uses port + N (default: %(default)s, 0 disables)")
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES,
+                        help="handle updates in N sharded worker processes (default: %(default)s, i.e. in-process)")
+    parser.add_argument("--api-url", default=BOT_API_BASE_URL,
+                        help="Bot API base URL, the token is appended (default: %(default)s)")
+    parser.add_argument("--profile", action="store_true", default=PROFILING_ENABLED,
+                        help="start with the slow-query log and handler sampling on (see /profile)")
+    parser.add_argument("--log-format", choices=["text", "json"], default=LOG_FORMAT,
+                        help="bot.log and stderr line format (default: %(default)s)")
+    args = parser.parse_args()
+    if args.mode == "webhook" and not args.webhook_url:
+        # PTB would otherwise register the --listen/--port address, which Telegram rejects
+        parser.error("--webhook-url is required with --mode webhook (the public HTTPS address Telegram calls)")
+    return args
+
+def settings_from_args(args: argparse.Namespace) -> Dict:
+    """The CLI_SETTINGS overrides that `args` resolved."""
+    return {CLI_SETTINGS[name]: value for name, value in vars(args).items()}
+
+def build_application(request: Optional[BaseRequest] = None, receive_updates: bool = True) -> Application:
+    """Create the Application with every handler registered.
+    
+    `request` replaces the HTTP backend for Bot API calls (benchmark.py
+    passes an in-process fake so the bot can run offline). Workers pass
+    receive_updates=False: their updates arrive from the front process.
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_BASE_URL)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if MAX_CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    if not receive_updates:
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(InstrumentedRequest(request))
+        if receive_updates:
+            builder = builder.get_updates_request(request)
+    else:
+        # getUpdates keeps PTB's own backend, so long polls never occupy this pool
+        builder = builder.request(InstrumentedRequest(
+            HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE, pool_timeout=POOL_TIMEOUT)
+        ))
+    application = builder.build()
 
     # Add error handler
     application.add_error_handler(error_handler)
 
+    # Attach the per-update user context before any other handler runs
+    application.add_handler(TypeHandler(Update, load_user_context), group=-1)
+    
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("version", version_command))
     application.add_handler(CommandHandler("stats", admin_stats_command, filters=filters.User(ADMIN_IDS)))
     application.add_handler(CommandHandler("userinfo", user_info_command, filters=filters.User(ADMIN_IDS)))
     application.add_handler(CommandHandler("cancel", cancel_action, filters=filters.User(ADMIN_IDS)))
+    application.add_handler(CommandHandler("profile", profile_command, filters=filters.User(ADMIN_IDS)))
+    application.add_handler(CommandHandler("bulk", bulk_command, filters=filters.User(ADMIN_IDS)))
     
     # Add message handlers
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_IDS),
         handle_admin_action
     ))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.User(ADMIN_IDS), handle_bulk_file))
     
     # Add message handler for feedback
     application.add_handler(MessageHandler(
@@ -901,15 +3673,173 @@ def main() -> None:
     ))
     
     # Add callback query handler
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(callback_router.dispatch))
     
-    # Run the bot
+    # Time every handler; the callback router also times each route
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_callback(handler.callback.__qualname__, handler.callback)
+    
+    return application
+
+def run_application(application: Application, args: argparse.Namespace) -> None:
+    """Receive updates for `application` by polling or webhook until stopped."""
     logger.info("Starting bot...")
-    application.run_polling()
+    if args.mode == "webhook":
+        # Same handlers and lifecycle hooks; only the update source differs
+        logger.info(f"Receiving updates on http://{args.listen}:{args.port}/{args.webhook_path} "
+                    f"for {args.webhook_url}")
+        application.run_webhook(
+            listen=args.listen,
+            port=args.port,
+            url_path=args.webhook_path,
+            webhook_url=args.webhook_url,
+            secret_token=args.secret_token or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        application.run_polling()
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Front process: hand the update to the worker that owns its user."""
+    shard_queues = context.bot_data['shard_queues']
+    user = update.effective_user
+    shard_queue = shard_queues[user.id % len(shard_queues) if user else 0]
+    data = update.to_dict()
+    try:
+        shard_queue.put_nowait(data)
+    except queue.Full:
+        # Backpressure: wait for the worker without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(None, shard_queue.put, data)
+
+async def serve_shard(updates: ProcessQueue, request_factory: Optional[Callable[[], BaseRequest]],
+                      ready: Optional[ProcessEvent]) -> None:
+    """Feed updates from the front process into this worker's Application."""
+    application = build_application(
+        request=request_factory() if request_factory else None,
+        receive_updates=False
+    )
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    if ready is not None:
+        ready.set()
+    
+    loop = asyncio.get_running_loop()
+    while (data := await loop.run_in_executor(None, updates.get)) is not None:
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        # Drain whatever else is queued without another thread hop
+        try:
+            while (data := updates.get_nowait()) is not None:
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        except queue.Empty:
+            continue
+        break
+    
+    # Let the fetcher pick up every routed update while still running: with
+    # concurrent processing, stop() only awaits updates dispatched before it
+    await application.update_queue.join()
+    await application.stop()
+    await on_shutdown(application)
+    await application.shutdown()
+
+def run_worker(shard: int, shard_count: int, updates: ProcessQueue, overrides: Optional[Dict] = None,
+               request_factory: Optional[Callable[[], BaseRequest]] = None,
+               ready: Optional[ProcessEvent] = None, log_queue: Optional[ProcessQueue] = None) -> None:
+    """Worker process entry point: handle the updates routed to `shard` until a None arrives.
+    
+    `overrides` are module settings to apply first; spawned processes
+    re-import this module with its defaults. Log records go to `log_queue`,
+    written by the front process.
+    """
+    global SHARD_INDEX, SHARD_COUNT
+    # Ctrl+C reaches the whole process group; the front stops workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    globals().update(overrides or {})
+    setup_logging(log_queue, listen=log_queue is None)
+    SHARD_INDEX, SHARD_COUNT = shard, shard_count
+    if PROFILING_ENABLED:
+        Profiler.enable()
+    DatabaseManager.close_connection()
+    DatabaseManager.init_db()
+    
+    asyncio.run(serve_shard(updates, request_factory, ready))
+    AsyncDatabaseManager.shutdown()
+    DatabaseManager.flush_writes()
+    DatabaseManager.close_connection()
+    logger.info(f"Worker {shard} stopped")
+
+def start_workers(count: int, overrides: Optional[Dict] = None,
+                  request_factory: Optional[Callable[[], BaseRequest]] = None
+                  ) -> Tuple[List[multiprocessing.Process], List[ProcessQueue]]:
+    """Spawn `count` workers and wait until each is ready for updates."""
+    # Spawn rather than fork: forked children would inherit open SQLite handles
+    mp_context = multiprocessing.get_context("spawn")
+    shard_queues = [mp_context.Queue(WORKER_QUEUE_SIZE) for _ in range(count)]
+    ready = [mp_context.Event() for _ in range(count)]
+    # Only this process writes (and rotates) the log file; workers queue to it
+    log_queue = mp_context.Queue(LOG_QUEUE_SIZE)
+    setup_logging(log_queue)
+    workers = [
+        mp_context.Process(
+            target=run_worker,
+            args=(shard, count, shard_queues[shard], overrides, request_factory, ready[shard], log_queue),
+            name=f"bot-worker-{shard}"
+        )
+        for shard in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker, event in zip(workers, ready):
+        while not event.wait(1):
+            if not worker.is_alive():
+                raise RuntimeError(f"{worker.name} exited during startup")
+    return workers, shard_queues
+
+def stop_workers(workers: List[multiprocessing.Process], shard_queues: List[ProcessQueue]) -> None:
+    """Let every worker finish its queued updates, then wait for it to exit."""
+    for shard_queue in shard_queues:
+        shard_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+def run_sharded(args: argparse.Namespace) -> None:
+    """Receive updates here and handle them in args.workers worker processes."""
+    workers, shard_queues = start_workers(args.workers, settings_from_args(args))
+    logger.info(f"Started {len(workers)} worker processes")
+    
+    # Routing stays sequential so each worker receives a user's updates in order
+    application = Application.builder().token(BOT_TOKEN).base_url(BOT_API_BASE_URL).build()
+    application.bot_data['shard_queues'] = shard_queues
+    application.add_error_handler(error_handler)
+    application.add_handler(TypeHandler(Update, route_update))
+    try:
+        run_application(application, args)
+    finally:
+        stop_workers(workers, shard_queues)
+
+def main() -> None:
+    """Run the bot."""
+    args = parse_args()
+    # Workers get the same overrides, see run_sharded()
+    globals().update(settings_from_args(args))
+    setup_logging()
+    if PROFILING_ENABLED:
+        Profiler.enable()
+    logger.info(f"Using SQLite storage profile '{STORAGE_PROFILE}'")
+    
+    # Workers migrate and load the database themselves
+    if args.workers > 0:
+        run_sharded(args)
+    else:
+        DatabaseManager.init_db()
+        run_application(build_application(), args)
     
-    # Close database connection when bot stops
+    # Drain the DB threads, commit buffered writes and close every connection
+    AsyncDatabaseManager.shutdown()
+    DatabaseManager.flush_writes()
     DatabaseManager.close_connection()
     logger.info("Bot stopped")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
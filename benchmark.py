@@ -0,0 +1,1543 @@
+"""Benchmarks for Bot.py.
+
+Every scenario runs against a throwaway database in a temporary working
+directory, so the real bot_database.db and bot.log are never touched.
+--db PATH keeps a seeded database between runs instead (seeding 1M users
+and 50M commands takes several minutes, so CI should cache the file).
+
+In CI, the queryplan scenario and a loadtest with --max-p95 exit non-zero
+on a regression:
+
+    python benchmark.py queryplan
+    python benchmark.py loadtest --users 100000 --commands 1000000 --interactions 5000 --max-p95 50
+
+Usage:
+    python benchmark.py latency [--users N] [--commands N] [--rate R] [--duration S]
+    python benchmark.py loadtest [--users N] [--commands N] [--interactions N] [--concurrency N]
+                                 [--admins N] [--max-p95 MS] [--db PATH]
+    python benchmark.py writes [--users N] [--interactions N]
+    python benchmark.py logging [--interactions N]    (4 x --interactions log calls per run)
+    python benchmark.py ratelimit [--users N] [--interactions N]
+    python benchmark.py broadcast [--users N] [--send-rate R] [--api-latency S]
+    python benchmark.py stats [--users N] [--commands N]
+    python benchmark.py queryplan            (exits 1 if a hot query scans a table)
+    python benchmark.py rollup [--users N] [--commands N]
+    python benchmark.py webhook [--users N] [--rate R] [--duration S]
+    python benchmark.py e2e [--mode polling|webhook] [--users N] [--rate R] [--duration S]
+                            [--flood-rate R] [--blocked-every N]
+    python benchmark.py sharding [--interactions N] [--workers N]
+    python benchmark.py concurrency [--users N] [--rate R] [--duration S] [--api-latency S]
+                                    (--rate capped at twice what one-at-a-time handling keeps up with)
+    python benchmark.py render [--users N] [--interactions N]
+    python benchmark.py callbacks [--interactions N]
+    python benchmark.py segments [--users N]
+    python benchmark.py feedback [--users N] [--commands N] [--interactions N]
+                                 (--commands feedback rows, --interactions / 10 pages walked)
+    python benchmark.py metrics [--interactions N]
+    python benchmark.py migrations [--users N] [--commands N]   (at least MIGRATION_BACKGROUND_ROWS of each)
+    python benchmark.py moderation [--users N] [--interactions N]   (--interactions IDs per bulk action)
+    python benchmark.py profiling [--users N] [--commands N] [--interactions N]
+    python benchmark.py storage [--users N] [--commands N] [--interactions N] [--rate R] [--duration S]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+# Bot.py opens its database and log file relative to the working directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+LAUNCH_DIR = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bot-bench-"))
+
+import Bot  # noqa: E402
+import httpx  # noqa: E402
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update  # noqa: E402
+from telegram.error import Forbidden, RetryAfter  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+from fake_bot_api import FakeBotAPIServer  # noqa: E402
+
+# One INFO line per HTTP request would drown the results
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name: str, samples: List[float], elapsed: float) -> None:
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{name:<24} n={len(ms):<7} {len(ms) / elapsed:>9.1f}/s  "
+        f"p50={percentile(ms, 50):7.2f}ms  p95={percentile(ms, 95):7.2f}ms  "
+        f"p99={percentile(ms, 99):7.2f}ms  max={max(ms, default=0):7.2f}ms"
+    )
+
+
+class FakeBot:
+    """Stand-in for telegram.Bot that records calls instead of hitting the network."""
+
+    def __init__(self, latency: float = 0.0, blocked_every: int = 0, flood_every: int = 0):
+        self.latency = latency
+        self.blocked_every = blocked_every
+        self.flood_every = flood_every
+        self.calls: List[tuple] = []
+        self._message_id = 0
+
+    async def _call(self, method: str, **kwargs):
+        self.calls.append((method, kwargs))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        n = len(self.calls)
+        if self.flood_every and n % self.flood_every == 0:
+            raise RetryAfter(1)
+        # Chats whose id is a multiple of blocked_every have blocked the bot
+        if self.blocked_every and method == "sendMessage" and kwargs['chat_id'] % self.blocked_every == 0:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self._message_id += 1
+        return SimpleNamespace(message_id=self._message_id, chat_id=kwargs.get('chat_id'))
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        return await self._call("sendMessage", chat_id=chat_id, text=text, **kwargs)
+
+    async def edit_message_text(self, text: str, chat_id: Optional[int] = None, message_id: Optional[int] = None,
+                                **kwargs):
+        return await self._call("editMessageText", chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+    async def answer_callback_query(self, callback_query_id: str, **kwargs):
+        return await self._call("answerCallbackQuery", callback_query_id=callback_query_id, **kwargs)
+
+
+class FakeBotAPI(BaseRequest):
+    """HTTP backend for a real Application that answers Bot API calls in-process."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[tuple] = []
+        self.sent: Dict[int, asyncio.Future] = {}
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        """Future resolved when the bot next sends a message to `chat_id`."""
+        self.sent[chat_id] = asyncio.get_running_loop().create_future()
+        return self.sent[chat_id]
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         **kwargs) -> tuple:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getMe":
+            result = {'id': 1, 'is_bot': True, 'first_name': "Benchmark", 'username': "benchmark_bot"}
+        elif endpoint == "getUpdates":
+            await asyncio.sleep(1)
+            result = []
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            self._message_id += 1
+            chat_id = int(params.get('chat_id', 0))
+            result = {'message_id': self._message_id, 'date': int(time.time()), 'text': params.get('text', ""),
+                      'chat': {'id': chat_id, 'type': "private"}}
+            future = self.sent.pop(chat_id, None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def fake_api_factory() -> FakeBotAPI:
+    """Request backend for worker processes (must be picklable, hence module level)."""
+    return FakeBotAPI()
+
+
+def make_command_update(update_id: int, user_id: int, command: str = "/start") -> Dict:
+    """Update JSON for a private-chat command, as Telegram would POST it."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': "private"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'language_code': "en"},
+            'text': command,
+            'entities': [{'type': "bot_command", 'offset': 0, 'length': len(command.split()[0])}]
+        }
+    }
+
+
+def seed_database(users: int, commands: int) -> None:
+    """Fill the current DATABASE_FILE with synthetic users and command rows.
+    
+    Rows are generated inside SQLite with the stats triggers dropped, which
+    loads tens of millions of commands in minutes; the triggers are then
+    recreated and reconcile_stats() recomputes the counters. A database that
+    already has users (a --db kept between runs) is left as it is.
+    """
+    conn = Bot.DatabaseManager.get_connection()
+    if conn.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+        return
+    started = time.perf_counter()
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    with conn:
+        for name, _ in triggers:
+            conn.execute(f'DROP TRIGGER {name}')
+        conn.execute('''
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < :users)
+            INSERT OR IGNORE INTO users (user_id, username, first_name, language_code, is_premium, last_seen)
+            SELECT n, 'user' || n, 'User ' || n,
+                CASE abs(random()) % 4 WHEN 0 THEN 'en' WHEN 1 THEN 'ru' WHEN 2 THEN 'es' ELSE 'de' END,
+                abs(random()) % 20 = 0,
+                datetime('now', 'localtime', '-' || (abs(random()) % 5184000) || ' seconds')
+            FROM seq WHERE n <= :users
+        ''', {'users': users})
+        # Oldest first, as the bot would have logged them over the last 30 days
+        conn.execute('''
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < :commands)
+            INSERT INTO commands (user_id, command, timestamp)
+            SELECT abs(random()) % :users + 1,
+                CASE abs(random()) % 6 WHEN 0 THEN 'start' WHEN 1 THEN 'terms' WHEN 2 THEN 'privacy'
+                    WHEN 3 THEN 'version' WHEN 4 THEN 'feedback' ELSE 'back' END,
+                datetime('now', '-' || ((:commands - n) * 2592000 / :commands) || ' seconds')
+            FROM seq WHERE n <= :commands
+        ''', {'users': users, 'commands': commands})
+        for _, sql in triggers:
+            conn.execute(sql)
+    Bot.DatabaseManager.reconcile_stats()
+    if users + commands >= 1_000_000:
+        print(f"seeded {users} users and {commands} commands in {time.perf_counter() - started:.1f}s")
+
+
+class BaselineStorage:
+    """The queries one /start (or one admin /stats) made before storage moved
+    off the event loop: blocking, on a plain connection with SQLite's default
+    pragmas, committing after every write and counting the stats from scratch.
+    """
+    
+    _connection: Optional[sqlite3.Connection] = None
+    
+    @classmethod
+    def get_connection(cls) -> sqlite3.Connection:
+        if cls._connection is None:
+            cls._connection = sqlite3.connect(Bot.DATABASE_FILE)
+            cls._connection.row_factory = sqlite3.Row
+        return cls._connection
+    
+    @classmethod
+    def close_connection(cls) -> None:
+        if cls._connection is not None:
+            cls._connection.close()
+            cls._connection = None
+    
+    @classmethod
+    def start(cls, user_id: int) -> None:
+        conn = cls.get_connection()
+        # check_rate_limit, then is_banned
+        row = conn.execute('SELECT last_used FROM rate_limits WHERE user_id = ? AND command = ?',
+                           (user_id, "start")).fetchone()
+        if row:
+            datetime.fromisoformat(row['last_used'])
+        conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        cls.record_start(user_id)
+        # get_setting, then is_banned and is_limited for the status line
+        conn.execute('SELECT setting_value FROM bot_settings WHERE setting_name = ?', ("welcome_message",)).fetchone()
+        conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    
+    @classmethod
+    def record_start(cls, user_id: int) -> None:
+        """update_user, log_command and update_rate_limit, one commit each."""
+        conn = cls.get_connection()
+        conn.execute('''
+            INSERT OR REPLACE INTO users (
+                user_id, username, first_name, last_name, language_code,
+                is_premium, is_bot, last_seen, is_banned, is_limited
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, f"user{user_id}", None, None, None, 0, 0, datetime.now().isoformat(' '), 0, 0))
+        conn.commit()
+        conn.execute('INSERT INTO commands (user_id, command) VALUES (?, ?)', (user_id, "start"))
+        conn.commit()
+        conn.execute('INSERT OR REPLACE INTO rate_limits (user_id, command, last_used) VALUES (?, ?, ?)',
+                     (user_id, "start", datetime.now().isoformat(' ')))
+        conn.commit()
+    
+    @classmethod
+    def get_global_stats(cls) -> Dict:
+        conn = cls.get_connection()
+        return {
+            'total_users': conn.execute('SELECT COUNT(*) FROM users').fetchone()[0],
+            'active_today': conn.execute('''
+                SELECT COUNT(DISTINCT user_id) FROM commands WHERE DATE(timestamp) = DATE('now')
+            ''').fetchone()[0],
+            'total_commands': conn.execute('SELECT COUNT(*) FROM commands').fetchone()[0],
+            'banned_users': conn.execute('SELECT COUNT(*) FROM users WHERE is_banned = 1').fetchone()[0],
+            'limited_users': conn.execute('SELECT COUNT(*) FROM users WHERE is_limited = 1').fetchone()[0],
+            'feedback_count': conn.execute('SELECT COUNT(*) FROM feedback').fetchone()[0]
+        }
+
+
+async def simulate_update(mode: str, user_id: int, heavy: bool) -> None:
+    """Replay the storage calls that one /start (or one admin /stats) makes.
+    
+    "sync" is the original bot (BaselineStorage), "async" the current one.
+    """
+    if mode == "sync":
+        if heavy:
+            BaselineStorage.get_global_stats()
+        else:
+            BaselineStorage.start(user_id)
+        return
+    if heavy:
+        await Bot.AsyncDatabaseManager.get_global_stats()
+        return
+    Bot.RateLimiter.check(user_id, "start")
+    Bot.DatabaseManager.is_banned(user_id)
+    await Bot.AsyncDatabaseManager.update_user({'user_id': user_id, 'username': f"user{user_id}"})
+    await Bot.AsyncDatabaseManager.log_command(user_id, "start")
+    Bot.RateLimiter.hit(user_id, "start")
+    Bot.DatabaseManager.get_setting("welcome_message")
+    Bot.DatabaseManager.is_limited(user_id)
+
+
+async def run_latency(mode: str, users: int, rate: float, duration: float, heavy_every: int) -> Dict:
+    """Fire updates at a fixed rate and measure arrival-to-reply latency."""
+    rng = random.Random(7)
+    latencies: List[float] = []
+    tasks = []
+
+    async def one(arrival: float, user_id: int, heavy: bool) -> None:
+        await simulate_update(mode, user_id, heavy)
+        if not heavy:
+            latencies.append(time.perf_counter() - arrival)
+
+    started = time.perf_counter()
+    sent = 0
+    while (now := time.perf_counter()) - started < duration:
+        due = int((now - started) * rate)
+        while sent < due:
+            heavy = heavy_every > 0 and sent % heavy_every == 0
+            arrival = started + sent / rate
+            tasks.append(asyncio.create_task(one(arrival, rng.randint(1, users), heavy)))
+            sent += 1
+        await asyncio.sleep(0.001)
+    await asyncio.gather(*tasks)
+    return {'samples': latencies, 'elapsed': time.perf_counter() - started}
+
+
+def latency_scenario(args: argparse.Namespace) -> None:
+    seed_database(args.users, args.commands)
+    for mode in ("sync", "async"):
+        result = asyncio.run(run_latency(mode, args.users, args.rate, args.duration, args.heavy_every))
+        report(f"latency/{mode}", result['samples'], result['elapsed'])
+        if mode == "sync":
+            # INSERT OR REPLACE re-fires the user insert triggers; fix the counters
+            BaselineStorage.close_connection()
+            Bot.DatabaseManager.reconcile_stats()
+    Bot.AsyncDatabaseManager.shutdown()
+
+
+def run_writes(users: int, interactions: int, batch_size: int) -> float:
+    """Apply the writes of `interactions` /start calls and return interactions/sec.
+    
+    A batch size of 0 replays the original bot's writes (BaselineStorage).
+    """
+    rng = random.Random(11)
+    if not batch_size:
+        started = time.perf_counter()
+        for _ in range(interactions):
+            BaselineStorage.record_start(rng.randint(1, users))
+        elapsed = time.perf_counter() - started
+        BaselineStorage.close_connection()
+        Bot.DatabaseManager.reconcile_stats()
+        return interactions / elapsed
+    Bot.WRITE_BATCH_SIZE = batch_size
+    started = time.perf_counter()
+    for _ in range(interactions):
+        user_id = rng.randint(1, users)
+        Bot.DatabaseManager.update_user({'user_id': user_id, 'username': f"user{user_id}"})
+        Bot.DatabaseManager.log_command(user_id, "start")
+        Bot.RateLimiter.hit(user_id, "start")
+    Bot.DatabaseManager.flush_writes()
+    return interactions / (time.perf_counter() - started)
+
+
+def writes_scenario(args: argparse.Namespace) -> None:
+    default_batch = Bot.WRITE_BATCH_SIZE
+    for label, batch_size in (("original", 0), ("commit-per-write", 1), (f"batched({default_batch})", default_batch)):
+        throughput = run_writes(args.users, args.interactions, batch_size)
+        print(f"writes/{label:<20} {throughput:>10.1f} interactions/s")
+    Bot.WRITE_BATCH_SIZE = default_batch
+    
+    # Another process holds the write lock: after one failed flush, writes
+    # only buffer (up to the cap) until a flush succeeds again
+    profile = Bot.STORAGE_PROFILES[Bot.STORAGE_PROFILE]
+    default_timeout, default_cap = profile['busy_timeout'], Bot.WRITE_BUFFER_MAX_COMMANDS
+    profile['busy_timeout'], Bot.WRITE_BUFFER_MAX_COMMANDS = 200, args.interactions // 4
+    Bot.DatabaseManager.flush_writes()
+    commands_before = Bot.DatabaseManager.get_connection().execute('SELECT COUNT(*) FROM commands').fetchone()[0]
+    locker = sqlite3.connect(Bot.DATABASE_FILE, isolation_level=None)
+    locker.execute('BEGIN IMMEDIATE')
+    rng = random.Random(5)
+    samples = []
+    started = time.perf_counter()
+    for _ in range(args.interactions):
+        user_id = rng.randint(1, args.users)
+        call_started = time.perf_counter()
+        Bot.DatabaseManager.update_user({'user_id': user_id})
+        Bot.DatabaseManager.log_command(user_id, "start")
+        samples.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    buffered = len(Bot.DatabaseManager._pending_commands)
+    locker.rollback()
+    locker.close()
+    Bot.DatabaseManager.flush_writes()
+    logged = Bot.DatabaseManager.get_connection().execute('SELECT COUNT(*) FROM commands').fetchone()[0] - commands_before
+    profile['busy_timeout'], Bot.WRITE_BUFFER_MAX_COMMANDS = default_timeout, default_cap
+    report("writes/database locked", samples, elapsed)
+    print(f"writes/database locked     {buffered} of {args.interactions} command logs buffered, {logged} committed after")
+    if sorted(samples)[-2] > 0.05 or logged != buffered or buffered > args.interactions // 4:
+        sys.exit("writes: a locked database blocked more than one write, or the buffer outgrew its cap")
+
+
+def ratelimit_scenario(args: argparse.Namespace) -> None:
+    rng = random.Random(3)
+    user_ids = [rng.randint(1, args.users) for _ in range(args.interactions)]
+    started = time.perf_counter()
+    for user_id in user_ids:
+        if Bot.RateLimiter.check(user_id, "start") is None:
+            Bot.RateLimiter.hit(user_id, "start")
+    elapsed = time.perf_counter() - started
+    live = sum(map(len, Bot.RateLimiter._deadlines.values()))
+    print(f"ratelimit/check+hit        {elapsed / len(user_ids) * 1e6:>8.2f}us per call, {live} live entries")
+    
+    # A long cooldown hit first must not keep later, shorter ones from expiring
+    default_cooldown = Bot.RATE_LIMITS['start']
+    Bot.RATE_LIMITS['start'] = timedelta(milliseconds=10)
+    Bot.RateLimiter._deadlines.clear()
+    Bot.RateLimiter.hit(1, "broadcast")
+    for user_id in user_ids:
+        Bot.RateLimiter.hit(user_id, "start")
+    time.sleep(0.02)
+    Bot.RateLimiter.hit(1, "start")
+    live = sum(map(len, Bot.RateLimiter._deadlines.values()))
+    Bot.RATE_LIMITS['start'] = default_cooldown
+    Bot.RateLimiter._deadlines.clear()
+    print(f"ratelimit/mixed cooldowns  {live} live entries after the short ones expired")
+    if live != 2:
+        sys.exit("ratelimit: expired cooldowns were kept behind a longer one")
+
+
+async def run_broadcast(bot: FakeBot, admin_id: int) -> float:
+    job = await Bot.BroadcastEngine.start_job(bot, admin_id, "📢 Announcement:\n\nbenchmark")
+    started = time.perf_counter()
+    await Bot.BroadcastEngine._tasks[job['job_id']]
+    return time.perf_counter() - started
+
+
+def broadcast_scenario(args: argparse.Namespace) -> None:
+    """Send rate of a full broadcast, then a second one that skips the chats the first found blocked."""
+    seed_database(args.users, 0)
+    if args.send_rate:
+        Bot.BROADCAST_GLOBAL_RATE = args.send_rate
+    bot = FakeBot(latency=args.api_latency, blocked_every=50)
+    elapsed = asyncio.run(run_broadcast(bot, Bot.ADMIN_IDS[0]))
+    sends = sum(1 for method, _ in bot.calls if method == "sendMessage")
+    print(f"broadcast/{args.users} users     {args.users / elapsed:>9.1f} msg/s "
+          f"({sends} API calls, global limit {Bot.BROADCAST_GLOBAL_RATE}/s, "
+          f"{Bot.BROADCAST_SENDERS} senders, {args.api_latency * 1000:.0f}ms API latency)")
+    
+    # Blocked chats are skipped next time, until the user sends /start again;
+    # the upsert ban_user makes for an unknown ID does not count as one
+    revived, unknown = 50, (args.users // 50 + 1) * 50
+    Bot.DatabaseManager.record_undeliverable([(unknown, Bot.DELIVERY_BLOCKED)])
+    Bot.DatabaseManager.ban_user(unknown)
+    Bot.DatabaseManager.update_user({'user_id': revived})
+    Bot.DatabaseManager.revive_delivery(revived)
+    Bot.DatabaseManager.flush_writes()
+    rows = Bot.DatabaseManager.get_connection().execute('SELECT COUNT(*) FROM delivery_status').fetchone()[0]
+    bot = FakeBot(latency=args.api_latency, blocked_every=50)
+    asyncio.run(run_broadcast(bot, Bot.ADMIN_IDS[0]))
+    Bot.AsyncDatabaseManager.shutdown()
+    recipients = [kwargs['chat_id'] for method, kwargs in bot.calls if method == "sendMessage"]
+    blocked = sum(1 for chat_id in recipients if chat_id % 50 == 0)
+    print(f"broadcast/repeat            {len(recipients) - sends:+d} API calls "
+          f"({blocked} to blocked chats, the one revived by /start), {rows} delivery_status rows")
+    if blocked != 1 or revived not in recipients:
+        sys.exit("broadcast: repeat broadcast did not skip blocked chats or revive the returning user")
+    if rows != args.users // 50:
+        sys.exit(f"broadcast: {rows} delivery_status rows, expected one per blocked chat")
+
+
+def stats_scenario(args: argparse.Namespace) -> None:
+    seed_database(args.users, args.commands)
+    samples = []
+    started = time.perf_counter()
+    for _ in range(200):
+        call_started = time.perf_counter()
+        Bot.DatabaseManager.get_global_stats()
+        samples.append(time.perf_counter() - call_started)
+    report(f"stats/{args.commands} commands", samples, time.perf_counter() - started)
+
+
+async def run_webhook(users: int, rate: float, duration: float, api_latency: float = 0.0) -> Dict:
+    """POST /start updates to the embedded webhook server and time each reply.
+    
+    Replies may lag behind the posts by up to `duration` plus 30 seconds.
+    """
+    api = FakeBotAPI(latency=api_latency)
+    application = Bot.build_application(request=api)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    secret = "benchmark-secret"
+    url = f"http://127.0.0.1:{port}/{Bot.WEBHOOK_PATH}"
+    
+    await application.initialize()
+    await application.updater.start_webhook(listen="127.0.0.1", port=port, url_path=Bot.WEBHOOK_PATH,
+                                            secret_token=secret, max_connections=Bot.WEBHOOK_MAX_CONNECTIONS)
+    await application.start()
+    latencies: List[float] = []
+    
+    async with httpx.AsyncClient() as client:
+        rejected = await client.post(url, json=make_command_update(0, 1))
+        if rejected.status_code != 403:
+            sys.exit(f"webhook accepted an update without the secret token ({rejected.status_code})")
+        
+        async def one(update_id: int, user_id: int) -> None:
+            reply = api.expect_reply(user_id)
+            posted = time.perf_counter()
+            response = await client.post(url, json=make_command_update(update_id, user_id),
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+            response.raise_for_status()
+            latencies.append(await asyncio.wait_for(reply, duration + 30) - posted)
+        
+        tasks = []
+        started = time.perf_counter()
+        sent = 0
+        while (now := time.perf_counter()) - started < duration:
+            while sent < int((now - started) * rate):
+                sent += 1
+                # Distinct users (while sent <= users) so the /start cooldown never applies
+                tasks.append(asyncio.create_task(one(sent, (sent - 1) % users + 1)))
+            await asyncio.sleep(0.001)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return {'samples': latencies, 'elapsed': elapsed}
+
+
+def webhook_scenario(args: argparse.Namespace) -> None:
+    seed_database(args.users, 0)
+    result = asyncio.run(run_webhook(args.users, args.rate, args.duration))
+    report("webhook/start", result['samples'], result['elapsed'])
+    Bot.AsyncDatabaseManager.shutdown()
+
+
+async def check_update_order(users: int, per_user: int, limit: int) -> int:
+    """Run interleaved updates through PerUserUpdateProcessor; return peak concurrency."""
+    processor = Bot.PerUserUpdateProcessor(limit)
+    rng = random.Random(13)
+    handled: Dict[int, List[int]] = {}
+    running = peak = 0
+
+    async def handle(user_id: int, seq: int) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(rng.random() * 0.01)
+        handled.setdefault(user_id, []).append(seq)
+        running -= 1
+
+    tasks = []
+    for seq in range(per_user):
+        for user_id in range(1, users + 1):
+            update = Update.de_json(make_command_update(seq * users + user_id, user_id), None)
+            tasks.append(asyncio.create_task(processor.process_update(update, handle(user_id, seq))))
+    await asyncio.gather(*tasks)
+    if any(order != list(range(per_user)) for order in handled.values()):
+        sys.exit("concurrency: a user's updates were handled out of order")
+    if peak > limit:
+        sys.exit(f"concurrency: {peak} updates ran at once, limit is {limit}")
+    return peak
+
+
+def concurrency_scenario(args: argparse.Namespace) -> None:
+    peak = asyncio.run(check_update_order(50, 10, Bot.MAX_CONCURRENT_UPDATES))
+    print(f"concurrency/ordering        per-user order kept, peak {peak}/{Bot.MAX_CONCURRENT_UPDATES} concurrent")
+    seed_database(args.users, 0)
+    # Twice what handling one update per API round trip keeps up with: the
+    # sequential run falls behind by about `duration` seconds but finishes
+    rate = min(args.rate, 2 / args.api_latency) if args.api_latency else args.rate
+    default_limit = Bot.MAX_CONCURRENT_UPDATES
+    p50s = []
+    for run, limit in enumerate((1, default_limit)):
+        Bot.MAX_CONCURRENT_UPDATES = limit
+        # Both runs use the same users; forget the first run's /start cooldowns
+        Bot.RateLimiter._deadlines.clear()
+        result = asyncio.run(run_webhook(args.users, rate, args.duration, args.api_latency))
+        report(f"concurrency/{limit} at once, {rate:.0f}/s", result['samples'], result['elapsed'])
+        p50s.append(sorted(result['samples'])[len(result['samples']) // 2])
+    Bot.MAX_CONCURRENT_UPDATES = default_limit
+    Bot.AsyncDatabaseManager.shutdown()
+    if p50s[1] >= p50s[0]:
+        sys.exit("concurrency: concurrent handling was no faster than sequential")
+
+
+def sharding_scenario(args: argparse.Namespace) -> None:
+    """Push the same /start load through 1..N worker processes and compare throughput."""
+    database = os.path.abspath(Bot.DATABASE_FILE)
+    conn = Bot.DatabaseManager.get_connection()
+    counts = [1]
+    while counts[-1] * 2 <= args.workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != args.workers:
+        counts.append(args.workers)
+    print(f"sharding: {os.cpu_count()} CPUs available")
+    
+    baseline = None
+    for run, count in enumerate(counts):
+        # Fresh users per run so restored /start cooldowns never apply
+        first_user = run * args.interactions + 1
+        updates = [make_command_update(i + 1, first_user + i) for i in range(args.interactions)]
+        logged_before = conn.execute("SELECT COUNT(*) FROM commands WHERE command = 'start'").fetchone()[0]
+        
+        workers, shard_queues = Bot.start_workers(count, {'DATABASE_FILE': database}, fake_api_factory)
+        started = time.perf_counter()
+        for update in updates:
+            # Same routing as Bot.route_update
+            shard_queues[update['message']['from']['id'] % count].put(update)
+        Bot.stop_workers(workers, shard_queues)
+        throughput = args.interactions / (time.perf_counter() - started)
+        
+        logged = conn.execute("SELECT COUNT(*) FROM commands WHERE command = 'start'").fetchone()[0] - logged_before
+        if logged != args.interactions:
+            sys.exit(f"sharding/{count}: {logged} of {args.interactions} updates were handled")
+        baseline = baseline or throughput
+        print(f"sharding/{count} workers      {throughput:>9.1f} updates/s  ({throughput / baseline:.2f}x)")
+
+
+def make_callback_update(update_id: int, user_id: int, data: str) -> Dict:
+    """Update JSON for an inline button press on a message the bot sent."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'language_code': "en"}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': user,
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'text': "menu", 'from': user,
+                        'chat': {'id': user_id, 'type': "private"}}
+        }
+    }
+
+
+async def run_callbacks(presses: int) -> None:
+    api = FakeBotAPI()
+    application = Bot.build_application(request=api)
+    await application.initialize()
+    admin_id, user_id = Bot.ADMIN_IDS[0], 424242
+    
+    async def press(update_id: int, from_id: int, data: str) -> str:
+        await application.process_update(Update.de_json(make_callback_update(update_id, from_id, data),
+                                                        application.bot))
+        return next((params['text'] for endpoint, params in reversed(api.calls)
+                     if endpoint == "editMessageText"), "")
+    
+    # Every route answers admins; admin_only routes refuse everyone else
+    update_id = 0
+    for name, route in Bot.callback_router.routes.items():
+        admin_only = route['admin_only']
+        for from_id in (admin_id, user_id):
+            update_id += 1
+            Bot.RateLimiter._deadlines.clear()
+            text = await press(update_id, from_id, name)
+            denied = text == "⛔ Access denied."
+            if denied != (admin_only and from_id != admin_id):
+                sys.exit(f"callbacks/{name}: unexpected reply for user {from_id}: {text!r}")
+    print(f"callbacks/routes           {len(Bot.callback_router.routes)} routes checked for admin and user")
+    
+    # Clients can send any callback data, so an unexpected param must not raise
+    errors_before = sum(Bot.Metrics._counters.get('bot_handler_errors_total', {}).values())
+    for name in Bot.callback_router.routes:
+        update_id += 1
+        Bot.RateLimiter._deadlines.clear()
+        await press(update_id, admin_id, f"{name}:1")
+    errors = sum(Bot.Metrics._counters.get('bot_handler_errors_total', {}).values()) - errors_before
+    if errors:
+        sys.exit(f"callbacks: {errors:g} handler errors on callback data with an unexpected param")
+    
+    samples = []
+    started = time.perf_counter()
+    for _ in range(presses):
+        update_id += 1
+        call_started = time.perf_counter()
+        await press(update_id, user_id, "terms")
+        samples.append(time.perf_counter() - call_started)
+    report("callbacks/terms press", samples, time.perf_counter() - started)
+    await application.shutdown()
+
+
+def callbacks_scenario(args: argparse.Namespace) -> None:
+    asyncio.run(run_callbacks(args.interactions))
+    Bot.AsyncDatabaseManager.shutdown()
+
+
+def make_text_update(update_id: int, user_id: int, text: str) -> Dict:
+    """Update JSON for a plain private-chat text message (feedback or admin input)."""
+    update = make_command_update(update_id, user_id, text)
+    del update['message']['entities']
+    return update
+
+
+# Sessions the load test replays, as (kind, text or callback data) steps sent
+# by one user in order. "{target}" is replaced with a random seeded user.
+USER_SESSIONS = {
+    'start': [("command", "/start")],
+    'version': [("command", "/version")],
+    'buttons': [("command", "/start"), ("callback", "terms"), ("callback", "back"),
+                ("callback", "privacy"), ("callback", "version"), ("callback", "back")],
+    'feedback': [("callback", "feedback"), ("text", "Load test feedback")],
+}
+ADMIN_SESSIONS = {
+    'stats': [("command", "/stats"), ("callback", "adminpanel"), ("callback", "adminstats")],
+    'userinfo': [("command", "/userinfo {target}"), ("callback", "userlookup"), ("text", "{target}")],
+    'moderation': [("callback", "banuser"), ("text", "{target}"), ("callback", "unbanuser"), ("text", "{target}"),
+                   ("callback", "limituser"), ("text", "{target}"), ("callback", "unlimituser"),
+                   ("text", "{target}")],
+}
+SESSION_WEIGHTS = {'start': 40, 'version': 10, 'buttons': 25, 'feedback': 10, 'stats': 5, 'userinfo': 5,
+                   'moderation': 5}
+
+
+async def run_loadtest(users: int, updates: int, concurrency: int, admins: int) -> Dict:
+    """Replay weighted user and admin sessions through a real Application.
+    
+    Each session is one user's steps in order; `concurrency` sessions run
+    at once. Returns per-kind update latencies and the handler error count.
+    """
+    rng = random.Random(17)
+    admin_ids = [10 ** 12 + i for i in range(admins)]
+    Bot.ADMIN_IDS.extend(admin_ids)
+    api = FakeBotAPI()
+    application = Bot.build_application(request=api)
+    await application.initialize()
+    flusher = asyncio.create_task(Bot.flush_writes_periodically())
+    errors_before = sum(Bot.Metrics._counters.get('bot_handler_errors_total', {}).values())
+    
+    kinds = list(SESSION_WEIGHTS)
+    plan = []
+    planned = 0
+    while planned < updates:
+        kind = rng.choices(kinds, weights=[SESSION_WEIGHTS[k] for k in kinds])[0]
+        user_id = rng.choice(admin_ids) if kind in ADMIN_SESSIONS else rng.randint(1, users)
+        plan.append((kind, user_id, rng.randint(1, users)))
+        planned += len(USER_SESSIONS.get(kind) or ADMIN_SESSIONS[kind])
+    sessions = iter(plan)
+    samples: Dict[str, List[float]] = {kind: [] for kind in kinds}
+    update_ids = iter(range(1, planned + 1))
+    
+    async def replay() -> None:
+        for kind, user_id, target in sessions:
+            for step, payload in USER_SESSIONS.get(kind) or ADMIN_SESSIONS[kind]:
+                payload = payload.replace("{target}", str(target))
+                update_id = next(update_ids)
+                if step == "callback":
+                    data = make_callback_update(update_id, user_id, payload)
+                elif step == "text":
+                    data = make_text_update(update_id, user_id, payload)
+                else:
+                    data = make_command_update(update_id, user_id, payload)
+                update = Update.de_json(data, application.bot)
+                started = time.perf_counter()
+                # Through the per-user processor, as Application.start() would
+                await application.update_processor.process_update(update, application.process_update(update))
+                samples[kind].append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(replay() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    flusher.cancel()
+    await Bot.AsyncDatabaseManager.flush_writes()
+    await application.shutdown()
+    errors = sum(Bot.Metrics._counters.get('bot_handler_errors_total', {}).values()) - errors_before
+    del Bot.ADMIN_IDS[-admins:]
+    return {'samples': samples, 'elapsed': elapsed, 'errors': errors, 'api_calls': len(api.calls)}
+
+
+def loadtest_scenario(args: argparse.Namespace) -> None:
+    """Handlers end to end over a seeded database; with --max-p95 this is a CI gate."""
+    seed_database(args.users, args.commands)
+    result = asyncio.run(run_loadtest(args.users, args.interactions, args.concurrency, args.admins))
+    Bot.AsyncDatabaseManager.shutdown()
+    elapsed = result['elapsed']
+    failures = []
+    for kind, samples in result['samples'].items():
+        report(f"loadtest/{kind}", samples, elapsed)
+        p95 = percentile(samples, 95) * 1000
+        if args.max_p95 and p95 > args.max_p95:
+            failures.append(f"{kind} p95 {p95:.2f}ms > {args.max_p95:g}ms")
+    report("loadtest/all", [s for samples in result['samples'].values() for s in samples], elapsed)
+    print(f"loadtest: {result['api_calls']} Bot API calls, {result['errors']:g} handler errors")
+    if result['errors']:
+        failures.append(f"{result['errors']:g} handler errors")
+    if failures:
+        sys.exit("loadtest regression: " + "; ".join(failures))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_e2e(args: argparse.Namespace) -> FakeBotAPIServer:
+    """The whole bot over HTTP: PTB's own HTTPX backend against fake_bot_api."""
+    server = FakeBotAPIServer(args.users, flood_rate=args.flood_rate, blocked_every=args.blocked_every)
+    api_port = free_port()
+    await server.start(port=api_port)
+    Bot.BOT_API_BASE_URL = f"http://127.0.0.1:{api_port}/bot"
+    application = Bot.build_application()
+    await application.initialize()
+    if args.mode == "webhook":
+        port = free_port()
+        await application.updater.start_webhook(
+            listen="127.0.0.1", port=port, url_path=Bot.WEBHOOK_PATH,
+            webhook_url=f"http://127.0.0.1:{port}/{Bot.WEBHOOK_PATH}", secret_token="benchmark",
+            max_connections=Bot.WEBHOOK_MAX_CONNECTIONS
+        )
+    else:
+        await application.updater.start_polling(poll_interval=0)
+    await application.start()
+    await server.connected.wait()
+    await server.inject(args.rate, args.duration)
+    await server.drain(10)
+    elapsed = time.perf_counter() - server.started
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await server.close()
+    report(f"e2e/{args.mode}", server.latencies, elapsed)
+    return server
+
+
+def e2e_scenario(args: argparse.Namespace) -> None:
+    """HTTP-level throughput of polling or webhook mode, optionally with 429/403 answers."""
+    server = asyncio.run(run_e2e(args))
+    Bot.AsyncDatabaseManager.shutdown()
+    print(server.report())
+    if server.unanswered and not args.flood_rate:
+        sys.exit(f"e2e: {server.unanswered} updates were never answered")
+
+
+async def run_metrics(updates: int) -> str:
+    """Handle /start updates with metrics on, then scrape the endpoint."""
+    Bot.METRICS_PORT = free_port()
+    application = Bot.build_application(request=FakeBotAPI())
+    await application.initialize()
+    await Bot.on_startup(application)
+    for update_id in range(1, updates + 1):
+        await application.process_update(Update.de_json(make_command_update(update_id, update_id),
+                                                        application.bot))
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"http://127.0.0.1:{Bot.METRICS_PORT}/metrics")
+        response.raise_for_status()
+    await Bot.on_shutdown(application)
+    await application.shutdown()
+    return response.text
+
+
+def metrics_scenario(args: argparse.Namespace) -> None:
+    """Cost of recording a sample, and a scrape after real updates."""
+    calls = 200_000
+    started = time.perf_counter()
+    for _ in range(calls):
+        Bot.Metrics.observe('benchmark_seconds', 'method', "noop", 0.003)
+    print(f"metrics/observe            {(time.perf_counter() - started) / calls * 1e6:>8.2f}us per sample")
+    
+    get_setting = Bot.DatabaseManager.get_setting
+    raw_get_setting = get_setting.__func__.__wrapped__
+    for label, call in (("raw", lambda: raw_get_setting(Bot.DatabaseManager, 'welcome_message')),
+                        ("instrumented", lambda: get_setting('welcome_message'))):
+        started = time.perf_counter()
+        for _ in range(calls):
+            call()
+        print(f"metrics/get_setting {label:<12} {(time.perf_counter() - started) / calls * 1e6:>5.2f}us per call")
+    
+    text = asyncio.run(run_metrics(args.interactions))
+    expected = f'bot_handler_seconds_count{{handler="start"}} {args.interactions}'
+    if expected not in text:
+        sys.exit(f"metrics: scrape is missing {expected!r}")
+    print(f"metrics/scrape             {len(text.splitlines())} lines, {len(text)} bytes")
+    summary = Bot.Metrics.summary()
+    print(summary)
+    # Counters that are not errors stay out of the summary's error count
+    Bot.Metrics.inc('bot_broadcast_undeliverable_total', 'status', "blocked")
+    if Bot.Metrics.summary() != summary:
+        sys.exit("metrics: the summary counted a non-error counter as an error")
+    Bot.AsyncDatabaseManager.shutdown()
+
+
+def profiling_scenario(args: argparse.Namespace) -> None:
+    """Per-query cost of the profiling hooks when off and on, and a sampled run of /start."""
+    seed_database(args.users, args.commands)
+    rng = random.Random(19)
+    user_ids = [rng.randint(1, args.users) for _ in range(2000)]
+    # Keep the log quiet: nothing here should cross an hour-long threshold
+    for label, enable in (("off", False), ("on", True)):
+        if enable:
+            Bot.Profiler.enable(0.0, 3600)
+        started = time.perf_counter()
+        for user_id in user_ids:
+            Bot.DatabaseManager.get_user_stats(user_id)
+        print(f"profiling/{label:<4} get_user_stats {(time.perf_counter() - started) / len(user_ids) * 1e6:>8.2f}us")
+    
+    Bot.Profiler.enable(0.05, 0.0)
+    Bot.DatabaseManager.get_user_stats(user_ids[0])
+    if not Bot.Profiler._slow_queries:
+        sys.exit("profiling: a zero threshold logged no queries")
+    Bot.Profiler.enable(0.05, 3600)
+    
+    async def run() -> None:
+        application = Bot.build_application(request=FakeBotAPI())
+        await application.initialize()
+        samples = []
+        started = time.perf_counter()
+        for update_id in range(1, args.interactions + 1):
+            update = Update.de_json(make_command_update(update_id, rng.randint(1, args.users)), application.bot)
+            call_started = time.perf_counter()
+            await application.process_update(update)
+            samples.append(time.perf_counter() - call_started)
+        report("profiling/start sampled", samples, time.perf_counter() - started)
+        await application.shutdown()
+    
+    asyncio.run(run())
+    Bot.AsyncDatabaseManager.shutdown()
+    path = Bot.Profiler.disable()
+    print(f"profiling: {Bot.Profiler.sampled} handler calls sampled into {path}")
+
+
+async def walk_feedback_pages(pages: int) -> Dict:
+    """Page older through the admin viewer, then back newer, via real callback updates."""
+    api = FakeBotAPI()
+    application = Bot.build_application(request=api)
+    await application.initialize()
+    admin_id = Bot.ADMIN_IDS[0]
+    update_id = 0
+    
+    async def press(data: str) -> tuple:
+        nonlocal update_id
+        update_id += 1
+        await application.process_update(Update.de_json(make_callback_update(update_id, admin_id, data),
+                                                        application.bot))
+        params = next(params for endpoint, params in reversed(api.calls) if endpoint == "editMessageText")
+        buttons = {button['callback_data'].split(":")[1]: button['callback_data']
+                   for row in params.get('reply_markup', {}).get('inline_keyboard', [])
+                   for button in row if button['callback_data'].startswith("feedbackpage:")}
+        return re.findall(r"^#(\d+) ", params['text'], re.M), params['text'], buttons
+    
+    walk = {'older': [], 'newer': [], 'samples': [], 'longest': 0}
+    data = "viewfeedback"
+    for direction in ("older", "newer"):
+        for _ in range(pages):
+            started = time.perf_counter()
+            ids, text, buttons = await press(data)
+            walk['samples'].append(time.perf_counter() - started)
+            walk[direction].append(ids)
+            walk['longest'] = max(walk['longest'], Bot.message_length(text))
+            if direction not in buttons:
+                break
+            data = buttons[direction]
+        # Turn around at the page we stopped on
+        data = buttons.get("newer", data)
+    await application.shutdown()
+    return walk
+
+
+def feedback_scenario(args: argparse.Namespace) -> None:
+    """Keyset paging: same page cost at any depth, pages that fit a message, and a consistent walk."""
+    seed_database(args.users, 0)
+    conn = Bot.DatabaseManager.get_connection()
+    started = time.perf_counter()
+    with conn:
+        # Many entries share a timestamp, and every 50th is longer than a whole message
+        conn.execute('''
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < :rows)
+            INSERT INTO feedback (user_id, message, timestamp)
+            SELECT abs(random()) % :users + 1,
+                CASE WHEN n % 50 = 0 THEN printf('%.5000c', 'x') ELSE 'Feedback ' || n END,
+                datetime('now', '-' || ((:rows - n) / 3) || ' seconds')
+            FROM seq WHERE n <= :rows
+        ''', {'rows': args.commands, 'users': args.users})
+    print(f"feedback/seed  {args.commands} rows in {time.perf_counter() - started:.1f}s")
+    
+    rng = random.Random(20)
+    for label, cursor in (("newest", None), ("deepest", 1), ("random", None)):
+        samples = []
+        started = time.perf_counter()
+        for _ in range(1000):
+            older_than = rng.randint(1, args.commands) if label == "random" else cursor
+            call_started = time.perf_counter()
+            Bot.DatabaseManager.get_feedback(Bot.FEEDBACK_PAGE_SIZE + 1, older_than)
+            samples.append(time.perf_counter() - call_started)
+        report(f"feedback/page {label}", samples, time.perf_counter() - started)
+    
+    walk = asyncio.run(walk_feedback_pages(args.interactions // 10))
+    Bot.AsyncDatabaseManager.shutdown()
+    report("feedback/page press", walk['samples'], sum(walk['samples']))
+    older = [feedback_id for page in walk['older'] for feedback_id in page]
+    expected = [str(row[0]) for row in conn.execute(
+        'SELECT feedback_id FROM feedback ORDER BY timestamp DESC, feedback_id DESC LIMIT ?', (len(older),)
+    )]
+    print(f"feedback/walk  {len(walk['older'])} pages older, {len(walk['newer'])} back, "
+          f"longest page {walk['longest']} of {Bot.MESSAGE_MAX_LENGTH}")
+    if older != expected:
+        sys.exit("feedback: paging older skipped or repeated entries")
+    # Page boundaries can shift on the way back (pages are filled from the
+    # cursor outward), but the entries must be the same ones, in order
+    newer = [feedback_id for page in reversed(walk['newer']) for feedback_id in page]
+    if newer != older[:len(older) - len(walk['older'][-1])]:
+        sys.exit("feedback: paging back newer skipped or repeated entries")
+    if walk['longest'] > Bot.MESSAGE_MAX_LENGTH:
+        sys.exit("feedback: a page exceeded Telegram's message limit")
+
+
+SEGMENTS = [
+    {'language': 'en'},
+    {'premium': True},
+    {'active_days': 7},
+    {'language': 'ru', 'premium': False, 'active_days': 30},
+    {'language': 'de', 'active_days': 1, 'include_banned': True},
+]
+
+
+def segments_scenario(args: argparse.Namespace) -> None:
+    """Summary refresh cost, picker sizes against exact counts, and chunked recipient streaming."""
+    seed_database(args.users, 0)
+    with Bot.DatabaseManager.get_connection() as conn:
+        conn.execute('UPDATE users SET is_banned = 1 WHERE user_id % 97 = 0')
+    Bot.DatabaseManager.record_undeliverable(
+        [(user_id, Bot.DELIVERY_BLOCKED) for user_id in range(89, args.users + 1, 89)]
+    )
+    samples = []
+    started = time.perf_counter()
+    for _ in range(5):
+        call_started = time.perf_counter()
+        summary = Bot.DatabaseManager.refresh_segment_summary()
+        samples.append(time.perf_counter() - call_started)
+    report(f"segments/summary {args.users} users ({len(summary['rows'])} rows)",
+           samples, time.perf_counter() - started)
+    
+    mismatches = 0
+    for segment in SEGMENTS:
+        started = time.perf_counter()
+        exact = Bot.DatabaseManager.count_segment(segment)
+        count_time = time.perf_counter() - started
+        estimate = Bot.segment_size(summary, segment)
+        chunks = []
+        streamed, cursor_user_id = 0, 0
+        started = time.perf_counter()
+        while True:
+            chunk_started = time.perf_counter()
+            recipients = Bot.DatabaseManager.get_broadcast_recipients(cursor_user_id, Bot.BROADCAST_CHUNK_SIZE,
+                                                                      segment)
+            chunks.append(time.perf_counter() - chunk_started)
+            if not recipients:
+                break
+            streamed += len(recipients)
+            cursor_user_id = recipients[-1]
+        stream_time = time.perf_counter() - started
+        # last_seen moves on while the scenario runs, so allow a user or two at the window edge
+        if streamed != exact or abs(estimate - exact) > 2:
+            mismatches += 1
+        print(f"segments/{Bot.encode_segment(segment):<14} {exact:>8} users  picker {estimate:>8}  "
+              f"count {count_time * 1000:>7.1f}ms  stream {stream_time * 1000:>7.1f}ms "
+              f"(chunk p50 {percentile(chunks, 50) * 1000:.2f}ms p99 {percentile(chunks, 99) * 1000:.2f}ms)")
+    if mismatches:
+        sys.exit(f"segments: {mismatches} segments streamed or summarised a different audience")
+
+
+async def run_bulk_command(action: str, user_ids: List[int]) -> List[tuple]:
+    """Send /bulk through a real Application and return the Bot API calls it made."""
+    api = FakeBotAPI()
+    application = Bot.build_application(request=api)
+    await application.initialize()
+    text = f"/bulk {action} " + " ".join(map(str, user_ids))
+    await application.process_update(Update.de_json(make_command_update(1, Bot.ADMIN_IDS[0], text),
+                                                    application.bot))
+    await application.shutdown()
+    return api.calls
+
+
+def moderation_scenario(args: argparse.Namespace) -> None:
+    """Per-ID ban_user calls against one bulk_moderate transaction, and the /bulk report."""
+    seed_database(args.users, 0)
+    rng = random.Random(23)
+    loop_ids = rng.sample(range(1, args.users + 1), 1000)
+    started = time.perf_counter()
+    for user_id in loop_ids:
+        Bot.DatabaseManager.ban_user(user_id)
+    per_id = (time.perf_counter() - started) / len(loop_ids)
+    print(f"moderation/ban_user loop     {per_id * 1e6:>8.1f}us per ID")
+    
+    # A spam wave with already banned users, unknown accounts and an admin mixed in
+    unknown = list(range(args.users + 1, args.users + 1001))
+    wave = rng.sample(range(1, args.users + 1), args.interactions) + loop_ids[:100] + unknown + Bot.ADMIN_IDS
+    for action in ("ban", "unban"):
+        started = time.perf_counter()
+        outcomes = Bot.DatabaseManager.bulk_moderate(action, wave)
+        elapsed = time.perf_counter() - started
+        counts = ", ".join(f"{len(ids)} {outcome}" for outcome, ids in outcomes.items() if ids)
+        print(f"moderation/bulk {action:<5} {len(wave)} IDs {elapsed / len(wave) * 1e6:>8.1f}us per ID ({counts})")
+        targets = list({user_id for user_id in wave if user_id not in Bot.ADMIN_IDS})
+        in_memory = sum(Bot.DatabaseManager.is_banned(user_id) for user_id in targets)
+        stored = Bot.DatabaseManager.get_connection().execute(
+            'SELECT COUNT(*) FROM users WHERE is_banned = 1 AND user_id IN (SELECT value FROM json_each(?))',
+            (json.dumps(targets),)
+        ).fetchone()[0]
+        expected = len(targets) if action == "ban" else 0
+        if in_memory != stored or stored != expected or any(map(Bot.DatabaseManager.is_banned, Bot.ADMIN_IDS)):
+            sys.exit(f"moderation: bulk {action} left {stored} banned in the DB, {in_memory} in memory, "
+                     f"expected {expected}")
+    
+    # Stray characters int() rejects even though str.isdigit() accepts them
+    calls = asyncio.run(run_bulk_command("limit", wave[:500] + ["spam", "²", "9" * 20]))
+    report = next(params['text'] for endpoint, params in calls if endpoint == "sendMessage")
+    documents = [endpoint for endpoint, _ in calls if endpoint == "sendDocument"]
+    print(f"moderation//bulk limit      {len(report)} chars, {len(documents)} CSV attachment(s)")
+    if not documents or "3 invalid entries" not in report:
+        sys.exit("moderation: /bulk did not report every outcome")
+
+
+class SlowStream:
+    """stderr stand-in that takes `delay` seconds per write, like a stalled terminal or log pipe."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def write(self, text: str) -> None:
+        time.sleep(self.delay)
+
+    def flush(self) -> None:
+        pass
+
+
+def time_log_calls(count: int, **kwargs) -> List[float]:
+    samples = []
+    for n in range(count):
+        started = time.perf_counter()
+        Bot.logger.error(f"Failed to send broadcast to {n}: Forbidden: bot was blocked by the user", **kwargs)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def logging_scenario(args: argparse.Namespace) -> None:
+    """Caller-side cost of an error log, written inline vs queued, plus rotation, JSON lines and aggregation.
+    
+    stderr takes 1ms per write here, as when the terminal or the pipe to a
+    log collector stalls; inline handlers make the event loop wait that out.
+    """
+    count = args.interactions * 4
+    root = logging.getLogger()
+    stderr, sys.stderr = sys.stderr, SlowStream(0.001)
+    try:
+        # What logging.basicConfig set up before: both handlers on the calling thread
+        Bot.stop_logging()
+        queued_handlers = root.handlers[:]
+        for handler in queued_handlers:
+            root.removeHandler(handler)
+        inline = [logging.FileHandler("inline.log"), logging.StreamHandler()]
+        for handler in inline:
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+            root.addHandler(handler)
+        samples = time_log_calls(count // 20)
+        report("logging/inline file+stderr", samples, sum(samples))
+        for handler in inline:
+            root.removeHandler(handler)
+            handler.close()
+        
+        Bot.LOG_FILE, Bot.LOG_FORMAT, Bot.LOG_MAX_BYTES = "queued.log", "json", 256 * 1024
+        Bot.setup_logging()
+        samples = time_log_calls(count)
+        report("logging/queued", samples, sum(samples))
+        samples = time_log_calls(count, extra={'aggregate': 'broadcast_send'})
+        report("logging/queued aggregated", samples, sum(samples))
+        Bot.LogAggregator.flush()
+        Bot.stop_logging()
+    finally:
+        sys.stderr = stderr
+    
+    files = sorted(name for name in os.listdir(".") if name.startswith("queued.log"))
+    lines = []
+    for name in files:
+        with open(name, encoding="utf-8") as log_file:
+            lines += [json.loads(line) for line in log_file]
+    summary = [line for line in lines if "suppressed" in line['msg']]
+    largest = max(os.path.getsize(name) for name in files)
+    dropped = sum(Bot.Metrics._counters.get('bot_log_records_dropped_total', {}).values())
+    print(f"logging/rotation        {len(files)} files, largest {largest // 1024} KB, "
+          f"{len(lines)} JSON lines kept, {dropped:.0f} dropped while stderr lagged")
+    if len(files) > Bot.LOG_BACKUP_COUNT + 1 or largest > Bot.LOG_MAX_BYTES:
+        sys.exit("logging: bot.log was not rotated")
+    if len(summary) != 1 or not summary[0]['msg'].startswith(f"{count - 1} more 'broadcast_send'"):
+        sys.exit("logging: aggregated errors were not folded into one summary line")
+    Bot.setup_logging()
+
+
+def schema(conn) -> List[tuple]:
+    return conn.execute("SELECT type, name, sql FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' "
+                        "ORDER BY type, name").fetchall()
+
+
+def migrations_scenario(args: argparse.Namespace) -> None:
+    """Import time, startup on a current and an outdated schema, and writes during a background index build.
+    
+    Seeds at least MIGRATION_BACKGROUND_ROWS users and commands, so upgrading
+    the outdated schema defers its index builds.
+    """
+    import_times = []
+    import_dir = tempfile.mkdtemp(prefix="bot-import-")
+    for _ in range(5):
+        output = subprocess.run(
+            [sys.executable, "-c", "import time; import telegram.ext, httpx; started = time.perf_counter(); "
+                                   "import Bot; print(time.perf_counter() - started)"],
+            cwd=import_dir, env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))},
+            capture_output=True, text=True, check=True
+        ).stdout
+        import_times.append(float(output))
+    report("migrations/import Bot", import_times, sum(import_times))
+    if os.listdir(import_dir):
+        sys.exit("migrations: importing Bot touched the database or the log file")
+    
+    started = time.perf_counter()
+    Bot.DatabaseManager.init_db()
+    print(f"migrations/fresh database      {(time.perf_counter() - started) * 1000:>8.1f}ms "
+          f"(schema version {len(Bot.MIGRATIONS)})")
+    conn = Bot.DatabaseManager.get_connection()
+    expected = schema(conn)
+    users = max(args.users, Bot.MIGRATION_BACKGROUND_ROWS)
+    commands = max(args.commands, Bot.MIGRATION_BACKGROUND_ROWS)
+    seed_database(users, commands)
+    samples = []
+    for _ in range(20):
+        started = time.perf_counter()
+        Bot.DatabaseManager.init_db()
+        samples.append(time.perf_counter() - started)
+    report(f"migrations/startup, current schema ({users} users)", samples, sum(samples))
+    
+    # A database from before the first background step, without any of
+    # the indexes those steps create
+    first_step = next(n for n, step in enumerate(Bot.MIGRATIONS) if step.get('background'))
+    with conn:
+        for step in Bot.MIGRATIONS[first_step:]:
+            for statement in step['sql'] if step.get('background') else []:
+                conn.execute(f"DROP INDEX {Bot.index_name(statement)}")
+        conn.execute(f"PRAGMA user_version = {first_step}")
+    started = time.perf_counter()
+    Bot.DatabaseManager.init_db()
+    print(f"migrations/startup, outdated   {(time.perf_counter() - started) * 1000:>8.1f}ms "
+          f"({len(Bot.DatabaseManager._deferred_indexes)} indexes deferred)")
+    
+    # /start writes and admin bans stay responsive while the indexes build;
+    # whatever could not be committed meanwhile is once the build is done
+    builder = threading.Thread(target=Bot.DatabaseManager.build_deferred_indexes)
+    commands_before = conn.execute('SELECT COUNT(*) FROM commands').fetchone()[0]
+    started = time.perf_counter()
+    builder.start()
+    writes, flushes, bans = [], [], []
+    user_id = 0
+    while builder.is_alive():
+        for _ in range(100):
+            user_id = user_id % users + 1
+            write_started = time.perf_counter()
+            Bot.DatabaseManager.update_user({'user_id': user_id})
+            Bot.DatabaseManager.log_command(user_id, "start")
+            writes.append(time.perf_counter() - write_started)
+        flush_started = time.perf_counter()
+        Bot.DatabaseManager.flush_writes()
+        flushes.append(time.perf_counter() - flush_started)
+        ban_started = time.perf_counter()
+        try:
+            Bot.DatabaseManager.ban_user(user_id)
+        except sqlite3.OperationalError:
+            pass
+        bans.append(time.perf_counter() - ban_started)
+        time.sleep(0.01)
+    builder.join()
+    Bot.DatabaseManager.flush_writes()
+    logged = conn.execute('SELECT COUNT(*) FROM commands').fetchone()[0] - commands_before
+    print(f"migrations/background build   {time.perf_counter() - started:>8.1f}s, "
+          f"{len(writes)} writes (slowest {max(writes) * 1000:.0f}ms), "
+          f"{len(flushes)} flushes (slowest {max(flushes) * 1000:.0f}ms), "
+          f"{len(bans)} bans (slowest {max(bans) * 1000:.0f}ms)")
+    if logged != len(writes):
+        sys.exit(f"migrations: {logged} of {len(writes)} commands logged during the build were committed")
+    if schema(conn) != expected or conn.execute('PRAGMA user_version').fetchone()[0] != len(Bot.MIGRATIONS):
+        sys.exit("migrations: the migrated schema differs from a fresh one")
+
+
+def legacy_render_profile(user, user_context: Dict) -> tuple:
+    """The per-call string building and keyboard construction render_profile replaced."""
+    welcome_message = Bot.DatabaseManager.get_setting('welcome_message')
+    user_details = f"{welcome_message}\n\nUSER DETAILS:\n\n"
+    user_details += f"🆔 User ID: {user.id}\n"
+    user_details += f"👤 Username: @{user.username}\n" if user.username else "👤 Username: Not set\n"
+    user_details += f"📛 First Name: {user.first_name}\n" if user.first_name else "📛 First Name: Not set\n"
+    user_details += f"📛 Last Name: {user.last_name}\n" if user.last_name else "📛 Last Name: Not set\n"
+    user_details += f"🌐 Language: {user.language_code}\n" if user.language_code else "🌐 Language: Not set\n"
+    user_details += f"💎 Premium: {'Yes' if getattr(user, 'is_premium', False) else 'No'}\n"
+    user_details += f"🤖 Bot: {'Yes' if user.is_bot else 'No'}\n"
+    user_status = "❌ Banned" if user_context['is_banned'] else (
+                 "⚠️ Limited" if user_context['is_limited'] else "✅ Active")
+    user_details += f"🔒 Status: {user_status}\n"
+    keyboard = [
+        [InlineKeyboardButton("📜 Terms", callback_data="terms"),
+         InlineKeyboardButton("🔏 Privacy", callback_data="privacy")],
+        [InlineKeyboardButton("ℹ️ Bot Info", callback_data="version"),
+         InlineKeyboardButton("💬 Feedback", callback_data="feedback")]
+    ]
+    if user.id in Bot.ADMIN_IDS:
+        keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="adminpanel")])
+    return user_details, InlineKeyboardMarkup(keyboard)
+
+
+def render_scenario(args: argparse.Namespace) -> None:
+    """Time and allocation per /start render, old inline building vs render_profile."""
+    rng = random.Random(17)
+    profiles = []
+    for user_id in range(1, min(args.users, Bot.PROFILE_RENDER_CACHE_SIZE) + 1):
+        user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}",
+                               last_name=None, language_code="en", is_premium=False, is_bot=False)
+        profiles.append((user, Bot.build_user_context(user)))
+    calls = [rng.choice(profiles) for _ in range(args.interactions)]
+    if legacy_render_profile(*calls[0])[0] != Bot.render_profile(*calls[0])[0]:
+        sys.exit("render: render_profile text differs from the original")
+    
+    for label, render in (("inline", legacy_render_profile), ("render_profile", Bot.render_profile)):
+        started = time.perf_counter()
+        for user, user_context in calls:
+            render(user, user_context)
+        per_call = (time.perf_counter() - started) / len(calls)
+        
+        # Memory each rendered reply holds until it is sent (caches are already warm)
+        tracemalloc.start()
+        replies = [render(user, user_context) for user, user_context in calls[:1000]]
+        allocated = tracemalloc.get_traced_memory()[0] / len(replies)
+        tracemalloc.stop()
+        del replies
+        print(f"render/{label:<16} {per_call * 1e6:>8.2f}us per render, {allocated:>8.0f} bytes allocated per render")
+
+
+def use_database(path: str) -> None:
+    """Point Bot at a fresh database file, reopening every connection."""
+    Bot.DatabaseManager.flush_writes()
+    Bot.DatabaseManager.close_connection()
+    Bot.DATABASE_FILE = path
+    Bot.DatabaseManager.init_db()
+
+
+def storage_scenario(args: argparse.Namespace) -> None:
+    """Compare STORAGE_PROFILES on commit-per-write and mixed /start + stats traffic."""
+    default_profile = Bot.STORAGE_PROFILE
+    default_batch = Bot.WRITE_BATCH_SIZE
+    for profile in Bot.STORAGE_PROFILES:
+        Bot.STORAGE_PROFILE = profile
+        use_database(f"storage-{profile}.db")
+        seed_database(args.users, args.commands)
+        throughput = run_writes(args.users, args.interactions, 1)
+        Bot.WRITE_BATCH_SIZE = default_batch
+        print(f"storage/{profile:<10} commit-per-write {throughput:>10.1f} interactions/s")
+        result = asyncio.run(run_latency("async", args.users, args.rate, args.duration, args.heavy_every))
+        report(f"storage/{profile} mixed", result['samples'], result['elapsed'])
+    Bot.AsyncDatabaseManager.shutdown()
+    Bot.STORAGE_PROFILE = default_profile
+
+
+def rollup_scenario(args: argparse.Namespace) -> None:
+    """Fold a month of seeded commands and compare raw rows and stats latency."""
+    seed_database(args.users, args.commands)
+    conn = Bot.DatabaseManager.get_connection()
+    rng = random.Random(5)
+    user_ids = [rng.randint(1, args.users) for _ in range(500)]
+    before = Bot.DatabaseManager.get_user_stats(user_ids[0])
+    
+    def measure(label: str) -> None:
+        raw = conn.execute('SELECT COUNT(*) FROM commands').fetchone()[0]
+        rollups = conn.execute('SELECT COUNT(*) FROM command_rollups').fetchone()[0]
+        samples = []
+        started = time.perf_counter()
+        for user_id in user_ids:
+            call_started = time.perf_counter()
+            Bot.DatabaseManager.get_user_stats(user_id)
+            samples.append(time.perf_counter() - call_started)
+        report(f"rollup/{label} user stats", samples, time.perf_counter() - started)
+        print(f"rollup/{label:<6} {raw} raw rows, {rollups} rollup rows")
+    
+    measure("before")
+    started = time.perf_counter()
+    folded = 0
+    while (batch := Bot.DatabaseManager.rollup_commands()) >= Bot.COMMAND_ROLLUP_BATCH:
+        folded += batch
+    folded += batch
+    print(f"rollup/fold   {folded} rows in {time.perf_counter() - started:.2f}s")
+    measure("after")
+    Bot.DatabaseManager.reconcile_stats()
+    if Bot.DatabaseManager.get_user_stats(user_ids[0])['commands'] != before['commands']:
+        sys.exit("rollup changed get_user_stats results")
+    if Bot.DatabaseManager.get_global_stats()['total_commands'] != args.commands:
+        sys.exit("rollup changed the reconciled command total")
+
+
+# DatabaseManager calls on the per-update and admin paths (plus the rollup
+# maintenance job); every SELECT, UPDATE and DELETE they issue must be
+# answered through an index.
+HOT_CALLS = [
+    ("get_user", (1,)),
+    ("is_banned", (1,)),
+    ("get_setting", ("welcome_message",)),
+    ("get_user_stats", (1,)),
+    ("get_global_stats", ()),
+    ("get_feedback", ()),
+    ("get_feedback", (11, 1)),
+    ("get_feedback", (11, None, 1)),
+    ("get_broadcast_recipients", (0, 100)),
+    ("get_broadcast_recipients", (0, 100, {'language': 'en', 'active_days': 7})),
+    ("get_broadcast_recipients", (0, 100, {'premium': True})),
+    ("count_segment", ({'language': 'en', 'premium': True},)),
+    ("count_segment", (None,)),
+    ("get_delivery_status", (1,)),
+    ("refresh_segment_summary", ()),
+    ("ban_user", (2,)),
+    ("unban_user", (2,)),
+    ("limit_user", (2,)),
+    ("unlimit_user", (2,)),
+    ("bulk_moderate", ("ban", [3, 4, 10**9])),
+    ("bulk_moderate", ("unban", [3, 4, 10**9])),
+    ("rollup_commands", ()),
+]
+
+TABLE_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?(?: LEFT-JOIN)?$")
+
+
+def queryplan_scenario(args: argparse.Namespace) -> None:
+    seed_database(min(args.users, 1000), min(args.commands, 10_000))
+    Bot.DatabaseManager.add_feedback(1, "benchmark")
+    conn = Bot.DatabaseManager.get_connection()
+    regressions = 0
+    for name, call_args in HOT_CALLS:
+        statements: List[str] = []
+        conn.set_trace_callback(statements.append)
+        Bot.DatabaseManager.log_command(1, "start")
+        getattr(Bot.DatabaseManager, name)(*call_args)
+        conn.set_trace_callback(None)
+        for sql in statements:
+            if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+                continue
+            # Scanning a subquery that was itself built through indexes is fine
+            materialized = set()
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+                detail = row[3]
+                if detail.startswith("MATERIALIZE "):
+                    materialized.add(detail.split()[1])
+                scan = TABLE_SCAN.match(detail)
+                # An automatic index is a full scan rebuilt on every execution
+                if (scan and scan.group(1) not in materialized) or "AUTOMATIC" in detail:
+                    regressions += 1
+                    print(f"queryplan/{name}: {detail}\n    {' '.join(sql.split())}")
+    print(f"queryplan: {len(HOT_CALLS)} hot calls checked, {regressions} table scans")
+    if regressions:
+        sys.exit(1)
+
+
+SCENARIOS = {
+    'latency': latency_scenario,
+    'logging': logging_scenario,
+    'loadtest': loadtest_scenario,
+    'writes': writes_scenario,
+    'ratelimit': ratelimit_scenario,
+    'broadcast': broadcast_scenario,
+    'stats': stats_scenario,
+    'queryplan': queryplan_scenario,
+    'render': render_scenario,
+    'segments': segments_scenario,
+    'rollup': rollup_scenario,
+    'callbacks': callbacks_scenario,
+    'concurrency': concurrency_scenario,
+    'e2e': e2e_scenario,
+    'feedback': feedback_scenario,
+    'metrics': metrics_scenario,
+    'migrations': migrations_scenario,
+    'moderation': moderation_scenario,
+    'profiling': profiling_scenario,
+    'sharding': sharding_scenario,
+    'storage': storage_scenario,
+    'webhook': webhook_scenario,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--commands", type=int, default=500_000)
+    parser.add_argument("--rate", type=float, default=300.0, help="updates per second")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per run")
+    parser.add_argument("--interactions", type=int, default=5_000)
+    parser.add_argument("--send-rate", type=float, default=None,
+                        help="override BROADCAST_GLOBAL_RATE (messages per second)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="fake Bot API latency in seconds")
+    parser.add_argument("--workers", type=int, default=4, help="largest worker count for sharding")
+    parser.add_argument("--heavy-every", type=int, default=50,
+                        help="every Nth update is an admin stats query (0 disables)")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling",
+                        help="how the e2e scenario receives updates")
+    parser.add_argument("--flood-rate", type=float, default=0.0,
+                        help="e2e: sends per second the fake Bot API allows before answering 429")
+    parser.add_argument("--blocked-every", type=int, default=0,
+                        help="e2e: chats whose id is a multiple of N have blocked the bot")
+    parser.add_argument("--concurrency", type=int, default=32, help="load test sessions in flight")
+    parser.add_argument("--admins", type=int, default=10, help="synthetic admin accounts for the load test")
+    parser.add_argument("--max-p95", type=float, default=None,
+                        help="fail the load test if any session kind's p95 exceeds this many milliseconds")
+    parser.add_argument("--db", default=None,
+                        help="database file to seed once and reuse on later runs (default: a fresh one)")
+    args = parser.parse_args()
+    Bot.setup_logging()
+    if args.db:
+        use_database(os.path.join(LAUNCH_DIR, args.db))
+    elif args.scenario != "migrations":
+        Bot.DatabaseManager.init_db()
+    SCENARIOS[args.scenario](args)
+    Bot.DatabaseManager.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""Local stand-in for the Telegram Bot API, for end-to-end load tests.
+
+Serves getMe, getUpdates, setWebhook/deleteWebhook, sendMessage,
+editMessageText and answerCallbackQuery over plain HTTP (any other method
+answers ok), injects /start commands and menu button presses at a target
+rate, and can answer like Telegram under load: 429 once the global send
+rate is exceeded and 403 for chats that blocked the bot. When every
+injected update is answered (or --grace runs out) it prints throughput and
+injection-to-reply latency, then exits.
+
+Usage:
+    python fake_bot_api.py [--port 8081] [--users N] [--rate R] [--duration S] [--callback-ratio F]
+                           [--flood-rate R] [--blocked-every N] [--retry-after S] [--grace S]
+    python Bot.py --api-url http://127.0.0.1:8081/bot
+    python Bot.py --api-url http://127.0.0.1:8081/bot --mode webhook --webhook-url http://127.0.0.1:8443/telegram
+
+Injection starts once the bot polls or registers its webhook. The token in
+the URL is not checked, so the bot runs with its configured BOT_TOKEN.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': "Fake Bot API", 'username': "fake_bot_api_bot"}
+BUTTONS = ["terms", "privacy", "version", "back"]
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class FakeBotAPIServer:
+    """Bot API endpoints plus an update injector, all on one asyncio loop."""
+
+    def __init__(self, users: int = 1000, callback_ratio: float = 0.5, flood_rate: float = 0.0,
+                 blocked_every: int = 0, retry_after: int = 1, seed: int = 18):
+        self.users = users
+        self.callback_ratio = callback_ratio
+        self.flood_rate = flood_rate
+        self.blocked_every = blocked_every
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.connected = asyncio.Event()
+        self.methods: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.latencies: List[float] = []
+        self.injected = 0
+        self.started = 0.0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._pending: Deque[Dict] = deque()
+        self._new_updates = asyncio.Event()
+        self._update_id = 0
+        self._message_id = 0
+        # chat_id -> injection times of updates still waiting for a reply
+        self._waiting: Dict[int, Deque[float]] = {}
+        self._tokens = flood_rate
+        self._refilled = time.monotonic()
+        self._webhook: Optional[Tuple[str, str, asyncio.Semaphore]] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._deliveries: set = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> None:
+        self._server = await asyncio.start_server(self._serve, host, port)
+
+    async def close(self) -> None:
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._client:
+            await self._client.aclose()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # --- HTTP ---------------------------------------------------------------
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Answer requests on one keep-alive connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                path = request_line.split()[1].decode()
+                status, payload = await self._dispatch(path, headers.get('content-type', ""), body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled: the loop is shutting down with a long poll still open
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, path: str, content_type: str, body: bytes) -> Tuple[int, Dict]:
+        url = urlsplit(path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = self._parse(url.query, content_type, body)
+        self.methods[method] += 1
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            status, payload = 200, {'ok': True, 'result': True}
+        else:
+            status, payload = await handler(params)
+        self.statuses[status] += 1
+        return status, payload
+
+    @staticmethod
+    def _parse(query: str, content_type: str, body: bytes) -> Dict:
+        """Parameters from the query string and a JSON or form-encoded body.
+
+        python-telegram-bot form-encodes each value as JSON, except plain
+        strings, so values that are not valid JSON are kept as they are.
+        """
+        if content_type.startswith("application/json") and body:
+            return json.loads(body)
+        params = {}
+        for name, value in parse_qsl(query) + parse_qsl(body.decode()):
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        return params
+
+    # --- Bot API methods ----------------------------------------------------
+
+    async def api_getMe(self, params: Dict) -> Tuple[int, Dict]:
+        return 200, {'ok': True, 'result': BOT_USER}
+
+    async def api_getUpdates(self, params: Dict) -> Tuple[int, Dict]:
+        self.connected.set()
+        offset = int(params.get('offset') or 0)
+        while self._pending and self._pending[0]['update_id'] < offset:
+            self._pending.popleft()
+        if not self._pending and params.get('timeout'):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params['timeout']))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get('limit') or 100)
+        return 200, {'ok': True, 'result': [self._pending[i] for i in range(min(limit, len(self._pending)))]}
+
+    async def api_setWebhook(self, params: Dict) -> Tuple[int, Dict]:
+        connections = asyncio.Semaphore(int(params.get('max_connections') or 40))
+        self._webhook = (params['url'], params.get('secret_token', ""), connections)
+        self._client = self._client or httpx.AsyncClient(limits=httpx.Limits(max_connections=None))
+        self.connected.set()
+        return 200, {'ok': True, 'result': True}
+
+    async def api_deleteWebhook(self, params: Dict) -> Tuple[int, Dict]:
+        self._webhook = None
+        return 200, {'ok': True, 'result': True}
+
+    async def api_sendMessage(self, params: Dict) -> Tuple[int, Dict]:
+        return self._send(params)
+
+    async def api_editMessageText(self, params: Dict) -> Tuple[int, Dict]:
+        return self._send(params)
+
+    async def api_answerCallbackQuery(self, params: Dict) -> Tuple[int, Dict]:
+        return 200, {'ok': True, 'result': True}
+
+    def _send(self, params: Dict) -> Tuple[int, Dict]:
+        chat_id = int(params.get('chat_id', 0))
+        if self.flood_rate:
+            # Token bucket holding one second of the allowed global send rate
+            now = time.monotonic()
+            self._tokens = min(self.flood_rate, self._tokens + (now - self._refilled) * self.flood_rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f"Too Many Requests: retry after {self.retry_after}",
+                             'parameters': {'retry_after': self.retry_after}}
+            self._tokens -= 1
+        # A refused reply still answers the update; a throttled one may be retried
+        waiting = self._waiting.get(chat_id)
+        if waiting:
+            self.latencies.append(time.perf_counter() - waiting.popleft())
+            if not waiting:
+                del self._waiting[chat_id]
+        if self.blocked_every and chat_id % self.blocked_every == 0:
+            return 403, {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"}
+        self._message_id += 1
+        return 200, {'ok': True, 'result': {
+            'message_id': self._message_id, 'date': int(time.time()), 'text': params.get('text', ""),
+            'from': BOT_USER, 'chat': {'id': chat_id, 'type': "private"}
+        }}
+
+    # --- Update injection ---------------------------------------------------
+
+    def make_update(self, user_id: int) -> Dict:
+        """A /start command or, with probability callback_ratio, a menu button press."""
+        self._update_id += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}", 'language_code': "en"}
+        chat = {'id': user_id, 'type': "private"}
+        if self.rng.random() < self.callback_ratio:
+            return {'update_id': self._update_id, 'callback_query': {
+                'id': str(self._update_id), 'from': user, 'chat_instance': str(user_id),
+                'data': self.rng.choice(BUTTONS),
+                'message': {'message_id': 1, 'date': int(time.time()), 'text': "menu", 'from': BOT_USER,
+                            'chat': chat}
+            }}
+        return {'update_id': self._update_id, 'message': {
+            'message_id': self._update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+            'text': "/start", 'entities': [{'type': "bot_command", 'offset': 0, 'length': 6}]
+        }}
+
+    def push(self, update: Dict) -> None:
+        """Queue one update for the next getUpdates, or POST it to the webhook."""
+        chat_id = (update.get('message') or update['callback_query']['message'])['chat']['id']
+        self._waiting.setdefault(chat_id, deque()).append(time.perf_counter())
+        self.injected += 1
+        if self._webhook:
+            task = asyncio.create_task(self._deliver(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._pending.append(update)
+            self._new_updates.set()
+
+    async def _deliver(self, update: Dict) -> None:
+        url, secret_token, connections = self._webhook
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+        async with connections:
+            try:
+                response = await self._client.post(url, json=update, headers=headers)
+                self.statuses[f"webhook {response.status_code}"] += 1
+            except httpx.HTTPError:
+                self.statuses["webhook error"] += 1
+
+    async def inject(self, rate: float, duration: float) -> None:
+        """Push updates from random users at `rate` per second for `duration` seconds."""
+        self.started = time.perf_counter()
+        interval = 1 / rate
+        sent = 0
+        while (elapsed := time.perf_counter() - self.started) < duration:
+            # Catch up in bursts when the loop is busy, so the offered rate holds
+            while sent <= elapsed / interval:
+                self.push(self.make_update(self.rng.randint(1, self.users)))
+                sent += 1
+            await asyncio.sleep(interval)
+
+    async def drain(self, timeout: float) -> None:
+        """Wait until every injected update has been answered, or `timeout` passes."""
+        deadline = time.perf_counter() + timeout
+        while self._waiting and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+    @property
+    def unanswered(self) -> int:
+        return sum(len(waiting) for waiting in self._waiting.values())
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        ms = [s * 1000 for s in self.latencies]
+        lines = [
+            f"injected {self.injected} updates, {len(ms)} answered ({len(ms) / elapsed:.1f}/s), "
+            f"{self.unanswered} unanswered",
+            f"injection to reply: p50={percentile(ms, 50):.2f}ms p95={percentile(ms, 95):.2f}ms "
+            f"p99={percentile(ms, 99):.2f}ms max={max(ms, default=0):.2f}ms",
+            "methods: " + ", ".join(f"{name}={count}" for name, count in self.methods.most_common()),
+            "statuses: " + ", ".join(f"{status}={count}" for status, count in sorted(self.statuses.items(),
+                                                                                      key=str))
+        ]
+        return "\n".join(lines)
+
+
+async def serve(args: argparse.Namespace) -> None:
+    server = FakeBotAPIServer(args.users, args.callback_ratio, args.flood_rate, args.blocked_every,
+                              args.retry_after)
+    await server.start(args.host, args.port)
+    print(f"Fake Bot API on http://{args.host}:{args.port}/bot, waiting for the bot to poll or set a webhook")
+    await server.connected.wait()
+    print(f"Injecting {args.rate:g} updates/s for {args.duration:g}s")
+    await server.inject(args.rate, args.duration)
+    await server.drain(args.grace)
+    print(server.report())
+    await server.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--users", type=int, default=1000, help="distinct users updates come from")
+    parser.add_argument("--rate", type=float, default=100.0, help="updates injected per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to inject for")
+    parser.add_argument("--callback-ratio", type=float, default=0.5, help="share of updates that are button presses")
+    parser.add_argument("--flood-rate", type=float, default=0.0,
+                        help="sends per second allowed before answering 429 (0 disables)")
+    parser.add_argument("--blocked-every", type=int, default=0,
+                        help="chats whose id is a multiple of N have blocked the bot (0 disables)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after seconds in 429 answers")
+    parser.add_argument("--grace", type=float, default=10.0, help="seconds to wait for the last replies")
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()